@@ -105,6 +105,18 @@ def main(spider_name, thread_number=None,
     if opt_queue:
         bot.setup_queue(**opt_queue)
 
+    opt_queue_buffer = spider_config.get('queue_buffer')
+    if opt_queue_buffer:
+        bot.setup_queue_buffer(**opt_queue_buffer)
+
+    opt_url_filter = spider_config.get('url_filter')
+    if opt_url_filter:
+        bot.setup_url_filter(**opt_url_filter)
+
+    opt_coordinator = spider_config.get('coordinator')
+    if opt_coordinator:
+        bot.setup_coordinator(**opt_coordinator)
+
     opt_cache = spider_config.get('cache')
     if opt_cache:
         bot.setup_cache(**opt_cache)
@@ -16,10 +16,12 @@ from contextlib import contextmanager
 from traceback import format_exc
 import multiprocessing
 import threading
-from datetime import datetime
+from datetime import datetime, timedelta
 import threading
 from threading import Thread
 from collections import deque
+import heapq
+import itertools
 
 from grab.base import Grab
 from grab.error import GrabInvalidUrl
@@ -28,14 +30,31 @@ from grab.spider.error import (SpiderError, SpiderMisuseError, FatalError,
                                SpiderConfigurationError)
 from grab.spider.task import Task
 from grab.spider.data import Data
-from grab.spider.transport.multicurl import MulticurlTransport
+from grab.spider.transport.multicurl import (MulticurlTransport,
+                                             is_event_loop_supported)
 from grab.proxylist import ProxyList, BaseProxySource
 from grab.util.misc import camel_case_to_underscore
 from weblib.encoding import make_str, make_unicode
 from grab.base import GLOBAL_STATE
 from grab.stat import Stat, Timer
 from grab.spider.parser_pipeline import ParserPipeline
-from grab.spider.cache_pipeline import CachePipeline
+from grab.spider.cache_pipeline import (CachePipeline,
+                                        DEFAULT_CACHE_QUEUE_SIZE,
+                                        DEFAULT_CACHE_WRITE_BATCH_SIZE)
+from grab.spider.cache_memory import MemoryCache, TwoTierCacheBackend
+from grab.spider.rate_limit import RateLimiter, DEFAULT_BACKLOG
+from grab.spider.queue_buffer import QueueBuffer
+from grab.spider.frontier import (Frontier, DEFAULT_HOST_STREAMS,
+                                  DEFAULT_HOST_BUFFER_SIZE, get_task_host)
+from grab.spider.concurrency import (ConcurrencyController,
+                                     is_overload_result)
+from grab.spider.retry import RetryPolicy, get_error_class
+from grab.spider.url_filter import (UrlFilter, canonicalize_url,
+                                    DEFAULT_FP_SAMPLE_RATE)
+from grab.spider.shared_body import (is_shared_body_supported,
+                                     prepare_shared_body, export_result_body,
+                                     import_result_body,
+                                     DEFAULT_SHARED_BODY_MIN_SIZE)
 from grab.spider.deprecated import DeprecatedThingsSpiderMixin
 from grab.util.warning import warn
 
@@ -44,7 +63,19 @@ DEFAULT_NETWORK_STREAM_NUMBER = 3
 DEFAULT_TASK_TRY_LIMIT = 5
 DEFAULT_NETWORK_TRY_LIMIT = 5
 DEFAULT_RPS_LIMIT = 0
+# How long the parser waits for network result before
+# it checks the shutdown event
+PARSER_QUEUE_WAIT = 0.1
 RANDOM_TASK_PRIORITY_RANGE = (50, 100)
+# Max time (in seconds) the event loop waits for something to happen
+EVENT_LOOP_MAX_WAIT = 1
+# Max time the event loop waits when task queue contains only delayed tasks
+EVENT_LOOP_SCHEDULE_WAIT = 0.1
+# Max number of tasks which task generator puts into the task queue at once
+TASK_GENERATOR_BATCH_SIZE = 100
+# How long the spider waits before it takes tasks from the task queue again
+# if all taken tasks have been returned because their hosts are busy
+FRONTIER_FILL_RETRY_INTERVAL = 0.5
 NULL = object()
 
 logger = logging.getLogger('grab.spider.base')
@@ -147,6 +178,10 @@ class Spider(DeprecatedThingsSpiderMixin):
                  parser_pool_size=None,
                  parser_mode=False,
                  parser_requests_per_process=10000,
+                 loop_waker=None,
+                 shared_body_min_size=DEFAULT_SHARED_BODY_MIN_SIZE,
+                 # event loop
+                 event_loop=False,
                  # http api
                  http_api_port=None,
                  ):
@@ -168,6 +203,12 @@ class Spider(DeprecatedThingsSpiderMixin):
         * retry_rebuild_user_agent - generate new random user-agent for each
             network request which is performed again due to network error
         * args - command line arguments parsed with `setup_arg_parser` method
+        * shared_body_min_size - in multiprocess mode response bodies
+            of this size or bigger are passed to parser processes through
+            shared memory (python 3.8 or newer), use None to disable
+        * event_loop - if True then the main loop sleeps until network
+            sockets are ready or new results are available instead of
+            polling the network transport and internal queues
         New options:
         * taskq=None,
         * newtork_response_queue=None,
@@ -206,6 +247,18 @@ class Spider(DeprecatedThingsSpiderMixin):
         self.parser_pool_size = parser_pool_size
         self.parser_mode = parser_mode
         self.parser_requests_per_process = parser_requests_per_process
+        # Things produced by the task handler which is being executed
+        self.parser_result_batch = None
+        self.loop_waker = loop_waker
+        if not is_shared_body_supported():
+            shared_body_min_size = None
+        self.shared_body_min_size = shared_body_min_size
+
+        if event_loop and not is_event_loop_supported():
+            raise SpiderConfigurationError(
+                'Event loop mode requires `selectors` module '
+                '(python 3.4 or newer)')
+        self.event_loop = event_loop
 
         self.stat = Stat()
         self.timer = Timer()
@@ -241,6 +294,13 @@ class Spider(DeprecatedThingsSpiderMixin):
             rps_limit or
             int(self.config.get('rps_limit',
                                 DEFAULT_RPS_LIMIT)))
+        self.rate_limiter = None
+        if self.rps_limit:
+            self.setup_rate_limit(rps=self.rps_limit)
+        # Heap of tasks delayed by the rate limiter:
+        # (ready time, sequence number, task, grab)
+        self.deferred_tasks = []
+        self.deferred_task_counter = itertools.count()
 
         self._grab_config = {}
         if priority_mode not in ['random', 'const']:
@@ -251,6 +311,17 @@ class Spider(DeprecatedThingsSpiderMixin):
 
         self.only_cache = only_cache
         self.cache_pipeline = None
+        self.frontier = None
+        # Time before which the frontier is not filled again because
+        # the task queue has no tasks which could be sent to the network
+        self.frontier_fill_time = 0
+        self.concurrency_controller = None
+        self.retry_policy = None
+        self.url_filter = None
+        self.coordinator = None
+        self.task_generator_enabled = False
+        # Tasks which have been taken from the task queue in advance
+        self.task_buffer = deque()
         self.work_allowed = True
         if request_pause is not NULL:
             warn('Option `request_pause` is deprecated and is not '
@@ -263,17 +334,203 @@ class Spider(DeprecatedThingsSpiderMixin):
         self.interrupted = False
 
     def setup_cache(self, backend='mongo', database=None, use_compression=True,
-                    **kwargs):
+                    worker_number=1, queue_size=DEFAULT_CACHE_QUEUE_SIZE,
+                    write_batch_size=DEFAULT_CACHE_WRITE_BATCH_SIZE,
+                    memory_cache_size=None, revalidate=True, **kwargs):
+        """
+        Enable the cache of network documents.
+
+        :param worker_number: number of cache pipeline threads, each thread
+            has its own connection to the database
+        :param queue_size: max. number of requests waiting for the cache
+            pipeline
+        :param write_batch_size: max. number of documents saved to
+            the database with one request
+        :param memory_cache_size: if specified then recently used documents
+            are kept in memory, it is the max. size of them in bytes
+        :param revalidate: if True then the spider sends conditional
+            request (If-None-Match, If-Modified-Since) when the cache item
+            is older than `cache_timeout` of the task, the "304 Not
+            Modified" response refreshes the cache item
+
+        Other options are passed to the backend constructor.
+        """
+
         if database is None:
             raise SpiderMisuseError('setup_cache method requires database '
                                     'option')
         self.cache_enabled = True
         mod = __import__('grab.spider.cache_backend.%s' % backend,
                          globals(), locals(), ['foo'])
-        cache = mod.CacheBackend(database=database,
-                                 use_compression=use_compression,
-                                 spider=self, **kwargs)
-        self.cache_pipeline = CachePipeline(self, cache)
+        caches = [mod.CacheBackend(database=database,
+                                   use_compression=use_compression,
+                                   spider=self, **kwargs)
+                  for x in range(worker_number)]
+        if memory_cache_size:
+            memory_cache = MemoryCache(max_size=memory_cache_size)
+            caches = [TwoTierCacheBackend(x, memory_cache, self.stat)
+                      for x in caches]
+        self.cache_pipeline = CachePipeline(
+            self, caches, queue_size=queue_size,
+            write_batch_size=write_batch_size, revalidate=revalidate)
+
+    def setup_rate_limit(self, rps=None, host_rps=None, task_rps=None,
+                         hosts=None, tasks=None, burst=1,
+                         backlog=DEFAULT_BACKLOG):
+        """
+        Configure limits of network requests rate.
+
+        :param rps: global limit of requests per second
+        :param host_rps: requests per second limit applied to each host
+        :param task_rps: requests per second limit applied to each
+            task name
+        :param hosts: dict of limits for specific hosts
+        :param tasks: dict of limits for specific task names
+        :param burst: number of requests which could be sent at once
+            if limit was not reached for some time
+        :param backlog: max. number of tasks which could be put aside
+            due to one limit (e.g. limit of one host)
+
+        Tasks which exceed the limits do not block the spider. They are
+        put aside and are sent to network when the limits allow that.
+        If too many tasks have been put aside due to some limit then
+        other tasks affected by that limit are returned to the task
+        queue as delayed tasks.
+        """
+
+        self.rate_limiter = RateLimiter(rps=rps, host_rps=host_rps,
+                                        task_rps=task_rps,
+                                        hosts=hosts, tasks=tasks,
+                                        burst=burst, backlog=backlog)
+
+    def setup_frontier(self, host_streams=DEFAULT_HOST_STREAMS,
+                       buffer_size=None, hosts=None,
+                       host_buffer_size=DEFAULT_HOST_BUFFER_SIZE):
+        """
+        Enable per-host scheduling of tasks.
+
+        Tasks taken from the task queue are distributed among network
+        streams in round-robin order of their hosts. Each host could use
+        not more than `host_streams` network streams at the same time.
+
+        :param host_streams: max. number of concurrent requests to one host
+        :param buffer_size: max. number of tasks taken from the task queue
+            and waiting for free network streams. The buffer should be big
+            enough to contain tasks of many hosts.
+        :param hosts: dict of `host_streams` values for specific hosts
+        :param host_buffer_size: max. number of buffered tasks of one
+            host, other tasks of that host are returned to the task queue
+        """
+
+        if buffer_size is None:
+            buffer_size = max(1000, self.thread_number * 100)
+        self.frontier = Frontier(host_streams=host_streams,
+                                 buffer_size=buffer_size, hosts=hosts,
+                                 host_buffer_size=host_buffer_size)
+
+    def setup_concurrency_control(self, min_streams=1, initial_streams=None,
+                                  per_host=False, host_max_streams=None,
+                                  **kwargs):
+        """
+        Enable run-time adjustment of number of concurrent network requests.
+
+        The number of requests is increased by one while network results
+        are good and it is cut down when there are too many timeouts,
+        429/503 responses or when the latency grows. The `thread_number`
+        option is the upper bound of the number of requests.
+
+        :param min_streams: min. number of concurrent requests
+        :param initial_streams: number of concurrent requests at the start,
+            by default it is `thread_number`
+        :param per_host: if True then number of concurrent requests to each
+            host is adjusted too. That option enables the frontier
+            (see `setup_frontier` method) if it is not enabled yet.
+        :param host_max_streams: max. number of concurrent requests to
+            one host, by default it is `thread_number`
+
+        Other options are passed to `ConcurrencyController` constructor.
+        """
+
+        if per_host and self.frontier is None:
+            self.setup_frontier()
+        self.concurrency_controller = ConcurrencyController(
+            max_streams=self.thread_number, min_streams=min_streams,
+            initial_streams=initial_streams, per_host=per_host,
+            host_max_streams=host_max_streams, **kwargs)
+
+    def setup_retry_policy(self, **kwargs):
+        """
+        Enable delayed retries of failed network requests.
+
+        By default the task of failed network request is put back into the
+        task queue immediately. With retry policy the task is scheduled
+        with the delay which grows exponentially with the number of
+        network tries. See `RetryPolicy` for available options.
+        """
+
+        self.retry_policy = RetryPolicy(**kwargs)
+
+    def setup_url_filter(self, backend='memory', canonicalizer=None,
+                         fp_sample_rate=None, **kwargs):
+        """
+        Enable filter which drops new tasks with URLs seen before.
+
+        Only GET requests of new tasks are filtered. Tasks which are
+        restarted due to network errors, cloned tasks and tasks with
+        `disable_url_filter=True` option are not filtered.
+
+        :param backend: "memory", "disk" or "redis"
+        :param canonicalizer: function which converts URL to the canonical
+            form, by default `canonicalize_url` function is used
+        :param fp_sample_rate: share of URLs used to count false positives
+            of the filter, by default it is enabled only for memory backend
+
+        Other options are passed to the backend constructor.
+        """
+
+        logger.debug('Using %s backend for URL filter' % backend)
+        mod = __import__('grab.spider.url_filter_backend.%s' % backend,
+                         globals(), locals(), ['foo'])
+        if canonicalizer is None:
+            canonicalizer = canonicalize_url
+        if fp_sample_rate is None:
+            if backend == 'memory':
+                fp_sample_rate = DEFAULT_FP_SAMPLE_RATE
+            else:
+                fp_sample_rate = 0
+        filter_backend = mod.UrlFilterBackend(
+            spider_name=self.get_spider_name(), **kwargs)
+        self.url_filter = UrlFilter(filter_backend, self.stat,
+                                    canonicalizer=canonicalizer,
+                                    fp_sample_rate=fp_sample_rate)
+
+    def is_url_filter_applicable(self, task):
+        if (task.network_try_count or task.task_try_count > 1
+                or task.get('disable_url_filter')):
+            return False
+        if task.grab_config and (task.grab_config.get('post')
+                                 or task.grab_config.get('multipart_post')):
+            return False
+        return True
+
+    def setup_coordinator(self, **kwargs):
+        """
+        Enable distributed mode: the spider works together with other
+        spiders which use the same task queue and coordinator options.
+
+        Task queue must be shared and it must give out tasks on lease
+        (redis or mongo backend). Only one spider processes initial URLs
+        and the task generator. All spiders stop when the shared queue is
+        empty and all of them have completed their work. Use the URL
+        filter with redis backend to drop duplicates across all spiders.
+
+        Options are passed to `Coordinator` constructor.
+        """
+
+        from grab.spider.coordinator import Coordinator
+
+        self.coordinator = Coordinator(spider_name=self.get_spider_name(),
+                                       **kwargs)
 
     def setup_queue(self, backend='memory', **kwargs):
         logger.debug('Using %s backend for task queue' % backend)
@@ -282,6 +539,22 @@ class Spider(DeprecatedThingsSpiderMixin):
         self.task_queue = mod.QueueBackend(spider_name=self.get_spider_name(),
                                            **kwargs)
 
+    def setup_queue_buffer(self, **kwargs):
+        """
+        Put the write-behind buffer in front of the task queue.
+
+        New tasks are collected in memory and written to the queue backend
+        in batches by the background thread. Useful with remote backends:
+        `add_task` does not wait for the network request. Buffered tasks
+        are written when the spider leaves the shared queue.
+
+        Options are passed to `QueueBuffer` constructor.
+        """
+
+        if self.task_queue is None:
+            self.setup_queue()
+        self.task_queue = QueueBuffer(self.task_queue, **kwargs)
+
     def add_task(self, task, raise_error=False):
         """
         Add task to the task queue.
@@ -290,9 +563,45 @@ class Spider(DeprecatedThingsSpiderMixin):
         # MP:
         # ***
         if self.parser_mode:
-            self.parser_result_queue.put((task, None))
+            if self.parser_result_batch is not None:
+                # Task is added from the handler
+                self.parser_result_batch.append(task)
+            else:
+                self.parser_result_queue.put((task, None))
             return
 
+        if not self.check_new_task(task, raise_error=raise_error):
+            return False
+        # TODO: keep original task priority if it was set explicitly
+        self.task_queue.put(task, task.priority, schedule_time=task.schedule_time)
+        return True
+
+    def add_tasks(self, tasks):
+        """
+        Add multiple tasks to the task queue with one request
+        to the queue backend.
+
+        If the subclass overrides `add_task` method then tasks are added
+        one by one with that method.
+
+        Returns number of added tasks.
+        """
+
+        if type(self).add_task is not Spider.add_task:
+            return len([x for x in tasks if self.add_task(x) is not False])
+        items = [(x, x.priority, x.schedule_time) for x in tasks
+                 if self.check_new_task(x)]
+        if items:
+            self.task_queue.put_many(items)
+        return len(items)
+
+    def check_new_task(self, task, raise_error=False):
+        """
+        Prepare the task which is going to be added to the task queue.
+
+        Returns False if the task should not be added.
+        """
+
         if self.task_queue is None:
             raise SpiderMisuseError('You should configure task queue before '
                                     'adding tasks. Use `setup_queue` method.')
@@ -325,8 +634,12 @@ class Spider(DeprecatedThingsSpiderMixin):
                 logger.error('', exc_info=ex)
                 return False
 
-        # TODO: keep original task priority if it was set explicitly
-        self.task_queue.put(task, task.priority, schedule_time=task.schedule_time)
+        if (self.url_filter is not None
+                and self.is_url_filter_applicable(task)
+                and self.url_filter.is_seen(task.url)):
+            logger_verbose.debug('Task %s is rejected because URL %s has '
+                                 'been seen before' % (task.name, task.url))
+            return False
         return True
 
     def stop(self):
@@ -337,6 +650,18 @@ class Spider(DeprecatedThingsSpiderMixin):
 
         logger_verbose.debug('Method `stop` was called')
         self.work_allowed = False
+        self.wakeup_main_loop()
+
+    def wakeup_main_loop(self):
+        """
+        Interrupt the waiting of the main loop working in event loop mode.
+
+        It should be called by any thread or parser process after it
+        produced something which the main loop should process.
+        """
+
+        if self.loop_waker is not None:
+            self.loop_waker.wake()
 
     def load_proxylist(self, source, source_type=None, proxy_type='http',
                        auto_init=True, auto_change=True,
@@ -418,8 +743,13 @@ class Spider(DeprecatedThingsSpiderMixin):
                        metric.format_traffic_value(
                            self.stat.counters['download-size']))
         out.append('Queue size: %d' % self.task_queue.size()
-                                      if self.task_queue else 'NA')
+                   if self.task_queue else 'NA')
         out.append('Network streams: %d' % self.thread_number)
+        if self.concurrency_controller:
+            out.append('Network streams limit: %d'
+                       % self.concurrency_controller.limit)
+        if self.frontier:
+            out.append('Frontier buffer: %d' % self.frontier.size)
         elapsed = self.timer.timers['total']
         hours, seconds = divmod(elapsed, 3600)
         minutes, seconds = divmod(seconds, 60)
@@ -545,30 +875,51 @@ class Spider(DeprecatedThingsSpiderMixin):
         then load new tasks from tasks file.
         """
 
-        while True:
-            with self.timer.log_time('task_generator'):
-                queue_size = self.task_queue.size()
-                min_limit = self.thread_number * 10
-            if queue_size < min_limit:
+        try:
+            while True:
                 with self.timer.log_time('task_generator'):
-                    logger_verbose.debug(
-                        'Task queue contains less tasks (%d) than '
-                        'allowed limit (%d). Trying to add '
-                        'new tasks.' % (queue_size, min_limit))
-                    try:
-                        for x in six.moves.range(min_limit - queue_size):
-                            item = next(task_generator)
-                            logger_verbose.debug('Got new item from generator. '
-                                                 'Processing it.')
-                            self.process_handler_result(item)
-                    except StopIteration:
-                        # If generator have no values to yield
-                        # then disable it
-                        logger_verbose.debug('Task generator has no more tasks. '
-                                             'Disabling it')
-                        break
-            else:
-                time.sleep(0.1)
+                    queue_size = self.task_queue.size()
+                    min_limit = self.thread_number * 10
+                if queue_size < min_limit:
+                    with self.timer.log_time('task_generator'):
+                        logger_verbose.debug(
+                            'Task queue contains less tasks (%d) than '
+                            'allowed limit (%d). Trying to add '
+                            'new tasks.' % (queue_size, min_limit))
+                        # Tasks are put into the task queue in batches
+                        tasks = []
+                        try:
+                            for x in six.moves.range(min_limit - queue_size):
+                                item = next(task_generator)
+                                logger_verbose.debug(
+                                    'Got new item from generator. '
+                                    'Processing it.')
+                                if isinstance(item, Task):
+                                    tasks.append(item)
+                                    if (len(tasks) >=
+                                            TASK_GENERATOR_BATCH_SIZE):
+                                        self.add_tasks(tasks)
+                                        tasks = []
+                                        self.wakeup_main_loop()
+                                else:
+                                    self.process_handler_result(item)
+                        except StopIteration:
+                            # If generator have no values to yield
+                            # then disable it
+                            logger_verbose.debug('Task generator has no more '
+                                                 'tasks. Disabling it')
+                            break
+                        finally:
+                            self.add_tasks(tasks)
+                            self.wakeup_main_loop()
+                else:
+                    time.sleep(0.1)
+        finally:
+            # Flag is reset after all tasks have been put into the task
+            # queue so the main loop could not see empty queue
+            # and enabled generator at the same time
+            self.task_generator_enabled = False
+            self.wakeup_main_loop()
 
     def start_task_generators(self):
         """
@@ -576,12 +927,18 @@ class Spider(DeprecatedThingsSpiderMixin):
         method.
         """
 
+        if (self.coordinator is not None
+                and not self.coordinator.acquire_seed()):
+            logger.debug('Initial tasks are generated by other worker')
+            return
+
         logger_verbose.debug('Processing initial urls')
         if self.initial_urls:
             for url in self.initial_urls:
                 self.add_task(Task('initial', url=url))
 
         self._task_generator_list = []
+        self.task_generator_enabled = True
         th = Thread(target=self.task_generator_thread_wrapper,
                     args=[self.task_generator()])
         th.daemon = True
@@ -589,11 +946,16 @@ class Spider(DeprecatedThingsSpiderMixin):
         self._task_generator_list.append(th)
 
     def get_task_from_queue(self):
-        start = time.time()
-        try:
+        if self.frontier is not None:
+            return self.get_task_from_frontier()
+        if not self.task_buffer:
+            # Take tasks for all free network streams at once
             with self.timer.log_time('task_queue'):
-                return self.task_queue.get()
-        except queue.Empty:
+                self.task_buffer.extend(self.task_queue.get_many(
+                    max(1, self.transport.get_free_threads_number())))
+        if self.task_buffer:
+            return self.task_buffer.popleft()
+        else:
             size = self.task_queue.size()
             if size:
                 logger_verbose.debug(
@@ -604,6 +966,64 @@ class Spider(DeprecatedThingsSpiderMixin):
                 logger_verbose.debug('Task queue is empty.')
                 return None
 
+    def fill_frontier(self):
+        """
+        Take tasks from the task queue until the frontier has a task
+        which host has free network streams.
+
+        Tasks of hosts which have too many buffered tasks are returned
+        to the task queue.
+        """
+
+        if time.time() < self.frontier_fill_time:
+            return
+        rejected = []
+        taken = 0
+        while (not self.frontier.is_full()
+               and taken < self.frontier.buffer_size):
+            tasks = self.task_queue.get_many(
+                self.frontier.buffer_size - self.frontier.size)
+            if not tasks:
+                break
+            taken += len(tasks)
+            for task in tasks:
+                if not self.frontier.put(task):
+                    rejected.append(task)
+            if self.frontier.has_ready_tasks():
+                break
+        if rejected:
+            if not self.frontier.has_ready_tasks():
+                self.frontier_fill_time = (time.time()
+                                           + FRONTIER_FILL_RETRY_INTERVAL)
+            self.task_queue.put_many([(x, x.priority, None)
+                                      for x in rejected])
+            for task in rejected:
+                self.task_queue.ack(task)
+
+    def get_task_from_frontier(self):
+        with self.timer.log_time('task_queue'):
+            if not self.frontier.has_ready_tasks():
+                self.fill_frontier()
+            task = self.frontier.get()
+        if task is not None:
+            return task
+        elif self.frontier.size or self.task_queue.size():
+            logger_verbose.debug('No tasks which hosts have free '
+                                 'network streams')
+            return True
+        else:
+            logger_verbose.debug('Task queue is empty.')
+            return None
+
+    def release_task_host(self, task):
+        """
+        Notify the frontier that the network processing of task
+        has been completed.
+        """
+
+        if self.frontier is not None:
+            self.frontier.release(task)
+
     def setup_grab_for_task(self, task):
         grab = self.create_grab_instance()
         if task.grab_config:
@@ -613,6 +1033,11 @@ class Spider(DeprecatedThingsSpiderMixin):
 
         # Generate new common headers
         grab.config['common_headers'] = grab.common_headers()
+        revalidation_headers = task.get('revalidation_headers')
+        if revalidation_headers:
+            headers = dict(grab.config['headers'])
+            headers.update(revalidation_headers)
+            grab.config['headers'] = headers
         self.update_grab_instance(grab)
         return grab
 
@@ -666,11 +1091,17 @@ class Spider(DeprecatedThingsSpiderMixin):
                 return handler
 
     def is_valid_network_result(self, res):
-        if res['task'].get('raw'):
+        if (self.cache_pipeline is not None and res.ok
+                and res.grab.response.code == 304
+                and not res.grab.response.from_cache):
+            # Response to the conditional request which has not been
+            # refreshed from the cache has no document
+            return False
+        if res.task.get('raw'):
             return True
-        if res['ok']:
-            res_code = res['grab'].response.code
-            if self.is_valid_network_response_code(res_code, res['task']):
+        if res.ok:
+            res_code = res.grab.response.code
+            if self.is_valid_network_response_code(res_code, res.task):
                 return True
         return False
 
@@ -688,11 +1119,10 @@ class Spider(DeprecatedThingsSpiderMixin):
             recent_task_time = time.time()
             while True:
                 try:
-                    result = self.network_result_queue.get(block=False)
+                    result = self.network_result_queue.get(
+                        True, PARSER_QUEUE_WAIT)
                 except queue.Empty:
                     self.is_parser_idle.set()
-                    time.sleep(0.1)
-                    self.is_parser_idle.clear()
                     logger_verbose.debug('Network result queue is empty')
                     # Set `waiting_shutdown_event` only after 1 seconds
                     # of waiting for tasks to avoid
@@ -703,31 +1133,29 @@ class Spider(DeprecatedThingsSpiderMixin):
                         logger_verbose.debug('Got shutdown event')
                         return
                 else:
+                    self.is_parser_idle.clear()
+                    if result.shared_body:
+                        import_result_body(result)
                     process_request_count += 1
                     recent_task_time = time.time()
                     if self.parser_mode:
                         self.stat.reset()
                     #if self.waiting_shutdown_event.is_set():
                     #    self.waiting_shutdown_event.clear()
+                    self.parser_result_batch = []
                     try:
-                        handler = self.find_task_handler(result['task'])
+                        handler = self.find_task_handler(result.task)
                     except NoTaskHandler as ex:
                         ex.tb = format_exc()
-                        self.parser_result_queue.put((ex, result['task']))
+                        self.parser_result_batch.append(ex)
                         self.stat.inc('parser:handler-not-found')
                     else:
                         self.process_network_result_with_handler(
                             result, handler)
                         self.stat.inc('parser:handler-processed')
                     finally:
-                        if self.parser_mode:
-                            data = {
-                                'type': 'stat',
-                                'counters': self.stat.counters,
-                                'collections': self.stat.collections,
-                            }
-                            self.parser_result_queue.put((data,
-                                                          result['task']))
+                        self.send_parser_result_batch(result.task)
+                        self.wakeup_main_loop()
                         if self.parser_mode:
                             if self.parser_requests_per_process:
                                 if (process_request_count >=
@@ -740,24 +1168,43 @@ class Spider(DeprecatedThingsSpiderMixin):
         #    self.waiting_shutdown_event.set()
 
 
+    def send_parser_result_batch(self, task):
+        """
+        Send all things produced by the handler of the task to the main
+        process with one message.
+
+        In parser mode the message also contains changes of stat counters
+        made since the start of the task processing.
+        """
+
+        batch = {'type': 'batch', 'items': self.parser_result_batch}
+        self.parser_result_batch = None
+        if self.parser_mode:
+            batch['counters'] = dict(
+                (x, y) for x, y in self.stat.counters.items() if y)
+            batch['collections'] = dict(
+                (x, y) for x, y in self.stat.collections.items() if y)
+        # Message is sent even if it is empty because it lets
+        # the main process know that the result has been processed
+        self.parser_result_queue.put((batch, task))
+
     def process_network_result_with_handler(self, result, handler):
         handler_name = getattr(handler, '__name__', 'NONE')
         try:
             with self.timer.log_time('response_handler'):
                 with self.timer.log_time('response_handler.%s' % handler_name):
-                    handler_result = handler(result['grab'], result['task'])
+                    handler_result = handler(result.grab, result.task)
                     if handler_result is None:
                         pass
                     else:
                         for something in handler_result:
-                            self.parser_result_queue.put((something,
-                                                          result['task']))
+                            self.parser_result_batch.append(something)
         except NoDataHandler as ex:
             ex.tb = format_exc()
-            self.parser_result_queue.put((ex, result['task']))
+            self.parser_result_batch.append(ex)
         except Exception as ex:
             ex.tb = format_exc()
-            self.parser_result_queue.put((ex, result['task']))
+            self.parser_result_batch.append(ex)
 
     def find_task_handler(self, task):
         callback = task.get('callback')
@@ -776,14 +1223,14 @@ class Spider(DeprecatedThingsSpiderMixin):
         # Increase stat counters
         self.stat.inc('spider:request-processed')
         self.stat.inc('spider:task')
-        self.stat.inc('spider:task-%s' % res['task'].name)
-        if (res['task'].network_try_count == 1 and
-                res['task'].task_try_count == 1):
-            self.stat.inc('spider:task-%s-initial' % res['task'].name)
+        self.stat.inc('spider:task-%s' % res.task.name)
+        if (res.task.network_try_count == 1 and
+                res.task.task_try_count == 1):
+            self.stat.inc('spider:task-%s-initial' % res.task.name)
 
         # Update traffic statistics
-        if res['grab'] and res['grab'].response:
-            resp = res['grab'].response
+        if res.grab and res.grab.response:
+            resp = res.grab.response
             self.timer.inc_timer('network-name-lookup', resp.name_lookup_time)
             self.timer.inc_timer('network-connect', resp.connect_time)
             self.timer.inc_timer('network-total', resp.total_time)
@@ -796,6 +1243,87 @@ class Spider(DeprecatedThingsSpiderMixin):
                 self.stat.inc('spider:download-size', resp.download_size)
                 self.stat.inc('spider:upload-size', resp.upload_size)
 
+    def process_not_modified(self, res):
+        """
+        Check the result of the conditional request sent to revalidate
+        the cache item.
+
+        If the document has not been modified then the result is passed
+        to the cache pipeline which loads the document from the cache and
+        True is returned.
+        """
+
+        task = res.task
+        revalidation_headers = task.get('revalidation_headers')
+        if revalidation_headers is None:
+            return False
+        # Tasks and requests created from the task or its grab object
+        # by the handler should not be conditional
+        del task.revalidation_headers
+        # Config backup is used to repeat the failed request
+        for config in (res.grab.config, res.grab_config_backup):
+            if config is not None:
+                headers = dict(config['headers'])
+                for key in revalidation_headers:
+                    headers.pop(key, None)
+                config['headers'] = headers
+        if (self.cache_pipeline is None or not res.ok
+                or res.grab.response.code != 304):
+            return False
+        self.stat.inc('spider:request-not-modified')
+        self.stat.inc('spider:download-size', res.grab.response.download_size)
+        self.stat.inc('spider:upload-size', res.grab.response.upload_size)
+        if self.concurrency_controller:
+            self.update_concurrency_limits(res)
+        # Transport of the grab object has been released after the request
+        self.cache_pipeline.input_queue.put(('refresh',
+                                             (task, res.grab.clone())))
+        return True
+
+    def update_concurrency_limits(self, res):
+        """
+        Pass the network result to the concurrency controller and apply
+        new limits to the network transport and to the frontier.
+        """
+
+        controller = self.concurrency_controller
+        host = get_task_host(res.task)
+        latency = None
+        if res.ok and res.grab.response:
+            latency = res.grab.response.total_time
+        host_limit = 1
+        if controller.per_host:
+            host_limit = self.frontier.get_host_limit(host)
+        global_change, host_change = controller.register_result(
+            host, is_overload_result(res), latency, host_limit=host_limit)
+        if global_change:
+            self.transport.set_stream_limit(controller.limit)
+            self.stat.set('spider:concurrency-limit', controller.limit)
+            self.stat.inc('spider:concurrency-%s' % (
+                'increase' if global_change > 0 else 'decrease'))
+        if host_change:
+            self.frontier.set_host_limit(host,
+                                         controller.get_host_limit(host))
+            self.stat.inc('spider:host-concurrency-%s' % (
+                'increase' if host_change > 0 else 'decrease'))
+
+    def retry_network_request(self, res):
+        """
+        Put the task of failed network result back into the task queue.
+        """
+
+        task = res.task
+        task.refresh_cache = True
+        task.setup_grab_config(res.grab_config_backup)
+        # Do not delay the task which will be rejected due to
+        # network try limit
+        if (self.retry_policy is not None
+                and task.network_try_count < self.network_try_limit):
+            error_class = get_error_class(res)
+            delay = self.retry_policy.get_delay(res, error_class)
+            task.schedule_time = datetime.utcnow() + timedelta(seconds=delay)
+            self.stat.inc('spider:retry-delay-%s' % error_class)
+        self.add_task(task)
 
     def process_grab_proxy(self, task, grab):
         "Assign new proxy from proxylist to the task"
@@ -817,24 +1345,77 @@ class Spider(DeprecatedThingsSpiderMixin):
                    proxy_type=proxy.proxy_type)
         return proxy
 
+    def defer_task(self, task, grab, delay, buckets):
+        self.stat.inc('spider:rate-limit-delay')
+        heapq.heappush(self.deferred_tasks,
+                       (time.time() + delay, next(self.deferred_task_counter),
+                        task, grab, buckets))
+
+    def is_deferred_task_ready(self):
+        return (self.deferred_tasks
+                and self.deferred_tasks[0][0] <= time.time())
+
+    def submit_deferred_task(self):
+        # Rate limiter has reserved the token for the task when it was
+        # deferred, other buckets are charged now
+        ready_time, idx, task, grab, buckets = heapq.heappop(
+            self.deferred_tasks)
+        if buckets:
+            delay, buckets = self.rate_limiter.acquire(task, buckets=buckets)
+            if delay:
+                self.defer_task(task, grab, delay, buckets)
+                return
+        self.start_network_request(task, grab)
+
+    def return_task_to_queue(self, task, delay):
+        """
+        Put the task taken from the task queue back into the queue
+        as delayed task.
+        """
+
+        self.stat.inc('spider:rate-limit-backlog')
+        # The task will be counted again when it is taken from the queue
+        task.network_try_count -= 1
+        self.task_queue.put(
+            task, task.priority,
+            schedule_time=datetime.utcnow() + timedelta(seconds=delay))
+        self.release_task_host(task)
+        self.task_queue.ack(task)
+
     def submit_task_to_transport(self, task, grab):
         if self.only_cache:
             self.stat.inc('spider:request-network-disabled-only-cache')
+            self.release_task_host(task)
+            self.task_queue.ack(task)
         else:
-            grab_config_backup = grab.dump_config()
-            self.process_grab_proxy(task, grab)
-            self.stat.inc('spider:request-network')
-            self.stat.inc('spider:task-%s-network' % task.name)
-            with self.timer.log_time('network_transport'):
-                logger_verbose.debug('Submitting task to the transport '
-                                     'layer')
-                try:
-                    self.transport.start_task_processing(
-                        task, grab, grab_config_backup)
-                except GrabInvalidUrl:
-                    logger.debug('Task %s has invalid URL: %s' % (
-                        task.name, task.url))
-                    self.stat.collect('invalid-url', task.url)
+            if self.rate_limiter is not None:
+                backlog_delay = self.rate_limiter.get_backlog_delay(task)
+                if backlog_delay:
+                    self.return_task_to_queue(task, backlog_delay)
+                    return
+                delay, buckets = self.rate_limiter.acquire(task)
+                if delay:
+                    self.defer_task(task, grab, delay, buckets)
+                    return
+            self.start_network_request(task, grab)
+
+    def start_network_request(self, task, grab):
+        grab_config_backup = grab.dump_config()
+        self.process_grab_proxy(task, grab)
+        self.stat.inc('spider:request-network')
+        self.stat.inc('spider:task-%s-network' % task.name)
+        with self.timer.log_time('network_transport'):
+            logger_verbose.debug('Submitting task to the transport '
+                                 'layer')
+            try:
+                self.transport.start_task_processing(
+                    task, grab, grab_config_backup)
+            except GrabInvalidUrl:
+                logger.debug('Task %s has invalid URL: %s' % (
+                    task.name, task.url))
+                self.stat.collect('invalid-url', task.url)
+                self.release_task_host(task)
+                self.task_queue.ack(task)
 
     def start_api_thread(self):
         from grab.spider.http_api import HttpApiThread
@@ -845,26 +1426,56 @@ class Spider(DeprecatedThingsSpiderMixin):
 
     def is_ready_to_shutdown(self):
         # Things should be true to shutdown spider
-        # 1) No active task handlers (task_* functions)
-        # 2) All task generators has completed work
+        # 1) All task generators has completed work
+        # 2) Task queue and buffer of tasks taken from the queue are empty
         # 3) No active network threads
-        # 4) Task queue is empty
-        # 5) Network result queue is empty
-        # 6) Cache is disabled or is in idle mode
+        # 4) All network results sent to parsers have been processed
+        #    and results of their handlers have been received
+        # 5) Cache pipeline has processed all tasks and the main loop
+        #    has received all its results
+        # 6) No tasks delayed by the rate limiter
+        # 7) No tasks in the frontier buffer
+        # 8) In distributed mode: other workers have no work, tasks
+        #    they have taken from the shared queue are counted in (2)
+        #
+        # Only task generators, parsers and the cache pipeline work
+        # outside of the main loop. The generator puts tasks directly into
+        # the task queue so it must be checked before the queue. Other
+        # stages are tracked with counters which change only when the main
+        # loop sends something into the stage or receives the result.
         return (
-            not self.parser_result_queue.qsize()
-            and all(x['is_parser_idle'].is_set()
-                    for x in self.parser_pipeline.parser_pool)
-            and not any(x.isAlive() for x in self._task_generator_list) # (2)
-            and not self.transport.get_active_threads_number() # (3)
-            and not self.task_queue.size() # (4)
-            and not self.network_result_queue.qsize() # (5)
+            not self.task_generator_enabled  # (1)
+            and not self.task_queue.size()  # (2)
+            and not self.task_buffer  # (2)
+            and not self.transport.get_active_threads_number()  # (3)
+            and not self.parser_pending_results  # (4)
             and (self.cache_pipeline is None
                  or (self.cache_pipeline.is_idle()
-                     and self.cache_pipeline.input_queue.qsize() == 0
-                     and self.cache_pipeline.result_queue.qsize() == 0))
+                     and self.cache_pipeline.result_queue.qsize() == 0))  # (5)
+            and not self.deferred_tasks  # (6)
+            and (self.frontier is None or not self.frontier.size)  # (7)
+            and (self.coordinator is None
+                 or self.coordinator.is_cluster_idle(self.stat))  # (8)
         )
 
+    def fix_parser_pending_results(self):
+        """
+        Correct the number of results being processed by parsers
+        after some parser has died.
+
+        Result which was processed by died parser is lost. The counter
+        is reduced to the max. number of results which could be queued
+        or processed by alive parsers.
+        """
+
+        max_pending = (self.network_result_queue.qsize()
+                       + len(self.parser_pipeline.parser_pool)
+                       + self.parser_result_queue.qsize())
+        if self.parser_pending_results > max_pending:
+            logger.error('Lost %d network results due to died parsers'
+                         % (self.parser_pending_results - max_pending))
+            self.parser_pending_results = max_pending
+
     def run(self):
         """
         Main method. All work is done here.
@@ -875,14 +1486,26 @@ class Spider(DeprecatedThingsSpiderMixin):
             from multiprocessing.dummy import Process, Event, Queue
 
         self.timer.start('total')
-        self.transport = MulticurlTransport(self.thread_number)
+        self.transport = MulticurlTransport(self.thread_number,
+                                            event_loop=self.event_loop)
+        if self.event_loop:
+            self.loop_waker = self.transport.waker
+        if self.concurrency_controller:
+            self.transport.set_stream_limit(self.concurrency_controller.limit)
+            self.stat.set('spider:concurrency-limit',
+                          self.concurrency_controller.limit)
 
         if self.http_api_port:
             http_api_proc = self.start_api_thread()
         else:
             http_api_proc = None
 
+        if self.mp_mode and self.shared_body_min_size:
+            prepare_shared_body()
         self.parser_result_queue = Queue()
+        # Number of network results which were sent to parsers
+        # and have not been acknowledged yet
+        self.parser_pending_results = 0
         self.parser_pipeline = ParserPipeline(
             bot=self,
             mp_mode=self.mp_mode,
@@ -903,6 +1526,13 @@ class Spider(DeprecatedThingsSpiderMixin):
             if self.task_queue is None:
                 self.setup_queue()
 
+            if self.coordinator:
+                if not getattr(self.task_queue, 'lease_timeout', None):
+                    raise SpiderConfigurationError(
+                        'Distributed mode requires task queue which '
+                        'gives out tasks on lease')
+                self.coordinator.register(self.task_queue)
+
             # Initiate task generator. Only in main process!
             with self.timer.log_time('task_generator'):
                 self.start_task_generators()
@@ -912,6 +1542,8 @@ class Spider(DeprecatedThingsSpiderMixin):
             #shutdown_countdown = 0 # !!!
             pending_tasks = deque()
             while self.work_allowed:
+                # Tells if the main loop could wait in event loop mode
+                loop_has_work = False
                 free_threads = self.transport.get_free_threads_number()
                 # Load new task only if:
                 # 1) network transport has free threads
@@ -922,70 +1554,75 @@ class Spider(DeprecatedThingsSpiderMixin):
                              < network_result_queue_limit)
                         and (self.cache_pipeline is None
                              or self.cache_pipeline.has_free_resources())):
-                    if pending_tasks:
-                        task = pending_tasks.popleft()
+                    if self.is_deferred_task_ready():
+                        loop_has_work = True
+                        self.submit_deferred_task()
                     else:
-                        task = self.get_task_from_queue()
-                    if task is None:
-                        # If received task is None then
-                        # check if spider is ready to be shut down
-                        if not pending_tasks and self.is_ready_to_shutdown():
-                            # I am afraid there is a bug in `is_ready_to_shutdown`
-                            # because it tries to evaluate too many things
-                            # includig thigs that are being set from other threads,
-                            # so to ensure we are really ready to shutdown I call
-                            # is_ready_to_shutdown a few more times.
-                            # Without this hack some times really rarely times
-                            # the Grab fails to do its job
-                            # A good way to see this bug is to disable this hack
-                            # and run:
-                            # while ./runtest.py -t test.spider_data; do echo "ok"; done;
-                            # And wait a few minutes
-                            really_ready = True
-                            for x in range(10):
-                                if not self.is_ready_to_shutdown():
-                                    really_ready = False
-                                    break
-                                time.sleep(0.001)
-                            if really_ready:
+                        if pending_tasks:
+                            task = pending_tasks.popleft()
+                        else:
+                            task = self.get_task_from_queue()
+                        # If some task has been received then
+                        # maybe there are more tasks in the queue
+                        loop_has_work = (task is not None
+                                         and not isinstance(task, bool))
+                        if task is None:
+                            # If received task is None then
+                            # check if spider is ready to be shut down
+                            if (not pending_tasks
+                                    and self.is_ready_to_shutdown()):
                                 self.shutdown_event.set()
                                 self.stop()
-                                break # Break from `while self.work_allowed` cycle
-                    elif isinstance(task, bool) and (task is True):
-                        # If received task is True
-                        # and there is no active network threads then
-                        # take some sleep
-                        if not self.transport.get_active_threads_number():
-                            time.sleep(0.01)
-                    else:
-                        logger_verbose.debug('Got new task from task queue: %s'
-                                             % task)
-                        task.network_try_count += 1
-                        is_valid, reason = self.check_task_limits(task)
-                        if is_valid:
-                            task_grab = self.setup_grab_for_task(task)
-                            if self.cache_pipeline:
-                                self.cache_pipeline.input_queue.put(
-                                    ('load', (task, task_grab)),
-                                )
-                            else:
-                                self.submit_task_to_transport(task, task_grab)
+                                # Break from `while self.work_allowed` cycle
+                                break
+                        elif isinstance(task, bool) and (task is True):
+                            # If received task is True
+                            # and there is no active network threads then
+                            # take some sleep
+                            transport = self.transport
+                            if (not self.event_loop and
+                                    not transport.get_active_threads_number()):
+                                time.sleep(0.01)
                         else:
-                            self.log_rejected_task(task, reason)
-                            handler = task.get_fallback_handler(self)
-                            if handler:
-                                handler(task)
+                            logger_verbose.debug(
+                                'Got new task from task queue: %s' % task)
+                            if self.coordinator:
+                                self.coordinator.heartbeat(self.stat,
+                                                           busy=True)
+                            task.network_try_count += 1
+                            is_valid, reason = self.check_task_limits(task)
+                            if is_valid:
+                                task_grab = self.setup_grab_for_task(task)
+                                if self.cache_pipeline:
+                                    self.cache_pipeline.input_queue.put(
+                                        ('load', (task, task_grab)),
+                                    )
+                                else:
+                                    self.submit_task_to_transport(task,
+                                                                  task_grab)
+                            else:
+                                self.log_rejected_task(task, reason)
+                                self.release_task_host(task)
+                                handler = task.get_fallback_handler(self)
+                                if handler:
+                                    handler(task)
+                                self.task_queue.ack(task)
 
                 with self.timer.log_time('network_transport'):
                     logger_verbose.debug('Asking transport layer to do '
                                          'something')
-                    self.transport.process_handlers()
+                    if self.event_loop:
+                        self.transport.process_handlers(
+                            self.get_event_loop_timeout(loop_has_work,
+                                                        pending_tasks))
+                    else:
+                        self.transport.process_handlers()
 
                 logger_verbose.debug('Processing network results (if any).')
 
                 # Collect completed network results
                 # Each result could be valid or failed
-                # Result is dict {ok, grab, grab_config_backup, task, emsg}
+                # Result is NetworkResult instance
                 results = [(x, False) for x in
                            self.transport.iterate_results()]
                 if self.cache_pipeline:
@@ -1008,13 +1645,15 @@ class Spider(DeprecatedThingsSpiderMixin):
                                     self.submit_task_to_transport(task, task_grab)
                                 else:
                                     pending_tasks.append(task)
+                    self.cache_pipeline.flush_stat()
 
                 # Take sleep to avoid millions of iterations per second.
                 # 1) If no results from network transport
                 # 2) If task queue is empty (or if there are only delayed tasks)
                 # 3) If no network activity
                 # 4) If parser result queue is empty
-                if (not results
+                if (not self.event_loop
+                    and not results
                     and (task is None or bool(task) == True)
                     and not self.transport.get_active_threads_number()
                     and not self.parser_result_queue.qsize()
@@ -1025,30 +1664,39 @@ class Spider(DeprecatedThingsSpiderMixin):
                     ):
                         time.sleep(0.001)
 
+                if results and self.coordinator:
+                    self.coordinator.heartbeat(self.stat, busy=True)
                 for result, from_cache in results:
+                    if not from_cache and self.process_not_modified(result):
+                        # The task host is released when the cache
+                        # pipeline returns the refreshed document
+                        continue
+                    self.release_task_host(result.task)
                     if self.cache_pipeline and not from_cache:
-                        if result['ok']:
+                        if result.ok:
                             self.cache_pipeline.input_queue.put(
-                                ('save', (result['task'], result['grab']))
+                                ('save', (result.task, result.grab))
                             )
                     self.log_network_result_stats(
                         result, from_cache=from_cache)
-                    if self.stat.counters.get('spider:request-processed') - self.stat.counters_prev.get(
-                            'spider:request-processed',0) >= self.rps_limit > 0:
-                        time.sleep(1)
+                    if self.concurrency_controller and not from_cache:
+                        self.update_concurrency_limits(result)
                     if self.is_valid_network_result(result):
                         #print('!! PUT NETWORK RESULT INTO QUEUE (base.py)')
+                        if self.mp_mode and self.shared_body_min_size:
+                            result = export_result_body(
+                                result, self.shared_body_min_size)
                         self.network_result_queue.put(result)
+                        self.parser_pending_results += 1
                     else:
                         self.log_failed_network_result(result)
                         # Try to do network request one more time
                         if self.network_try_limit > 0:
-                            result['task'].refresh_cache = True
-                            result['task'].setup_grab_config(
-                                result['grab_config_backup'])
-                            self.add_task(result['task'])
+                            self.retry_network_request(result)
+                        self.task_queue.ack(result.task)
                     if from_cache:
-                        self.stat.inc('spider:task-%s-cache' % result['task'].name)
+                        self.stat.inc('spider:task-%s-cache'
+                                      % result.task.name)
                     self.stat.inc('spider:request')
 
                 while True:
@@ -1059,9 +1707,17 @@ class Spider(DeprecatedThingsSpiderMixin):
                     else:
                         self.stat.inc('spider:parser-result')
                         self.process_handler_result(p_res, p_task)
+                        if (isinstance(p_res, dict)
+                                and p_res.get('type') == 'batch'):
+                            # Parser has completed processing of the result.
+                            # Task is acknowledged after new tasks produced
+                            # by its handler have been put into the queue.
+                            self.parser_pending_results -= 1
+                            self.task_queue.ack(p_task)
 
                 if not self.shutdown_event.is_set():
-                    self.parser_pipeline.check_pool_health()
+                    if self.parser_pipeline.check_pool_health():
+                        self.fix_parser_pending_results()
 
             logger_verbose.debug('Work done')
         except KeyboardInterrupt:
@@ -1072,6 +1728,8 @@ class Spider(DeprecatedThingsSpiderMixin):
         finally:
             # This code is executed when main cycles is breaked
             self.timer.stop('total')
+            if self.cache_pipeline:
+                self.cache_pipeline.flush_stat()
             self.stat.print_progress_line()
             self.shutdown()
 
@@ -1080,20 +1738,60 @@ class Spider(DeprecatedThingsSpiderMixin):
                 http_api_proc.server.shutdown()
                 http_api_proc.join()
 
-            if self.task_queue:
-                self.task_queue.clear()
+            if self.coordinator:
+                # Shared queue is not cleared, tasks taken by this worker
+                # are given out again when their lease expires
+                self.task_queue.close()
+                self.coordinator.close(self.stat)
+            elif self.task_queue:
+                if self.task_queue.persistent:
+                    self.task_queue.close()
+                else:
+                    self.task_queue.clear()
+            self.task_buffer.clear()
+            if self.frontier:
+                self.frontier.clear()
+            if self.url_filter is not None:
+                self.url_filter.close()
 
             # Stop parser processes
             self.shutdown_event.set()
             self.parser_pipeline.shutdown()
+            self.loop_waker = None
+            self.transport.close()
             logger.debug('Main process [pid=%s]: work done' % os.getpid())
 
+    def get_event_loop_timeout(self, loop_has_work, pending_tasks):
+        """
+        Calculate how long the event loop could wait for network events.
+
+        Loop does not wait at all if there is something to process right now.
+        """
+
+        if (loop_has_work
+                or (pending_tasks
+                    and self.transport.get_free_threads_number())
+                or self.parser_result_queue.qsize()
+                or (self.cache_pipeline is not None
+                    and self.cache_pipeline.result_queue.qsize())):
+            return 0
+        timeout = EVENT_LOOP_MAX_WAIT
+        if (self.transport.get_free_threads_number()
+                and self.task_queue.size()):
+            # Task queue is not empty but it did not return a task
+            # It means all tasks in the queue are delayed
+            timeout = EVENT_LOOP_SCHEDULE_WAIT
+        if self.deferred_tasks:
+            timeout = min(timeout,
+                          max(0, self.deferred_tasks[0][0] - time.time()))
+        return timeout
+
     def log_failed_network_result(self, res):
         # Log the error
-        if res['ok']:
-            msg = 'http-%s' % res['grab'].response.code
+        if res.ok:
+            msg = 'http-%s' % res.grab.response.code
         else:
-            msg = res['error_abbr']
+            msg = res.error_abbr
 
         self.stat.inc('error:%s' % msg)
         #logger.error(u'Network error: %s' % msg)#%
@@ -1105,10 +1803,10 @@ class Spider(DeprecatedThingsSpiderMixin):
                              % (task.name, reason))
         if reason == 'task-try-count':
             self.stat.collect('task-count-rejected',
-                             task.url)
+                              task.url)
         elif reason == 'network-try-count':
             self.stat.collect('network-count-rejected',
-                             task.url)
+                              task.url)
         else:
             raise SpiderError('Unknown response from '
                               'check_task_limits: %s'
@@ -1121,7 +1819,9 @@ class Spider(DeprecatedThingsSpiderMixin):
         Result could be:
         * None
         * Task instance
-        * Data instance.
+        * Data instance
+        * Exception instance
+        * dict with batch of results and stat changes from parser process
         """
 
         if isinstance(result, Task):
@@ -1146,10 +1846,17 @@ class Spider(DeprecatedThingsSpiderMixin):
             handler_name = getattr(handler, '__name__', 'NONE')
             self.process_handler_error(handler_name, result, task)
         elif isinstance(result, dict):
-            if result.get('type') == 'stat':
-                for name, count in result['counters'].items():
+            if result.get('type') == 'batch':
+                tasks = []
+                for something in result['items']:
+                    if isinstance(something, Task):
+                        tasks.append(something)
+                    else:
+                        self.process_handler_result(something, task)
+                self.add_tasks(tasks)
+                for name, count in result.get('counters', {}).items():
                     self.stat.inc(name, count)
-                for name, items in result['collections'].items():
+                for name, items in result.get('collections', {}).items():
                     for item in items:
                         self.stat.collect(name, item)
             else:
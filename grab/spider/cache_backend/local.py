@@ -0,0 +1,273 @@
+"""
+Cache backend which works inside the spider process without any database
+server.
+
+Metadata of cached documents is stored in SQLite database keyed by
+the hash of URL. Bodies are stored in separate files named by the hash of
+the body (content addressing): same body received from many URLs is
+stored once. Body files are compressed with zlib if compression is enabled
+and they are read through mmap.
+
+The `database` option of `Spider.setup_cache` is the path to the cache
+directory.
+
+Cache pipeline workers use separate backend objects. Saving bodies and
+removing unused bodies is serialised with the lock shared by all backend
+objects of the same directory: otherwise one worker could remove the body
+file which other worker has just found existing and is going to refer to.
+
+CacheItem interface:
+'url': string,
+'response_url': string,
+'body': string,
+'head': string,
+'response_code': int,
+'cookies': None,
+'timestamp': int,
+"""
+from hashlib import sha1
+import logging
+import mmap
+import os
+import shutil
+import sqlite3
+import tempfile
+from threading import Lock
+import time
+import zlib
+from weblib.encoding import make_str
+
+from grab.response import Response
+from grab.cookie import CookieManager
+
+logger = logging.getLogger('grab.spider.cache_backend.local')
+# Path of cache directory -> lock of body files
+BODY_LOCKS = {}
+BODY_LOCKS_LOCK = Lock()
+
+
+def get_body_lock(path):
+    with BODY_LOCKS_LOCK:
+        return BODY_LOCKS.setdefault(os.path.realpath(path), Lock())
+
+
+class CacheBackend(object):
+    def __init__(self, database, use_compression=True, spider=None,
+                 **kwargs):
+        self.spider = spider
+        self.path = database
+        self.body_dir = os.path.join(self.path, 'bodies')
+        self.use_compression = use_compression
+        self.body_lock = get_body_lock(self.path)
+        if not os.path.exists(self.body_dir):
+            os.makedirs(self.body_dir)
+        self.conn = sqlite3.connect(os.path.join(self.path, 'cache.sqlite'),
+                                    check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode = WAL')
+        self.conn.execute('PRAGMA synchronous = NORMAL')
+        self.create_cache_table()
+
+    def create_cache_table(self):
+        self.conn.execute('''
+            CREATE TABLE IF NOT EXISTS cache (
+                id TEXT NOT NULL PRIMARY KEY,
+                timestamp INTEGER NOT NULL,
+                url TEXT NOT NULL,
+                response_url TEXT,
+                head BLOB NOT NULL,
+                response_code INTEGER NOT NULL,
+                body_hash TEXT NOT NULL
+            )
+        ''')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS body_hash_idx '
+                          'ON cache (body_hash)')
+        self.conn.commit()
+
+    def build_hash(self, url):
+        utf_url = make_str(url)
+        return sha1(utf_url).hexdigest()
+
+    def build_body_path(self, body_hash):
+        return os.path.join(self.body_dir, body_hash[:2], body_hash[2:])
+
+    def read_body(self, body_hash):
+        with open(self.build_body_path(body_hash), 'rb') as inp:
+            if not os.fstat(inp.fileno()).st_size:
+                return b''
+            data = mmap.mmap(inp.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                if self.use_compression:
+                    return zlib.decompress(data)
+                else:
+                    return data[:]
+            finally:
+                data.close()
+
+    def write_body(self, body):
+        """
+        Save the body file if it does not exist yet and return
+        the hash of the body.
+        """
+
+        body_hash = sha1(body).hexdigest()
+        path = self.build_body_path(body_hash)
+        if not os.path.exists(path):
+            path_dir = os.path.dirname(path)
+            if not os.path.exists(path_dir):
+                os.makedirs(path_dir)
+            if self.use_compression:
+                body = zlib.compress(body)
+            # The file is written under temporary name and renamed:
+            # the reader never sees partially written file
+            fd, tmp_path = tempfile.mkstemp(dir=path_dir)
+            with os.fdopen(fd, 'wb') as out:
+                out.write(body)
+            os.rename(tmp_path, path)
+        return body_hash
+
+    def remove_unused_body(self, body_hash):
+        row = self.conn.execute('SELECT 1 FROM cache WHERE body_hash = ? '
+                                'LIMIT 1', (body_hash,)).fetchone()
+        if row is None:
+            path = self.build_body_path(body_hash)
+            if os.path.exists(path):
+                os.remove(path)
+
+    def get_item(self, url, timeout=None):
+        """
+        Returned item should have specific interface. See module docstring.
+        """
+
+        _hash = self.build_hash(url)
+        with self.spider.timer.log_time('cache.read.local_query'):
+            if timeout is None:
+                query = ''
+                args = (_hash,)
+            else:
+                query = ' AND timestamp > ?'
+                args = (_hash, int(time.time()) - timeout)
+            row = self.conn.execute(
+                'SELECT url, response_url, head, response_code, body_hash, '
+                'timestamp FROM cache WHERE id = ?' + query, args).fetchone()
+        if row is None:
+            return None
+        with self.spider.timer.log_time('cache.read.local_body'):
+            try:
+                body = self.read_body(row[4])
+            except (IOError, OSError, zlib.error) as ex:
+                logger.error('Could not read body of cached document %s'
+                             % url, exc_info=ex)
+                return None
+        return {
+            'url': row[0],
+            'response_url': row[1],
+            'body': body,
+            'head': bytes(row[2]),
+            'response_code': row[3],
+            'cookies': None,
+            'timestamp': row[5],
+        }
+
+    def remove_cache_item(self, url):
+        _hash = self.build_hash(url)
+        with self.body_lock:
+            row = self.conn.execute('SELECT body_hash FROM cache '
+                                    'WHERE id = ?', (_hash,)).fetchone()
+            if row is not None:
+                self.conn.execute('DELETE FROM cache WHERE id = ?', (_hash,))
+                self.conn.commit()
+                self.remove_unused_body(row[0])
+
+    def touch_item(self, url):
+        """
+        Update the timestamp of the cache item without rewriting it.
+        """
+
+        self.conn.execute('UPDATE cache SET timestamp = ? WHERE id = ?',
+                          (int(time.time()), self.build_hash(url)))
+        self.conn.commit()
+
+    def load_response(self, grab, cache_item):
+        grab.setup_document(cache_item['body'])
+
+        body = cache_item['body']
+
+        def custom_prepare_response_func(transport, grab):
+            response = Response()
+            response.head = cache_item['head']
+            response.body = body
+            response.code = cache_item['response_code']
+            response.download_size = len(body)
+            response.upload_size = 0
+            response.download_speed = 0
+            response.url = cache_item['response_url']
+            response.parse(charset=grab.config['document_charset'])
+            response.cookies = CookieManager(transport.extract_cookiejar())
+            response.from_cache = True
+            return response
+
+        grab.process_request_result(custom_prepare_response_func)
+
+    def save_response(self, url, grab):
+        self.save_responses([(url, grab)])
+
+    def save_responses(self, items):
+        """
+        Save multiple documents in one transaction.
+
+        :param items: list of (url, grab) tuples
+        """
+
+        ts = int(time.time())
+        rows = {}
+        # Bodies which could be unused after the update
+        old_body_hashes = set()
+        with self.body_lock:
+            for url, grab in items:
+                _hash = self.build_hash(url)
+                body_hash = self.write_body(grab.response.body)
+                old_row = self.conn.execute(
+                    'SELECT body_hash FROM cache WHERE id = ?',
+                    (_hash,)).fetchone()
+                if old_row is not None:
+                    old_body_hashes.add(old_row[0])
+                if _hash in rows:
+                    old_body_hashes.add(rows[_hash][-1])
+                rows[_hash] = (_hash, ts, url, grab.response.url,
+                               sqlite3.Binary(grab.response.head),
+                               grab.response.code, body_hash)
+            self.conn.executemany(
+                'INSERT OR REPLACE INTO cache (id, timestamp, url, '
+                'response_url, head, response_code, body_hash) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                list(rows.values()))
+            self.conn.commit()
+            old_body_hashes.difference_update(x[-1] for x in rows.values())
+            for body_hash in old_body_hashes:
+                self.remove_unused_body(body_hash)
+
+    def clear(self):
+        with self.body_lock:
+            self.conn.execute('DELETE FROM cache')
+            self.conn.commit()
+            shutil.rmtree(self.body_dir)
+            os.makedirs(self.body_dir)
+
+    def has_item(self, url, timeout=None):
+        """
+        Test if required item exists in the cache.
+        """
+
+        _hash = self.build_hash(url)
+        if timeout is None:
+            query = ''
+            args = (_hash,)
+        else:
+            query = ' AND timestamp > ?'
+            args = (_hash, int(time.time()) - timeout)
+        row = self.conn.execute('SELECT 1 FROM cache WHERE id = ?' + query,
+                                args).fetchone()
+        return row is not None
+
+    def size(self):
+        return self.conn.execute('SELECT COUNT(*) FROM cache').fetchone()[0]
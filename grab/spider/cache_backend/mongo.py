@@ -1,4 +1,9 @@
 """
+Metadata of cached documents is stored in `cache` collection keyed by
+the hash of URL. Bodies are stored in `cache_body` collection keyed by
+the hash of the body (content addressing): same body received from many
+URLs is stored once. The body is removed when no document refers to it.
+
 CacheItem interface:
 '_id': string,
 'url': string,
@@ -7,22 +12,26 @@ CacheItem interface:
 'head': string,
 'response_code': int,
 'cookies': None,#grab.response.cookies,
+'timestamp': int,
 
 TODO: WTF with cookies???
 """
+from collections import Counter
 from hashlib import sha1
 import zlib
 import logging
 import pymongo
+from pymongo import ReplaceOne, UpdateOne
 from bson import Binary
 import time
-import six
 from weblib.encoding import make_str
 
 from grab.response import Response
 from grab.cookie import CookieManager
 
 logger = logging.getLogger('grab.spider.cache_backend.mongo')
+# The maximum BSON document size is 16 megabytes
+MAX_BODY_SIZE = 16 * 1024 * 1024 - 1024
 
 
 class CacheBackend(object):
@@ -42,7 +51,16 @@ class CacheBackend(object):
             query = {'_id': _hash, 'timestamp': {'$gt': ts}}
         else:
             query = {'_id': _hash}
-        return self.db.cache.find_one(query)
+        item = self.db.cache.find_one(query)
+        if item is not None and item.get('body_hash') is not None:
+            # Documents saved by previous version of the backend
+            # contain the body
+            body_item = self.db.cache_body.find_one(
+                {'_id': item['body_hash']}, {'body': 1})
+            if body_item is None or 'body' not in body_item:
+                return None
+            item['body'] = body_item['body']
+        return item
 
     def build_hash(self, url):
         utf_url = make_str(url)
@@ -50,7 +68,34 @@ class CacheBackend(object):
 
     def remove_cache_item(self, url):
         _hash = self.build_hash(url)
-        self.db.cache.remove({'_id': _hash})
+        item = self.db.cache.find_one_and_delete({'_id': _hash},
+                                                 {'body_hash': 1})
+        if item is not None and item.get('body_hash') is not None:
+            self.release_bodies(Counter([item['body_hash']]))
+
+    def release_bodies(self, refs):
+        """
+        Decrease reference counters of bodies and remove bodies which
+        are not used anymore.
+
+        :param refs: dict of body hash -> number of released references
+        """
+
+        if refs:
+            self.db.cache_body.bulk_write(
+                [UpdateOne({'_id': body_hash}, {'$inc': {'refcount': -count}})
+                 for body_hash, count in refs.items()], ordered=False)
+            self.db.cache_body.delete_many({'_id': {'$in': list(refs)},
+                                            'refcount': {'$lte': 0}})
+
+    def touch_item(self, url):
+        """
+        Update the timestamp of the cache item without rewriting it.
+        """
+
+        _hash = self.build_hash(url)
+        self.db.cache.update_one({'_id': _hash},
+                                 {'$set': {'timestamp': int(time.time())}})
 
     def load_response(self, grab, cache_item):
         grab.setup_document(cache_item['body'])
@@ -75,33 +120,79 @@ class CacheBackend(object):
 
         grab.process_request_result(custom_prepare_response_func)
 
-    def save_response(self, url, grab):
-        body = grab.response.body
-        if self.use_compression:
-            body = zlib.compress(body)
-
-        _hash = self.build_hash(url)
-        item = {
-            '_id': _hash,
+    def build_item(self, url, grab):
+        return {
+            '_id': self.build_hash(url),
             'timestamp': int(time.time()),
             'url': url,
             'response_url': grab.response.url,
-            'body': Binary(body),
+            'body_hash': sha1(grab.response.body).hexdigest(),
             'head': Binary(grab.response.head),
             'response_code': grab.response.code,
             'cookies': None,
         }
-        try:
-            self.db.cache.save(item, w=1)
-        except Exception as ex:
-            if 'document too large' in six.text_type(ex):
+
+    def save_items(self, items):
+        """
+        Save documents and their bodies.
+
+        :param items: list of (item, packed body) tuples
+
+        Body is sent to the database only if there is no such body in
+        the cache yet. Bodies are saved before documents which refer to
+        them, references of replaced documents are released after that.
+        """
+
+        new_refs = Counter(item['body_hash'] for item, body in items)
+        bodies = dict((item['body_hash'], body) for item, body in items)
+        stored = set(x['_id'] for x in self.db.cache_body.find(
+            {'_id': {'$in': list(new_refs)}, 'body': {'$exists': True}},
+            {'_id': 1}))
+        ops = []
+        for body_hash, count in new_refs.items():
+            update = {'$inc': {'refcount': count}}
+            if body_hash not in stored:
+                update['$set'] = {'body': Binary(bodies[body_hash])}
+            ops.append(UpdateOne({'_id': body_hash}, update, upsert=True))
+        self.db.cache_body.bulk_write(ops, ordered=False)
+
+        old_refs = Counter(
+            x['body_hash'] for x in self.db.cache.find(
+                {'_id': {'$in': [item['_id'] for item, body in items]},
+                 'body_hash': {'$ne': None}}, {'body_hash': 1}))
+        self.db.cache.bulk_write(
+            [ReplaceOne({'_id': item['_id']}, item, upsert=True)
+             for item, body in items], ordered=False)
+        self.release_bodies(old_refs)
+
+    def save_responses(self, items):
+        """
+        Save multiple documents with bulk requests.
+
+        :param items: list of (url, grab) tuples
+        """
+
+        # Only the last document of each URL is saved
+        unique_items = {}
+        for url, grab in items:
+            body = grab.response.body
+            if self.use_compression:
+                body = zlib.compress(body)
+            if len(body) > MAX_BODY_SIZE:
                 logging.error('Document too large. It was not saved into mongo'
                               ' cache. Url: %s' % url)
-            else:
-                raise
+                continue
+            item = self.build_item(url, grab)
+            unique_items[item['_id']] = (item, body)
+        if unique_items:
+            self.save_items(list(unique_items.values()))
+
+    def save_response(self, url, grab):
+        self.save_responses([(url, grab)])
 
     def clear(self):
         self.db.cache.remove()
+        self.db.cache_body.remove()
 
     def size(self):
         return self.db.cache.count()
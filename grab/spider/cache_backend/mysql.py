@@ -1,4 +1,9 @@
 """
+Metadata of cached documents is stored in `cache` table keyed by the hash
+of URL. Bodies are stored in `cache_body` table keyed by the hash of
+the body (content addressing): same body received from many URLs is stored
+once. The body row is removed when no document refers to it.
+
 CacheItem interface:
 '_id': string,
 'url': string,
@@ -7,14 +12,17 @@ CacheItem interface:
 'head': string,
 'response_code': int,
 'cookies': None,#grab.response.cookies,
+'timestamp': int,
 
 TODO: WTF with cookies???
 """
+from collections import Counter
 from hashlib import sha1
 import zlib
 import logging
 import MySQLdb
 import marshal
+import random
 import time
 from weblib.encoding import make_str
 
@@ -22,6 +30,15 @@ from grab.response import Response
 from grab.cookie import CookieManager
 
 logger = logging.getLogger('grab.spider.cache_backend.mysql')
+DEADLOCK_RETRY_LIMIT = 5
+# Max. delay in seconds before the transaction is run again
+DEADLOCK_RETRY_DELAY = 0.1
+ER_LOCK_DEADLOCK = 1213
+
+
+def is_deadlock(ex):
+    return (isinstance(ex, MySQLdb.OperationalError)
+            and ex.args and ex.args[0] == ER_LOCK_DEADLOCK)
 
 
 class CacheBackend(object):
@@ -35,13 +52,11 @@ class CacheBackend(object):
         self.connect()
         self.execute('SET TRANSACTION ISOLATION LEVEL READ COMMITTED')
         self.execute('show tables')
-        found = False
-        for row in self.cursor:
-            if row[0] == 'cache':
-                found = True
-                break
-        if not found:
+        tables = set(row[0] for row in self.cursor)
+        if 'cache' not in tables:
             self.create_cache_table(self.mysql_engine)
+        elif 'cache_body' not in tables:
+            self.upgrade_cache_table(self.mysql_engine)
 
     def connect(self):
         self.conn = MySQLdb.connect(**self.connection_config)
@@ -51,7 +66,11 @@ class CacheBackend(object):
     def execute(self, *args):
         try:
             self.cursor.execute(*args)
-        except (AttributeError, MySQLdb.OperationalError):
+        except (AttributeError, MySQLdb.OperationalError) as ex:
+            if is_deadlock(ex):
+                # Statement could not be repeated outside of
+                # the transaction
+                raise
             self.connect()
             self.cursor.execute(*args)
         return self.cursor
@@ -63,10 +82,33 @@ class CacheBackend(object):
                 id binary(20) not null,
                 timestamp int not null,
                 data mediumblob not null,
+                body_hash binary(20),
                 primary key (id),
                 index timestamp_idx(timestamp)
             ) engine = %s
         ''' % engine)
+        self.create_body_table(engine)
+        self.execute('commit')
+
+    def create_body_table(self, engine):
+        self.execute('''
+            create table if not exists cache_body (
+                hash binary(20) not null,
+                refcount int not null,
+                data mediumblob not null,
+                primary key (hash)
+            ) engine = %s
+        ''' % engine)
+
+    def upgrade_cache_table(self, engine):
+        """
+        Add body table to the cache created by previous version of
+        the backend. Old documents keep their bodies in `data` column.
+        """
+
+        self.execute('begin')
+        self.execute('alter table cache add column body_hash binary(20)')
+        self.create_body_table(engine)
         self.execute('commit')
 
     def get_item(self, url, timeout=None):
@@ -83,19 +125,33 @@ class CacheBackend(object):
                 ts = int(time.time()) - timeout
                 query = " AND timestamp > %d" % ts
             sql = '''
-                  SELECT data
+                  SELECT cache.data, cache_body.data, cache.timestamp
                   FROM cache
-                  WHERE id = x%%s %(query)s
+                  LEFT JOIN cache_body ON cache_body.hash = cache.body_hash
+                  WHERE cache.id = x%%s %(query)s
                   ''' % {'query': query}
             self.execute(sql, (_hash,))
             row = self.cursor.fetchone()
             self.execute('COMMIT')
         if row:
-            data = row[0]
-            return self.unpack_database_value(data)
+            item = self.unpack_item(row[0], row[1])
+            if item is not None:
+                item['timestamp'] = row[2]
+            return item
         else:
             return None
 
+    def unpack_item(self, data, body_data):
+        item = self.unpack_database_value(data)
+        if body_data is not None:
+            with self.spider.timer.log_time('cache.read.unpack_data'):
+                item['body'] = zlib.decompress(body_data)
+        elif 'body' not in item:
+            # The body has been lost. Documents saved by previous version
+            # of the backend keep the body in `data` column.
+            return None
+        return item
+
     def unpack_database_value(self, val):
         with self.spider.timer.log_time('cache.read.unpack_data'):
             dump = zlib.decompress(val)
@@ -106,13 +162,72 @@ class CacheBackend(object):
             utf_url = make_str(url)
             return sha1(utf_url).hexdigest()
 
+    def run_transaction(self, func, *args):
+        """
+        Call `func` in the transaction.
+
+        Concurrent transactions of cache workers could deadlock. The
+        transaction which has been rolled back is run again.
+        """
+
+        for attempt in range(DEADLOCK_RETRY_LIMIT):
+            self.execute('BEGIN')
+            try:
+                result = func(*args)
+            except Exception as ex:
+                self.execute('ROLLBACK')
+                if not is_deadlock(ex) or attempt + 1 == DEADLOCK_RETRY_LIMIT:
+                    raise
+                logger.debug('Cache transaction has been rolled back: %s'
+                             % ex)
+                time.sleep(random.random() * DEADLOCK_RETRY_DELAY)
+            else:
+                self.execute('COMMIT')
+                return result
+
     def remove_cache_item(self, url):
-        _hash = self.build_hash(url)
-        self.execute('begin')
+        self.run_transaction(self.delete_item, self.build_hash(url))
+
+    def delete_item(self, _hash):
+        self.execute('''
+            select lower(hex(body_hash)) from cache
+            where id = x%s and body_hash is not null for update
+        ''', (_hash,))
+        refs = Counter(row[0] for row in self.cursor.fetchall())
         self.execute('''
             delete from cache where id = x%s
         ''', (_hash,))
-        self.execute('commit')
+        self.release_bodies(refs)
+
+    def release_bodies(self, refs):
+        """
+        Decrease reference counters of bodies and remove bodies which
+        are not used anymore.
+
+        :param refs: dict of body hash -> number of released references
+        """
+
+        if refs:
+            self.cursor.executemany('''
+                UPDATE cache_body SET refcount = refcount - %s
+                WHERE hash = x%s
+            ''', [(count, body_hash)
+                  for body_hash, count in sorted(refs.items())])
+            self.execute('''
+                DELETE FROM cache_body WHERE hash IN (%s) AND refcount <= 0
+            ''' % ', '.join(['x%s'] * len(refs)), sorted(refs))
+
+    def touch_item(self, url):
+        """
+        Update the timestamp of the cache item without rewriting it.
+        """
+
+        _hash = self.build_hash(url)
+        self.execute('BEGIN')
+        self.execute('''
+            UPDATE cache SET timestamp = %s WHERE id = x%s
+        ''', (int(time.time()), _hash))
+        self.execute('COMMIT')
 
     def load_response(self, grab, cache_item):
         grab.setup_document(cache_item['body'])
@@ -135,31 +250,91 @@ class CacheBackend(object):
 
         grab.process_request_result(custom_prepare_response_func)
 
-    def save_response(self, url, grab):
-        body = grab.response.body
-
-        item = {
+    def build_item(self, url, grab):
+        return {
             'url': url,
             'response_url': grab.response.url,
-            'body': body,
+            'body': grab.response.body,
             'head': grab.response.head,
             'response_code': grab.response.code,
             'cookies': None,
         }
-        self.set_item(url, item)
 
-    def set_item(self, url, item):
-        _hash = self.build_hash(url)
-        data = self.pack_database_value(item)
-        self.execute('BEGIN')
+    def save_response(self, url, grab):
+        self.save_responses([(url, grab)])
+
+    def save_responses(self, items):
+        """
+        Save multiple documents with multi-row inserts in one transaction.
+
+        :param items: list of (url, grab) tuples
+
+        Body is sent to the database only if there is no such body
+        in the cache yet.
+        """
+
         ts = int(time.time())
-        sql = '''
-              INSERT INTO cache (id, timestamp, data)
-              VALUES(x%s, %s, %s)
-              ON DUPLICATE KEY UPDATE timestamp = %s, data = %s
-              '''
-        self.execute(sql, (_hash, ts, data, ts, data))
-        self.execute('COMMIT')
+        rows = {}
+        bodies = {}
+        for url, grab in items:
+            _hash = self.build_hash(url)
+            item = self.build_item(url, grab)
+            body = item.pop('body')
+            body_hash = sha1(body).hexdigest()
+            bodies[body_hash] = body
+            rows[_hash] = (_hash, ts, self.pack_database_value(item),
+                           body_hash)
+        self.run_transaction(self.write_items, rows, bodies)
+
+    def write_items(self, rows, bodies):
+        """
+        Save rows of `cache` table and bodies which they refer to.
+
+        Rows are locked in the order of their keys: concurrent
+        transactions which save same documents do not deadlock.
+        """
+
+        # Number of new references to each body
+        new_refs = Counter(x[3] for x in rows.values())
+        self.execute('''
+            SELECT LOWER(HEX(body_hash)) FROM cache
+            WHERE id IN (%s) AND body_hash IS NOT NULL
+            ORDER BY id FOR UPDATE
+        ''' % ', '.join(['x%s'] * len(rows)), sorted(rows))
+        old_refs = Counter(x[0] for x in self.cursor.fetchall())
+        # Stored bodies are locked till the end of the transaction:
+        # other workers could not remove them
+        body_hashes = sorted(set(new_refs) | set(old_refs))
+        self.execute('''
+            SELECT LOWER(HEX(hash)) FROM cache_body
+            WHERE hash IN (%s) ORDER BY hash FOR UPDATE
+        ''' % ', '.join(['x%s'] * len(body_hashes)), body_hashes)
+        stored = set(x[0] for x in self.cursor.fetchall())
+        args = []
+        for body_hash, count in sorted(new_refs.items()):
+            if body_hash in stored:
+                data = b''
+            else:
+                data = zlib.compress(bodies[body_hash])
+            args.extend((body_hash, count, data))
+        self.execute('''
+            INSERT INTO cache_body (hash, refcount, data)
+            VALUES %s
+            ON DUPLICATE KEY UPDATE refcount = refcount + VALUES(refcount)
+        ''' % ', '.join(['(x%s, %s, %s)'] * len(new_refs)), args)
+        args = []
+        for _hash in sorted(rows):
+            args.extend(rows[_hash])
+        self.execute('''
+            INSERT INTO cache (id, timestamp, data, body_hash)
+            VALUES %s
+            ON DUPLICATE KEY UPDATE timestamp = VALUES(timestamp),
+                                    data = VALUES(data),
+                                    body_hash = VALUES(body_hash)
+        ''' % ', '.join(['(x%s, %s, %s, x%s)'] * len(rows)), args)
+        # References are released after new references have been
+        # added: the body of the document saved again is not removed
+        self.release_bodies(old_refs)
 
     def pack_database_value(self, val):
         dump = marshal.dumps(val)
@@ -168,6 +343,7 @@ class CacheBackend(object):
     def clear(self):
         self.execute('BEGIN')
         self.execute('TRUNCATE cache')
+        self.execute('TRUNCATE cache_body')
         self.execute('COMMIT')
 
     def has_item(self, url, timeout=None):
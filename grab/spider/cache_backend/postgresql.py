@@ -1,4 +1,9 @@
 """
+Metadata of cached documents is stored in `cache` table keyed by the hash
+of URL. Bodies are stored in `cache_body` table keyed by the hash of
+the body (content addressing): same body received from many URLs is stored
+once. The body row is removed when no document refers to it.
+
 CacheItem interface:
 '_id': string,
 'url': string,
@@ -7,11 +12,14 @@ CacheItem interface:
 'head': string,
 'response_code': int,
 'cookies': None,#grab.response.cookies,
+'timestamp': int,
 """
+from collections import Counter
 from hashlib import sha1
 import zlib
 import logging
 import marshal
+import random
 import time
 from weblib.encoding import make_str
 
@@ -19,6 +27,9 @@ from grab.response import Response
 from grab.cookie import CookieManager
 
 logger = logging.getLogger('grab.spider.cache_backend.postgresql')
+DEADLOCK_RETRY_LIMIT = 5
+# Max. delay in seconds before the transaction is run again
+DEADLOCK_RETRY_DELAY = 0.1
 
 
 class CacheBackend(object):
@@ -39,13 +50,11 @@ class CacheBackend(object):
                 TABLE_TYPE = 'BASE TABLE'
             AND
                 table_schema NOT IN ('pg_catalog', 'information_schema')""")
-        found = False
-        for row in self.cursor:
-            if row[0] == 'cache':
-                found = True
-                break
-        if not found:
+        tables = set(row[0] for row in self.cursor)
+        if 'cache' not in tables:
             self.create_cache_table()
+        elif 'cache_body' not in tables:
+            self.upgrade_cache_table()
 
     def create_cache_table(self):
         self.cursor.execute('BEGIN')
@@ -53,10 +62,32 @@ class CacheBackend(object):
             CREATE TABLE cache (
                 id BYTEA NOT NULL CONSTRAINT primary_key PRIMARY KEY,
                 timestamp INT NOT NULL,
-                data BYTEA NOT NULL
+                data BYTEA NOT NULL,
+                body_hash BYTEA
             );
             CREATE INDEX timestamp_idx ON cache (timestamp);
         ''')
+        self.create_body_table()
+        self.cursor.execute('COMMIT')
+
+    def create_body_table(self):
+        self.cursor.execute('''
+            CREATE TABLE IF NOT EXISTS cache_body (
+                hash BYTEA NOT NULL PRIMARY KEY,
+                refcount INT NOT NULL,
+                data BYTEA NOT NULL
+            );
+        ''')
+
+    def upgrade_cache_table(self):
+        """
+        Add body table to the cache created by previous version of
+        the backend. Old documents keep their bodies in `data` column.
+        """
+
+        self.cursor.execute('BEGIN')
+        self.cursor.execute('ALTER TABLE cache ADD COLUMN body_hash BYTEA')
+        self.create_body_table()
         self.cursor.execute('COMMIT')
 
     def get_item(self, url, timeout=None):
@@ -73,19 +104,33 @@ class CacheBackend(object):
                 ts = int(time.time()) - timeout
                 query = " AND timestamp > %d" % ts
             sql = '''
-                  SELECT data
+                  SELECT cache.data, cache_body.data, cache.timestamp
                   FROM cache
-                  WHERE id = %%s %(query)s
+                  LEFT JOIN cache_body ON cache_body.hash = cache.body_hash
+                  WHERE cache.id = %%s %(query)s
                   ''' % {'query': query}
             self.cursor.execute(sql, (_hash,))
             row = self.cursor.fetchone()
             self.cursor.execute('COMMIT')
         if row:
-            data = row[0]
-            return self.unpack_database_value(data)
+            item = self.unpack_item(row[0], row[1])
+            if item is not None:
+                item['timestamp'] = row[2]
+            return item
         else:
             return None
 
+    def unpack_item(self, data, body_data):
+        item = self.unpack_database_value(data)
+        if body_data is not None:
+            with self.spider.timer.log_time('cache.read.unpack_data'):
+                item['body'] = zlib.decompress(body_data)
+        elif 'body' not in item:
+            # The body has been lost. Documents saved by previous version
+            # of the backend keep the body in `data` column.
+            return None
+        return item
+
     def unpack_database_value(self, val):
         with self.spider.timer.log_time('cache.read.unpack_data'):
             dump = zlib.decompress(val)
@@ -96,13 +141,73 @@ class CacheBackend(object):
             utf_url = make_str(url)
             return sha1(utf_url).hexdigest()
 
+    def run_transaction(self, func, *args):
+        """
+        Call `func` in the transaction.
+
+        Concurrent transactions of cache workers could deadlock. The
+        transaction which has been rolled back is run again.
+        """
+
+        from psycopg2.extensions import TransactionRollbackError
+
+        for attempt in range(DEADLOCK_RETRY_LIMIT):
+            self.cursor.execute('BEGIN')
+            try:
+                result = func(*args)
+            except TransactionRollbackError as ex:
+                self.cursor.execute('ROLLBACK')
+                if attempt + 1 == DEADLOCK_RETRY_LIMIT:
+                    raise
+                logger.debug('Cache transaction has been rolled back: %s'
+                             % ex)
+                time.sleep(random.random() * DEADLOCK_RETRY_DELAY)
+            except Exception:
+                self.cursor.execute('ROLLBACK')
+                raise
+            else:
+                self.cursor.execute('COMMIT')
+                return result
+
     def remove_cache_item(self, url):
-        _hash = self.build_hash(url)
-        self.cursor.execute('begin')
+        self.run_transaction(self.delete_item, self.build_hash(url))
+
+    def delete_item(self, _hash):
         self.cursor.execute('''
-            DELETE FROM cache WHERE id = %s
+            DELETE FROM cache WHERE id = %s RETURNING body_hash
         ''', (_hash,))
-        self.cursor.execute('commit')
+        self.release_bodies(Counter(
+            bytes(row[0]).decode('ascii')
+            for row in self.cursor.fetchall() if row[0] is not None))
+
+    def release_bodies(self, refs):
+        """
+        Decrease reference counters of bodies and remove bodies which
+        are not used anymore.
+
+        :param refs: dict of body hash -> number of released references
+        """
+
+        if refs:
+            self.cursor.executemany('''
+                UPDATE cache_body SET refcount = refcount - %s WHERE hash = %s
+            ''', [(count, body_hash)
+                  for body_hash, count in sorted(refs.items())])
+            self.cursor.execute('''
+                DELETE FROM cache_body WHERE hash IN %s AND refcount <= 0
+            ''', (tuple(sorted(refs)),))
+
+    def touch_item(self, url):
+        """
+        Update the timestamp of the cache item without rewriting it.
+        """
+
+        _hash = self.build_hash(url)
+        self.cursor.execute('BEGIN')
+        self.cursor.execute('''
+            UPDATE cache SET timestamp = %s WHERE id = %s
+        ''', (int(time.time()), _hash))
+        self.cursor.execute('COMMIT')
 
     def load_response(self, grab, cache_item):
         grab.setup_document(cache_item['body'])
@@ -125,35 +230,94 @@ class CacheBackend(object):
 
         grab.process_request_result(custom_prepare_response_func)
 
-    def save_response(self, url, grab):
-        body = grab.response.body
-
-        item = {
+    def build_item(self, url, grab):
+        return {
             'url': url,
             'response_url': grab.response.url,
-            'body': body,
+            'body': grab.response.body,
             'head': grab.response.head,
             'response_code': grab.response.code,
             'cookies': None,
         }
-        self.set_item(url, item)
 
-    def set_item(self, url, item):
+    def save_response(self, url, grab):
+        self.save_responses([(url, grab)])
+
+    def save_responses(self, items):
+        """
+        Save multiple documents in one transaction.
+
+        :param items: list of (url, grab) tuples
+
+        Body is sent to the database only if there is no such body
+        in the cache yet.
+        """
+
         import psycopg2
 
-        _hash = self.build_hash(url)
-        data = self.pack_database_value(item)
-        self.cursor.execute('BEGIN')
         ts = int(time.time())
-        sql = '''
-              UPDATE cache SET timestamp = %s, data = %s WHERE id = %s;
-              INSERT INTO cache (id, timestamp, data)
-              SELECT %s, %s, %s WHERE NOT EXISTS
-                (SELECT 1 FROM cache WHERE id = %s);
-              '''
-        self.cursor.execute(sql, (ts, psycopg2.Binary(data), _hash,
-                            _hash, ts, psycopg2.Binary(data), _hash))
-        self.cursor.execute('COMMIT')
+        # One query could not update same row twice
+        rows = {}
+        bodies = {}
+        for url, grab in items:
+            _hash = self.build_hash(url)
+            item = self.build_item(url, grab)
+            body = item.pop('body')
+            body_hash = sha1(body).hexdigest()
+            bodies[body_hash] = body
+            rows[_hash] = (_hash, ts,
+                           psycopg2.Binary(self.pack_database_value(item)),
+                           body_hash)
+        self.run_transaction(self.write_items, rows, bodies)
+
+    def write_items(self, rows, bodies):
+        """
+        Save rows of `cache` table and bodies which they refer to.
+
+        Rows are locked in the order of their keys: concurrent
+        transactions which save same documents do not deadlock.
+        """
+
+        import psycopg2
+        from psycopg2.extras import execute_values
+
+        # Number of new references to each body
+        new_refs = Counter(x[3] for x in rows.values())
+        self.cursor.execute('''
+            SELECT body_hash FROM cache
+            WHERE id IN %s AND body_hash IS NOT NULL ORDER BY id FOR UPDATE
+        ''', (tuple(sorted(rows)),))
+        old_refs = Counter(bytes(x[0]).decode('ascii')
+                           for x in self.cursor.fetchall())
+        # Stored bodies are locked till the end of the transaction:
+        # other workers could not remove them
+        self.cursor.execute('''
+            SELECT hash FROM cache_body
+            WHERE hash IN %s ORDER BY hash FOR UPDATE
+        ''', (tuple(sorted(set(new_refs) | set(old_refs))),))
+        stored = set(bytes(x[0]).decode('ascii')
+                     for x in self.cursor.fetchall())
+        body_rows = []
+        for body_hash, count in sorted(new_refs.items()):
+            if body_hash in stored:
+                data = b''
+            else:
+                data = zlib.compress(bodies[body_hash])
+            body_rows.append((body_hash, count, psycopg2.Binary(data)))
+        execute_values(self.cursor, '''
+            INSERT INTO cache_body (hash, refcount, data) VALUES %s
+            ON CONFLICT (hash) DO UPDATE
+            SET refcount = cache_body.refcount + EXCLUDED.refcount
+        ''', body_rows)
+        execute_values(self.cursor, '''
+            INSERT INTO cache (id, timestamp, data, body_hash) VALUES %s
+            ON CONFLICT (id) DO UPDATE
+            SET timestamp = EXCLUDED.timestamp, data = EXCLUDED.data,
+                body_hash = EXCLUDED.body_hash
+        ''', [rows[x] for x in sorted(rows)])
+        # References are released after new references have been
+        # added: the body of the document saved again is not removed
+        self.release_bodies(old_refs)
 
     def pack_database_value(self, val):
         dump = marshal.dumps(val)
@@ -161,7 +325,7 @@ class CacheBackend(object):
 
     def clear(self):
         self.cursor.execute('BEGIN')
-        self.cursor.execute('TRUNCATE cache')
+        self.cursor.execute('TRUNCATE cache, cache_body')
         self.cursor.execute('COMMIT')
 
     def has_item(self, url, timeout=None):
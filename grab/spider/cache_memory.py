@@ -0,0 +1,231 @@
+"""
+In-memory tier of the spider cache.
+
+`MemoryCache` keeps cache items (as they are returned by `get_item` method
+of the cache backend, i.e. already unpacked) in LRU order. The total size
+of bodies and heads of items is limited by `max_size` bytes.
+
+`TwoTierCacheBackend` wraps the cache backend: `get_item` looks into
+the memory first and goes to the database only on miss. One `MemoryCache`
+is shared by backends of all cache pipeline workers. The item is removed
+from memory both before and after it is written to the database, and the
+item loaded by other worker while it was written is not put into memory,
+so the memory tier never keeps the outdated document.
+
+The memory tier does not know when the document has been saved if the
+backend does not return the timestamp with the item. For such items it
+remembers the lower bound of that time: the item loaded with
+`timeout=N` has been saved not earlier than N seconds before it has been
+loaded. The item is served from memory only if that bound satisfies
+the timeout of the request.
+"""
+from collections import OrderedDict, defaultdict
+from threading import Lock
+import time
+
+DEFAULT_MEMORY_CACHE_SIZE = 100 * 1024 * 1024
+# Approximate size of the item without body and head
+ITEM_OVERHEAD = 500
+
+
+def get_item_size(item):
+    return (len(item.get('body') or b'') + len(item.get('head') or b'')
+            + ITEM_OVERHEAD)
+
+
+class MemoryCache(object):
+    def __init__(self, max_size=DEFAULT_MEMORY_CACHE_SIZE):
+        """
+        :param max_size: max. total size of cached items in bytes
+        """
+
+        self.max_size = max_size
+        self.size = 0
+        # url -> (item, min_timestamp, size)
+        self.items = OrderedDict()
+        # url -> number of loads from the database in progress
+        self.loading = {}
+        # Urls which have been invalidated while they were loaded
+        self.stale = set()
+        # Cache pipeline workers use the memory cache concurrently
+        self.lock = Lock()
+
+    def get(self, url, timeout=None):
+        """
+        Return the item or None if the item is not in memory or it could
+        be older than `timeout` seconds.
+        """
+
+        with self.lock:
+            record = self.items.pop(url, None)
+            if record is None:
+                return None
+            # Move the item to the end of LRU order
+            self.items[url] = record
+        if timeout is not None and record[1] <= time.time() - timeout:
+            return None
+        return record[0]
+
+    def put(self, url, item, min_timestamp):
+        with self.lock:
+            self.put_item(url, item, min_timestamp)
+
+    def put_item(self, url, item, min_timestamp):
+        size = get_item_size(item)
+        if size > self.max_size:
+            return
+        old_record = self.items.pop(url, None)
+        if old_record is not None:
+            self.size -= old_record[2]
+        self.items[url] = (item, min_timestamp, size)
+        self.size += size
+        while self.size > self.max_size:
+            self.size -= self.items.popitem(last=False)[1][2]
+
+    def begin_load(self, url):
+        """
+        Register the load of the item from the database.
+        """
+
+        with self.lock:
+            self.loading[url] = self.loading.get(url, 0) + 1
+
+    def end_load(self, url, item, min_timestamp):
+        """
+        Put the item loaded from the database into memory unless the item
+        has been invalidated after the load was started.
+        """
+
+        with self.lock:
+            count = self.loading.pop(url) - 1
+            is_stale = url in self.stale
+            if count:
+                self.loading[url] = count
+            else:
+                self.stale.discard(url)
+            if item is not None and not is_stale:
+                self.put_item(url, item, min_timestamp)
+
+    def touch(self, url, timestamp):
+        with self.lock:
+            record = self.items.get(url)
+            if record is not None:
+                item = record[0]
+                if item.get('timestamp') is not None:
+                    item = dict(item, timestamp=timestamp)
+                self.items[url] = (item, timestamp, record[2])
+
+    def remove(self, url):
+        with self.lock:
+            record = self.items.pop(url, None)
+            if record is not None:
+                self.size -= record[2]
+            if url in self.loading:
+                self.stale.add(url)
+
+    def clear(self):
+        with self.lock:
+            self.items.clear()
+            self.size = 0
+            self.stale.update(self.loading)
+
+
+class TwoTierCacheBackend(object):
+    def __init__(self, backend, memory_cache, stat):
+        self.backend = backend
+        self.memory_cache = memory_cache
+        self.stat = stat
+        # Stat is not thread-safe: counters are collected here and
+        # the spider thread moves them into the stat
+        self.counters = defaultdict(int)
+        self.counters_lock = Lock()
+
+    def __getattr__(self, key):
+        # Backend-specific attributes and methods
+        if key == 'backend':
+            raise AttributeError(key)
+        return getattr(self.backend, key)
+
+    def inc_counter(self, key):
+        with self.counters_lock:
+            self.counters[key] += 1
+
+    def flush_stat(self):
+        """
+        Add collected counters to the spider stat. The method must be
+        called from the spider thread.
+        """
+
+        with self.counters_lock:
+            counters = self.counters
+            self.counters = defaultdict(int)
+        for key, count in counters.items():
+            self.stat.inc(key, count)
+
+    def get_item(self, url, timeout=None):
+        item = self.memory_cache.get(url, timeout=timeout)
+        if item is not None:
+            self.inc_counter('spider:cache-memory-hit')
+            return item
+        self.inc_counter('spider:cache-memory-miss')
+        now = time.time()
+        min_timestamp = None
+        self.memory_cache.begin_load(url)
+        try:
+            item = self.backend.get_item(url, timeout=timeout)
+            if item is not None:
+                if item.get('timestamp') is not None:
+                    min_timestamp = item['timestamp']
+                elif timeout is not None:
+                    min_timestamp = now - timeout
+                else:
+                    min_timestamp = float('-inf')
+        finally:
+            self.memory_cache.end_load(url, item, min_timestamp)
+        if item is None:
+            self.inc_counter('spider:cache-db-miss')
+        else:
+            self.inc_counter('spider:cache-db-hit')
+        return item
+
+    def has_item(self, url, timeout=None):
+        if self.memory_cache.get(url, timeout=timeout) is not None:
+            return True
+        return self.backend.has_item(url, timeout=timeout)
+
+    def load_response(self, grab, cache_item):
+        self.backend.load_response(grab, cache_item)
+
+    def save_response(self, url, grab):
+        self.memory_cache.remove(url)
+        try:
+            self.backend.save_response(url, grab)
+        finally:
+            self.memory_cache.remove(url)
+
+    def save_responses(self, items):
+        for url, grab in items:
+            self.memory_cache.remove(url)
+        try:
+            self.backend.save_responses(items)
+        finally:
+            for url, grab in items:
+                self.memory_cache.remove(url)
+
+    def touch_item(self, url):
+        self.backend.touch_item(url)
+        self.memory_cache.touch(url, int(time.time()))
+
+    def remove_cache_item(self, url):
+        self.memory_cache.remove(url)
+        try:
+            self.backend.remove_cache_item(url)
+        finally:
+            self.memory_cache.remove(url)
+
+    def clear(self):
+        self.memory_cache.clear()
+        self.backend.clear()
+
+    def size(self):
+        return self.backend.size()
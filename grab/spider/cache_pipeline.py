@@ -1,55 +1,201 @@
-from threading import Event, Thread
-from six.moves.queue import Queue, Empty
+"""
+Cache pipeline loads documents from the cache and saves network results
+into the cache outside of the main loop.
+
+The pipeline runs `worker_number` threads, each thread works with its own
+cache backend object (its own database connection). Threads block on the
+input queue and wake up as soon as the main loop puts something into it.
+After the thread has got an item it takes all items which are already in
+the queue (up to `write_batch_size`): load requests are processed at once,
+documents to save are written with one `save_responses` call.
+
+If the cache item is older than `cache_timeout` of the task then
+the validators (ETag and Last-Modified headers) of the expired item are
+attached to the task and the spider sends the conditional request.
+If the server answers "304 Not Modified" then the main loop passes
+the result back to the pipeline: the cached document is loaded and only its
+timestamp is updated in the cache.
+"""
+import logging
+from threading import Thread
 import time
+from six.moves.queue import Queue, Empty
+
+from grab.spider.cache_memory import TwoTierCacheBackend
+from grab.spider.network_result import NetworkResult
+
+logger = logging.getLogger('grab.spider.cache_pipeline')
+
+DEFAULT_CACHE_QUEUE_SIZE = 100
+DEFAULT_CACHE_WRITE_BATCH_SIZE = 100
+# Response header -> header of the conditional request
+VALIDATOR_HEADERS = (
+    ('etag', 'If-None-Match'),
+    ('last-modified', 'If-Modified-Since'),
+)
+
+
+def build_revalidation_headers(head):
+    """
+    Return dict of headers of the conditional request built from
+    validators found in the raw head of the cached response.
+
+    If the head contains headers of many responses (redirects) then
+    headers of the last response are used.
+    """
+
+    if isinstance(head, bytes):
+        head = head.decode('latin-1')
+    validators = {}
+    for line in head.splitlines():
+        if line.startswith('HTTP/'):
+            validators = {}
+        elif ':' in line:
+            name, value = line.split(':', 1)
+            name = name.strip().lower()
+            value = value.strip()
+            if value:
+                validators[name] = value
+    headers = {}
+    for name, request_name in VALIDATOR_HEADERS:
+        if name in validators:
+            headers[request_name] = validators[name]
+    return headers
 
 
 class CachePipeline(object):
-    def __init__(self, spider, cache):
+    def __init__(self, spider, cache, worker_number=1,
+                 queue_size=DEFAULT_CACHE_QUEUE_SIZE,
+                 write_batch_size=DEFAULT_CACHE_WRITE_BATCH_SIZE,
+                 revalidate=True):
+        """
+        :param cache: cache backend object or the list of backend objects,
+            one object for each worker
+        :param worker_number: number of worker threads
+        :param queue_size: max. number of items waiting in input and
+            result queues of the pipeline
+        :param write_batch_size: max. number of documents saved with one
+            request to the cache backend
+        :param revalidate: if True then expired cache items are revalidated
+            with conditional requests
+        """
+
         self.spider = spider
-        self.cache = cache
-        self.idle_event = Event()
-        self.queue_size = 100
+        if isinstance(cache, (list, tuple)):
+            self.caches = list(cache)
+        else:
+            self.caches = [cache] * worker_number
+        # Backend of the first worker, it is used to work with the cache
+        # outside of the pipeline
+        self.cache = self.caches[0]
+        self.queue_size = queue_size
+        self.write_batch_size = write_batch_size
+        self.revalidate = revalidate
         self.input_queue = Queue()
         self.result_queue = Queue()
 
-        self.thread = Thread(target=self.thread_worker)
-        self.thread.daemon = True
-        self.thread.start()
+        self.threads = []
+        for cache in self.caches:
+            thread = Thread(target=self.thread_worker, args=[cache])
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
 
     def has_free_resources(self):
         return (self.input_queue.qsize() < self.queue_size
                 and self.result_queue.qsize() < self.queue_size)
 
     def is_idle(self):
-        return self.idle_event.is_set()
+        # Number of input items which have not been completely processed,
+        # the result of the item is put into `result_queue` before
+        # the item is marked as processed.
+        return not self.input_queue.unfinished_tasks
 
-    def thread_worker(self):
-        self.idle_event.clear()
-        while True:
+    def flush_stat(self):
+        """
+        Move counters collected by cache backends of workers into
+        the spider stat. The method is called from the spider thread.
+        """
+
+        for cache in self.caches:
+            if isinstance(cache, TwoTierCacheBackend):
+                cache.flush_stat()
+
+    def get_input_batch(self):
+        """
+        Wait for the input item and return it with all items which are
+        already in the input queue.
+        """
+
+        items = [self.input_queue.get()]
+        while len(items) < self.write_batch_size:
             try:
-                action, data = self.input_queue.get(block=False)
+                items.append(self.input_queue.get_nowait())
             except Empty:
-                self.idle_event.set()
-                time.sleep(0.1)
-                self.idle_event.clear()
-            else:
-                assert action in ('load', 'save')
-                if action == 'load':
+                break
+        return items
+
+    def thread_worker(self, cache):
+        while True:
+            items = self.get_input_batch()
+            save_items = []
+            for action, data in items:
+                assert action in ('load', 'save', 'refresh')
+                is_delayed = False
+                try:
+                    is_delayed = self.process_item(cache, action, data,
+                                                   save_items)
+                except Exception as ex:
                     task, grab = data
-                    result = None
-                    if self.is_cache_loading_allowed(task, grab):
-                        result = self.load_from_cache(task, grab)
-                    if result:
-                        #print('!! PUT RESULT INTO CACHE PIPE RESULT QUEUE (cache)')
-                        self.result_queue.put(('network_result', result))
-                    else:
+                    logger.error('Could not process %s action of the cache '
+                                 'pipeline for %s' % (action, task.url),
+                                 exc_info=ex)
+                    if action != 'save':
+                        # The task goes to the network
                         self.result_queue.put(('task', task))
-                elif action == 'save':
-                    task, grab = data
-                    if self.is_cache_saving_allowed(task, grab):
-                        with self.spider.timer.log_time('cache'):
-                            with self.spider.timer.log_time('cache.write'):
-                                self.cache.save_response(task.url, grab)
+                finally:
+                    # Documents to save are marked as processed
+                    # when the whole batch has been saved
+                    if not is_delayed:
+                        self.input_queue.task_done()
+            if save_items:
+                try:
+                    with self.spider.timer.log_time('cache'):
+                        with self.spider.timer.log_time('cache.write'):
+                            self.save_to_cache(cache, save_items)
+                finally:
+                    for x in save_items:
+                        self.input_queue.task_done()
+            # Main loop could wait for results or for free resources
+            # of the cache pipeline
+            self.spider.wakeup_main_loop()
+
+    def process_item(self, cache, action, data, save_items):
+        """
+        Process the input item. Return True if the document has been
+        added to `save_items` list to be saved later.
+        """
+
+        task, grab = data
+        if action == 'load':
+            result = None
+            if self.is_cache_loading_allowed(task, grab):
+                result = self.load_from_cache(cache, task, grab)
+            if result:
+                self.result_queue.put(('network_result', result))
+            else:
+                self.result_queue.put(('task', task))
+        elif action == 'refresh':
+            result = self.refresh_from_cache(cache, task, grab)
+            if result:
+                self.result_queue.put(('network_result', result))
+            else:
+                self.result_queue.put(('task', task))
+        elif action == 'save':
+            if self.is_cache_saving_allowed(task, grab):
+                save_items.append((task.url, grab))
+                return True
+        return False
 
     def is_cache_loading_allowed(self, task, grab):
         # 1) cache data should be refreshed
@@ -64,33 +210,104 @@ class CachePipeline(object):
         Check if network transport result could
         be saved to cache layer.
 
-        res: {ok, grab, grab_config_backup, task, emsg}
+        res: NetworkResult
         """
 
-        if grab.request_method == 'GET':
+        # "304 Not Modified" response has no document
+        if grab.request_method == 'GET' and grab.response.code != 304:
             if not task.get('disable_cache'):
                 if self.spider.is_valid_network_response_code(
                         grab.response.code, task):
                     return True
         return False
 
+    def save_to_cache(self, cache, items):
+        # Only the last document of each URL is saved
+        urls = set()
+        unique_items = []
+        for url, grab in reversed(items):
+            if url not in urls:
+                urls.add(url)
+                unique_items.append((url, grab))
+        unique_items.reverse()
+        try:
+            cache.save_responses(unique_items)
+        except Exception as ex:
+            logger.error('Could not save %d documents to the cache'
+                         % len(unique_items), exc_info=ex)
 
-    def load_from_cache(self, task, grab):
+    def load_from_cache(self, cache, task, grab):
+        url = grab.config['url']
         with self.spider.timer.log_time('cache'):
             with self.spider.timer.log_time('cache.read'):
-                cache_item = self.cache.get_item(
-                    grab.config['url'], timeout=task.cache_timeout)
+                if (self.revalidate and task.cache_timeout is not None
+                        and task.get('revalidation_headers') is None):
+                    # Expired item is needed to revalidate it: the item
+                    # is loaded without timeout and checked here
+                    cache_item = cache.get_item(url)
+                    if (cache_item is not None and not self.is_fresh(
+                            cache, url, cache_item, task.cache_timeout)):
+                        self.setup_revalidation(task, cache_item)
+                        cache_item = None
+                else:
+                    cache_item = cache.get_item(url,
+                                                timeout=task.cache_timeout)
                 if cache_item is None:
                     return None
                 else:
                     with self.spider.timer.log_time('cache.read.prepare_request'):
                         grab.prepare_request()
                     with self.spider.timer.log_time('cache.read.load_response'):
-                        self.cache.load_response(grab, cache_item)
+                        cache.load_response(grab, cache_item)
 
                     grab.log_request('CACHED')
                     self.spider.stat.inc('spider:request-cache')
 
-                    return {'ok': True, 'task': task, 'grab': grab,
-                            'grab_config_backup': grab.dump_config(),
-                            'emsg': None}
+                    return NetworkResult(True, task, grab,
+                                         grab.dump_config())
+
+    def is_fresh(self, cache, url, cache_item, timeout):
+        if cache_item.get('timestamp') is None:
+            # Backend does not return the timestamp of the item
+            return cache.has_item(url, timeout=timeout)
+        return cache_item['timestamp'] > int(time.time()) - timeout
+
+    def setup_revalidation(self, task, cache_item):
+        """
+        Attach headers of the conditional request to the task if the
+        expired cache item has validators.
+        """
+
+        headers = build_revalidation_headers(cache_item['head'])
+        if headers:
+            task.revalidation_headers = headers
+            self.spider.stat.inc('spider:cache-revalidate')
+
+    def refresh_from_cache(self, cache, task, grab):
+        """
+        Process the "304 Not Modified" response: load the document from
+        the cache and update the timestamp of the cache item.
+        """
+
+        url = grab.config['url']
+        with self.spider.timer.log_time('cache'):
+            with self.spider.timer.log_time('cache.read'):
+                cache_item = cache.get_item(url)
+            if cache_item is None:
+                # The item has been removed after the request was sent
+                return None
+            with self.spider.timer.log_time('cache.write'):
+                try:
+                    cache.touch_item(url)
+                except Exception as ex:
+                    logger.error('Could not update the timestamp of cached '
+                                 'document %s' % url, exc_info=ex)
+            with self.spider.timer.log_time('cache.read.prepare_request'):
+                grab.prepare_request()
+            with self.spider.timer.log_time('cache.read.load_response'):
+                cache.load_response(grab, cache_item)
+
+        grab.log_request('REVALIDATED')
+        self.spider.stat.inc('spider:cache-not-modified')
+
+        return NetworkResult(True, task, grab, grab.dump_config())
@@ -0,0 +1,171 @@
+"""
+This module contains the controller which adjusts number of concurrent
+network requests at run-time. It uses AIMD (additive increase,
+multiplicative decrease) algorithm: the limit grows by one after each
+window of successful results and it is cut down when results of the
+window show too many errors (timeouts, 429/503 responses) or the latency
+grows significantly.
+"""
+import pycurl
+
+DEFAULT_WINDOW = 20
+DEFAULT_HOST_WINDOW = 10
+DEFAULT_ERROR_THRESHOLD = 0.1
+DEFAULT_LATENCY_FACTOR = 2.0
+DEFAULT_DECREASE_FACTOR = 0.5
+# Network errors which mean that the server is overloaded
+OVERLOAD_ERROR_CODES = (pycurl.E_OPERATION_TIMEOUTED,)
+OVERLOAD_STATUS_CODES = (429, 503)
+
+
+def is_overload_result(res):
+    if res.ok:
+        return res.grab.response.code in OVERLOAD_STATUS_CODES
+    else:
+        return res.ecode in OVERLOAD_ERROR_CODES
+
+
+class AimdState(object):
+    """
+    AIMD state of the whole spider or of the single host.
+    """
+
+    __slots__ = ('limit', 'min_limit', 'max_limit', 'window',
+                 'count', 'errors', 'latency', 'latency_count',
+                 'base_latency')
+
+    def __init__(self, limit, min_limit, max_limit, window):
+        self.limit = limit
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.window = window
+        self.base_latency = None
+        self.reset_window()
+
+    def reset_window(self):
+        self.count = 0
+        self.errors = 0
+        self.latency = 0
+        self.latency_count = 0
+
+    def register(self, is_error, latency, controller):
+        """
+        Register one network result.
+
+        Returns -1, 0 or 1 if the limit has been decreased,
+        not changed or increased.
+        """
+
+        self.count += 1
+        if is_error:
+            self.errors += 1
+        elif latency is not None:
+            self.latency += latency
+            self.latency_count += 1
+        if self.count < self.window:
+            return 0
+
+        avg_latency = None
+        if self.latency_count:
+            avg_latency = self.latency / self.latency_count
+        overloaded = (
+            float(self.errors) / self.count > controller.error_threshold
+            or (avg_latency is not None and self.base_latency is not None
+                and avg_latency > (self.base_latency
+                                   * controller.latency_factor)))
+        if avg_latency is not None and not overloaded:
+            if self.base_latency is None or avg_latency < self.base_latency:
+                self.base_latency = avg_latency
+            else:
+                # Slowly adapt to the increased latency
+                self.base_latency += (avg_latency - self.base_latency) * 0.1
+        self.reset_window()
+
+        old_limit = self.limit
+        if overloaded:
+            self.limit = max(self.min_limit,
+                             int(self.limit * controller.decrease_factor))
+        else:
+            self.limit = min(self.max_limit, self.limit + 1)
+        if self.limit < old_limit:
+            return -1
+        elif self.limit > old_limit:
+            return 1
+        else:
+            return 0
+
+
+class ConcurrencyController(object):
+    def __init__(self, max_streams, min_streams=1, initial_streams=None,
+                 per_host=False, host_max_streams=None,
+                 window=DEFAULT_WINDOW, host_window=DEFAULT_HOST_WINDOW,
+                 error_threshold=DEFAULT_ERROR_THRESHOLD,
+                 latency_factor=DEFAULT_LATENCY_FACTOR,
+                 decrease_factor=DEFAULT_DECREASE_FACTOR):
+        """
+        :param max_streams: max. number of concurrent network requests
+        :param min_streams: min. number of concurrent network requests
+        :param initial_streams: number of concurrent network requests at
+            the start, by default it is `max_streams`
+        :param per_host: if True then number of concurrent requests to
+            each host is adjusted separately
+        :param host_max_streams: max. number of concurrent requests to
+            one host
+        :param window: number of results after which the global limit
+            is reconsidered
+        :param host_window: same as `window` but for host limits
+        :param error_threshold: max. share of errors (timeouts, 429 and 503
+            responses) in the window
+        :param latency_factor: limit is decreased if average latency of the
+            window is in `latency_factor` times greater than base latency
+        :param decrease_factor: the limit is multiplied by this value
+            when overload is detected
+        """
+
+        if initial_streams is None:
+            initial_streams = max_streams
+        self.state = AimdState(initial_streams, min_streams, max_streams,
+                               window)
+        self.per_host = per_host
+        if host_max_streams is None:
+            host_max_streams = max_streams
+        self.host_max_streams = host_max_streams
+        self.host_window = host_window
+        self.host_states = {}
+        self.error_threshold = error_threshold
+        self.latency_factor = latency_factor
+        self.decrease_factor = decrease_factor
+
+    @property
+    def limit(self):
+        return self.state.limit
+
+    def get_host_state(self, host, host_limit=1):
+        try:
+            return self.host_states[host]
+        except KeyError:
+            state = AimdState(min(host_limit, self.host_max_streams), 1,
+                              self.host_max_streams, self.host_window)
+            self.host_states[host] = state
+            return state
+
+    def get_host_limit(self, host):
+        return self.host_states[host].limit
+
+    def register_result(self, host, is_error, latency, host_limit=1):
+        """
+        Register the result of network request.
+
+        :param host_limit: current limit of the host, it is used
+            as initial value when the host is met first time
+
+        Returns tuple of two values which tell if the global limit
+        and the host limit has been changed (-1, 0 or 1).
+        """
+
+        global_change = self.state.register(is_error, latency, self)
+        host_change = 0
+        if self.per_host:
+            host_change = self.get_host_state(host, host_limit).register(
+                is_error, latency, self)
+        return global_change, host_change
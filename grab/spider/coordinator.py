@@ -0,0 +1,200 @@
+"""
+This module contains the coordinator of spiders which crawl the same
+site together. Spiders could work on different hosts. They share the
+task queue and the coordinator state stored in redis.
+
+Each spider registers itself as the worker and periodically writes
+the heartbeat: the time and the flag which tells if the spider has some
+work. Only one spider (the first one) processes initial URLs and the task
+generator. Crawling is completed when the shared queue is empty and
+no alive worker is busy. Worker which has not sent the heartbeat in
+`worker_timeout` seconds is considered dead: tasks it has taken from
+the queue are given out again when their lease expires. The heartbeat
+extends leases of tasks which the alive worker has taken but has not
+processed yet.
+
+The key which tells that initial URLs have been processed is removed
+by the last worker which leaves the cluster. It also expires in
+`worker_timeout` seconds if all workers have died: the heartbeat of
+any worker extends it.
+
+Counters of `Stat` of all workers are summed in redis.
+"""
+from __future__ import absolute_import
+import logging
+import os
+import random
+import socket
+import time
+
+from redis import StrictRedis
+
+logger = logging.getLogger('grab.spider.coordinator')
+DEFAULT_HEARTBEAT_INTERVAL = 5
+DEFAULT_WORKER_TIMEOUT = 30
+DEFAULT_CHECK_INTERVAL = 0.5
+# KEYS: workers, seed key
+# ARGV: worker id
+REMOVE_WORKER_SCRIPT = '''
+redis.call('HDEL', KEYS[1], ARGV[1])
+if redis.call('HLEN', KEYS[1]) == 0 then
+    redis.call('DEL', KEYS[2])
+end
+'''
+
+
+def build_worker_id():
+    return '%s:%d:%08x' % (socket.gethostname(), os.getpid(),
+                           random.getrandbits(32))
+
+
+class Coordinator(object):
+    def __init__(self, spider_name, prefix=None,
+                 heartbeat_interval=DEFAULT_HEARTBEAT_INTERVAL,
+                 worker_timeout=DEFAULT_WORKER_TIMEOUT,
+                 check_interval=DEFAULT_CHECK_INTERVAL, **kwargs):
+        """
+        :param prefix: prefix of redis keys, by default it is built
+            from the spider name
+        :param heartbeat_interval: how often the busy worker writes
+            the heartbeat, change of the state is written immediately
+        :param worker_timeout: number of seconds after which the worker
+            without heartbeats is considered dead
+        :param check_interval: how often the idle worker checks if
+            other workers have completed work
+
+        All "unexpected" kwargs goes to `redis.StrictRedis()` constructor
+        """
+
+        if prefix is None:
+            prefix = 'spider_%s' % spider_name
+        self.workers_key = '%s:workers' % prefix
+        self.stat_key = '%s:stat' % prefix
+        self.seed_key = '%s:seed' % prefix
+        self.heartbeat_interval = heartbeat_interval
+        self.worker_timeout = worker_timeout
+        self.check_interval = check_interval
+        self.worker_id = build_worker_id()
+        self.redis = StrictRedis(**kwargs)
+        self.remove_worker_script = self.redis.register_script(
+            REMOVE_WORKER_SCRIPT)
+        self.task_queue = None
+        self.busy = None
+        self.heartbeat_time = 0
+        self.check_time = 0
+        # Values of counters which have been sent to redis
+        self.counters_sent = {}
+
+    def register(self, task_queue=None):
+        """
+        Add the worker to the list of workers.
+
+        New worker is busy until it reports that it has no work.
+
+        :param task_queue: shared task queue, leases of tasks taken
+            from it are extended on each heartbeat
+        """
+
+        self.task_queue = task_queue
+        self.heartbeat(None, busy=True, force=True)
+        logger.debug('Registered worker %s' % self.worker_id)
+
+    def acquire_seed(self):
+        """
+        Return True if this worker should process initial URLs and
+        the task generator. Only one worker gets True until
+        all workers leave the cluster or `clear` is called.
+        """
+
+        return bool(self.redis.set(self.seed_key, self.worker_id, nx=True,
+                                   px=self.seed_ttl()))
+
+    def seed_ttl(self):
+        return int(self.worker_timeout * 1000)
+
+    def heartbeat(self, stat, busy, force=False):
+        now = time.time()
+        if (not force and busy == self.busy
+                and now - self.heartbeat_time < self.heartbeat_interval):
+            return
+        self.busy = busy
+        self.heartbeat_time = now
+        with self.redis.pipeline(transaction=False) as pipe:
+            pipe.hset(self.workers_key, self.worker_id,
+                      '%f %d' % (now, int(busy)))
+            pipe.pexpire(self.seed_key, self.seed_ttl())
+            if stat is not None:
+                self.push_counters(pipe, stat)
+            pipe.execute()
+        if self.task_queue is not None:
+            self.task_queue.renew_leases()
+
+    def push_counters(self, pipe, stat):
+        for key, val in list(stat.counters.items()):
+            delta = val - self.counters_sent.get(key, 0)
+            if delta:
+                if isinstance(delta, float):
+                    pipe.hincrbyfloat(self.stat_key, key, delta)
+                else:
+                    pipe.hincrby(self.stat_key, key, delta)
+                self.counters_sent[key] = val
+
+    def is_cluster_idle(self, stat):
+        """
+        Report that this worker has no work and check the state
+        of other workers. Return True if no alive worker has work.
+
+        The shared task queue must be checked by the caller: tasks
+        given out on lease stay in the queue until they are processed.
+        """
+
+        self.heartbeat(stat, busy=False)
+        now = time.time()
+        if now - self.check_time < self.check_interval:
+            return False
+        self.check_time = now
+        is_idle = True
+        for key, state in self.redis.hgetall(self.workers_key).items():
+            worker_id = key.decode('utf-8')
+            if worker_id == self.worker_id:
+                continue
+            state_time, busy = state.split()
+            if now - float(state_time) > self.worker_timeout:
+                logger.error('Worker %s is dead' % worker_id)
+                self.redis.hdel(self.workers_key, key)
+            elif busy != b'0':
+                is_idle = False
+        return is_idle
+
+    def get_counters(self):
+        """
+        Return sum of counters of all workers.
+        """
+
+        result = {}
+        for key, val in self.redis.hgetall(self.stat_key).items():
+            val = val.decode('ascii')
+            result[key.decode('utf-8')] = (float(val) if '.' in val
+                                           else int(val))
+        return result
+
+    def close(self, stat):
+        """
+        Send the final values of counters and remove the worker
+        from the list of workers. The last worker removes the seed key
+        so the next crawling processes initial URLs again.
+        """
+
+        with self.redis.pipeline(transaction=False) as pipe:
+            self.push_counters(pipe, stat)
+            pipe.execute()
+        self.remove_worker_script(keys=[self.workers_key, self.seed_key],
+                                  args=[self.worker_id])
+        self.task_queue = None
+
+    def clear(self):
+        """
+        Remove the state of workers and counters to start new crawling.
+        """
+
+        self.redis.delete(self.workers_key, self.stat_key, self.seed_key)
@@ -0,0 +1,139 @@
+"""
+Frontier is a layer between the task queue and the network transport.
+
+It keeps tasks taken from the task queue in per-host sub-queues and gives
+them out in round-robin order. Each host could have only limited number of
+active network requests. That does not allow tasks of one host to occupy
+all network streams while other hosts are starving. Tasks of one host are
+given out in the order of their priorities.
+
+Each host could have only limited number of buffered tasks, so tasks of
+one host could not fill the whole buffer. Tasks which do not fit are
+rejected and the spider returns them to the task queue.
+"""
+from collections import deque
+from heapq import heappush, heappop
+from itertools import count
+from six.moves.urllib.parse import urlsplit
+
+DEFAULT_HOST_STREAMS = 2
+DEFAULT_BUFFER_SIZE = 1000
+DEFAULT_HOST_BUFFER_SIZE = 100
+
+
+def get_task_host(task):
+    return urlsplit(task.url).hostname
+
+
+class Frontier(object):
+    def __init__(self, host_streams=DEFAULT_HOST_STREAMS,
+                 buffer_size=DEFAULT_BUFFER_SIZE, hosts=None,
+                 host_buffer_size=DEFAULT_HOST_BUFFER_SIZE):
+        """
+        :param host_streams: max. number of active network requests
+            to one host
+        :param buffer_size: max. number of tasks taken from the task queue
+            and not sent to the network yet
+        :param hosts: dict of `host_streams` values for specific hosts
+        :param host_buffer_size: max. number of buffered tasks of one host
+        """
+
+        self.host_streams = host_streams
+        self.host_limits = hosts or {}
+        self.buffer_size = buffer_size
+        self.host_buffer_size = host_buffer_size
+        # Heaps of (priority, number, task) items, the number keeps
+        # the order of tasks with same priority
+        self.host_queues = {}
+        self.counter = count()
+        self.host_active = {}
+        # Hosts which have buffered tasks and free streams
+        self.rotation = deque()
+        self.rotation_hosts = set()
+        self.size = 0
+
+    def get_host_limit(self, host):
+        return self.host_limits.get(host, self.host_streams)
+
+    def set_host_limit(self, host, limit):
+        self.host_limits[host] = limit
+        # Host could have been removed from rotation due to the old limit
+        self.add_to_rotation(host)
+
+    def is_host_available(self, host):
+        return (host in self.host_queues
+                and self.host_active.get(host, 0) < self.get_host_limit(host))
+
+    def add_to_rotation(self, host):
+        if host not in self.rotation_hosts and self.is_host_available(host):
+            self.rotation.append(host)
+            self.rotation_hosts.add(host)
+
+    def is_full(self):
+        return self.size >= self.buffer_size
+
+    def has_ready_tasks(self):
+        """
+        Return True if there are buffered tasks which hosts have
+        free network streams.
+        """
+
+        return bool(self.rotation)
+
+    def put(self, task):
+        """
+        Add the task to the buffer. Return False if the buffer of the task
+        host is full, the task is not added then.
+        """
+
+        host = get_task_host(task)
+        host_queue = self.host_queues.setdefault(host, [])
+        if len(host_queue) >= self.host_buffer_size:
+            return False
+        heappush(host_queue, (task.priority or 0, next(self.counter), task))
+        self.size += 1
+        self.add_to_rotation(host)
+        return True
+
+    def get(self):
+        """
+        Return next task or None if there are no tasks which hosts have
+        free network streams.
+        """
+
+        while self.rotation:
+            host = self.rotation.popleft()
+            self.rotation_hosts.discard(host)
+            if not self.is_host_available(host):
+                # Host limit could have been changed
+                continue
+            host_queue = self.host_queues[host]
+            task = heappop(host_queue)[2]
+            if not host_queue:
+                del self.host_queues[host]
+            self.size -= 1
+            self.host_active[host] = self.host_active.get(host, 0) + 1
+            self.add_to_rotation(host)
+            return task
+        return None
+
+    def release(self, task):
+        """
+        Must be called when network processing of the task which
+        was returned by `get` method is completed.
+        """
+
+        host = get_task_host(task)
+        active = self.host_active.get(host, 0) - 1
+        if active > 0:
+            self.host_active[host] = active
+        else:
+            self.host_active.pop(host, None)
+        self.add_to_rotation(host)
+
+    def clear(self):
+        self.host_queues = {}
+        self.host_active = {}
+        self.rotation = deque()
+        self.rotation_hosts = set()
+        self.size = 0
@@ -0,0 +1,123 @@
+from grab.base import Grab
+from grab.cookie import CookieManager
+from grab.document import Document
+
+# Attributes of Grab instance which are sent to parser processes
+GRAB_STATE_ATTRIBUTES = ('config', 'request_head', 'request_body',
+                         'request_method', 'request_counter', 'meta')
+
+
+def pack_grab(grab):
+    """
+    Return the state of Grab instance which is required to process
+    the response: config, cookies, request details and the document.
+
+    Transport object and the proxy list are not included.
+    """
+
+    state = dict((x, getattr(grab, x, None)) for x in GRAB_STATE_ATTRIBUTES)
+    state['transport_param'] = grab.transport_param
+    state['cookies'] = list(grab.cookies.cookiejar)
+    doc_state = grab.doc.__getstate__()
+    del doc_state['grab']
+    # Unicode body and parsed trees are built again from the body
+    doc_state['_unicode_body'] = None
+    doc_state['_pyquery'] = None
+    state['doc'] = doc_state
+    return state
+
+
+def unpack_grab(state):
+    """
+    Build Grab instance from the state returned by `pack_grab`.
+    """
+
+    grab = Grab(transport=state['transport_param'])
+    for key in GRAB_STATE_ATTRIBUTES:
+        setattr(grab, key, state[key])
+    grab.cookies = CookieManager.from_cookie_list(state['cookies'])
+    doc = Document(grab)
+    doc.__setstate__(state['doc'])
+    grab.doc = doc
+    return grab
+
+
+def unpickle_network_result(ok, task, grab_state, ecode, emsg, error_abbr,
+                            shared_body):
+    res = NetworkResult(ok, task, None, ecode=ecode, emsg=emsg,
+                        error_abbr=error_abbr, shared_body=shared_body)
+    res._grab_state = grab_state
+    return res
+
+
+class NetworkResult(object):
+    """
+    Result of network request which is passed from the network transport
+    (or the cache pipeline) to the spider and then to the parser.
+
+    Items could be accessed as attributes or dict keys, the latter
+    is supported for backward compatibility with code which handles
+    results as dicts.
+
+    Pickled result contains only the state of the Grab instance returned
+    by `pack_grab`. The Grab instance is built when it is accessed first
+    time in the parser process.
+    """
+
+    __slots__ = ('ok', 'ecode', 'emsg', 'error_abbr', '_grab', '_grab_state',
+                 'grab_config_backup', 'task', 'shared_body')
+
+    def __init__(self, ok, task, grab, grab_config_backup=None,
+                 ecode=None, emsg=None, error_abbr=None, shared_body=None):
+        self.ok = ok
+        self.task = task
+        self._grab = grab
+        self._grab_state = None
+        self.grab_config_backup = grab_config_backup
+        self.ecode = ecode
+        self.emsg = emsg
+        self.error_abbr = error_abbr
+        self.shared_body = shared_body
+
+    @property
+    def grab(self):
+        if self._grab_state is not None:
+            self._grab = unpack_grab(self._grab_state)
+            self._grab_state = None
+        return self._grab
+
+    @grab.setter
+    def grab(self, grab):
+        self._grab = grab
+        self._grab_state = None
+
+    def __getitem__(self, key):
+        try:
+            return getattr(self, key)
+        except AttributeError:
+            raise KeyError(key)
+
+    def __setitem__(self, key, val):
+        try:
+            setattr(self, key, val)
+        except AttributeError:
+            raise KeyError(key)
+
+    def copy(self):
+        return NetworkResult(self.ok, self.task, self.grab,
+                             self.grab_config_backup, self.ecode, self.emsg,
+                             self.error_abbr, self.shared_body)
+
+    def __reduce__(self):
+        # Config backup is required only to repeat failed requests
+        # in the main process. It is not sent to parser processes.
+        if self._grab is not None:
+            grab_state = pack_grab(self._grab)
+        else:
+            grab_state = self._grab_state
+        return (unpickle_network_result,
+                (self.ok, self.task, grab_state, self.ecode, self.emsg,
+                 self.error_abbr, self.shared_body))
+
+    def __repr__(self):
+        return '<NetworkResult ok=%s task=%r>' % (self.ok, self.task)
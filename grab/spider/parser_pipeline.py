@@ -46,6 +46,7 @@ class ParserPipeline(object):
                 shutdown_event=self.shutdown_event,
                 parser_requests_per_process=self.requests_per_process,
                 parser_mode=True,
+                loop_waker=self.bot.loop_waker,
                 meta=self.bot.meta)
         else:
             # In non-multiprocess mode we start `run_process`
@@ -68,6 +69,13 @@ class ParserPipeline(object):
         return is_parser_idle, proc
 
     def check_pool_health(self):
+        """
+        Restart died parser processes.
+
+        Returns number of restarted processes.
+        """
+
+        restored = 0
         for proc in self.parser_pool:
             if not proc['proc'].is_alive():
                 self.bot.stat.inc('parser-pipeline-restore')
@@ -78,6 +86,8 @@ class ParserPipeline(object):
                     'proc': new_proc,
                 })
                 self.parser_pool.remove(proc)
+                restored += 1
+        return restored
 
     def shutdown(self):
         for proc in self.parser_pool:
@@ -1,13 +1,27 @@
 """
 QueueInterface defines interface of queue backend.
 """
+try:
+    import Queue as queue
+except ImportError:
+    import queue
 
 
 class QueueInterface(object):
+    # Persistent queue is not cleared when the spider stops, tasks left
+    # in the queue are processed by the next run of the spider
+    persistent = False
+
     def __init__(self, spider_name, **kwargs):
         pass
 
-    def put(self, task, priority):
+    def put(self, task, priority, schedule_time=None):
+        """
+        Put the task into the queue.
+
+        If `schedule_time` (datetime in UTC) is specified then the task
+        could not be returned by `get` method until that time.
+        """
         raise NotImplementedError
 
     def get(self):
@@ -19,9 +33,64 @@ class QueueInterface(object):
         """
         raise NotImplementedError
 
+    def put_many(self, items):
+        """
+        Put multiple tasks into the queue.
+
+        :param items: list of (task, priority, schedule_time) tuples
+
+        Backends should override this method to put all tasks with one
+        request to the storage.
+        """
+        for task, priority, schedule_time in items:
+            self.put(task, priority, schedule_time=schedule_time)
+
+    def get_many(self, count):
+        """
+        Return list of up to `count` tasks, the list is empty if there
+        are no ready-to-go tasks.
+
+        Backends should override this method to get all tasks with one
+        request to the storage.
+        """
+        tasks = []
+        for x in range(count):
+            try:
+                tasks.append(self.get())
+            except queue.Empty:
+                break
+        return tasks
+
+    def ack(self, task):
+        """
+        Notify the queue that the task taken from the queue has been
+        processed.
+
+        Backends which give tasks out on lease remove the task from the
+        storage only after that call. Other backends do nothing.
+        """
+        pass
+
+    def renew_leases(self):
+        """
+        Extend the lease of tasks which have been taken from the queue
+        and have not been processed yet. It is called periodically by
+        the spider which works in distributed mode.
+
+        Backends which do not give tasks out on lease do nothing.
+        """
+        pass
+
     def size(self):
         raise NotImplementedError
 
     def clear(self):
         """Remove all tasks from the queue."""
         raise NotImplementedError
+
+    def close(self):
+        """
+        Write buffered changes to the storage, it is called when the
+        spider leaves the queue without clearing it.
+        """
+        pass
@@ -1,8 +1,23 @@
+"""
+In-memory queue backend.
+
+Tasks ready to be processed are stored in the heap ordered by priority.
+Delayed tasks are stored in the separate heap ordered by schedule time.
+Both heaps contain tuples with the unique sequence number as
+the second item: tasks with same priority (or schedule time) are returned
+in the order they have been added and tasks are never compared.
+
+The queue does not use locks. It could be filled from the task generator
+thread while the main thread reads it: `heappush` and `heappop` are atomic
+operations and only the main thread removes items from the heaps.
+"""
 from datetime import datetime
+from heapq import heappush, heappop
+from itertools import count
 try:
-    from Queue import PriorityQueue, Empty
+    from Queue import Empty
 except ImportError:
-    from queue import PriorityQueue, Empty
+    from queue import Empty
 
 from grab.spider.queue_backend.base import QueueInterface
 
@@ -10,39 +25,49 @@ from grab.spider.queue_backend.base import QueueInterface
 class QueueBackend(QueueInterface):
     def __init__(self, spider_name, **kwargs):
         super(QueueInterface, self).__init__(**kwargs)
-        self.queue_object = PriorityQueue()
+        # Heap of (priority, seq, task)
+        self.ready_heap = []
+        # Heap of (schedule_time, seq, task)
         self.schedule_list = []
+        self.seq_counter = count()
 
     def put(self, task, priority, schedule_time=None):
         if schedule_time is None:
-            self.queue_object.put((priority, task))
+            heappush(self.ready_heap, (priority, next(self.seq_counter), task))
         else:
-            self.schedule_list.append((schedule_time, task))
+            heappush(self.schedule_list,
+                     (schedule_time, next(self.seq_counter), task))
 
-    def get(self):
-        now = datetime.utcnow()
+    def move_scheduled_tasks(self):
+        """
+        Move tasks which schedule time has come to the ready heap.
+        """
 
-        removed_indexes = []
-        index = 0
-        for schedule_time, task in self.schedule_list:
-            if schedule_time <= now:
+        schedule_list = self.schedule_list
+        if schedule_list:
+            now = datetime.utcnow()
+            while schedule_list and schedule_list[0][0] <= now:
+                task = heappop(schedule_list)[2]
                 self.put(task, 1)
-                removed_indexes.append(index)
-            index += 1
 
-        self.schedule_list = [x for idx, x in enumerate(self.schedule_list)
-                              if idx not in removed_indexes]
+    def get(self):
+        self.move_scheduled_tasks()
+        try:
+            return heappop(self.ready_heap)[2]
+        except IndexError:
+            raise Empty
 
-        priority, task = self.queue_object.get(block=False)
-        return task
+    def get_many(self, count):
+        self.move_scheduled_tasks()
+        ready_heap = self.ready_heap
+        tasks = []
+        while ready_heap and len(tasks) < count:
+            tasks.append(heappop(ready_heap)[2])
+        return tasks
 
     def size(self):
-        return self.queue_object.qsize() + len(self.schedule_list)
+        return len(self.ready_heap) + len(self.schedule_list)
 
     def clear(self):
-        try:
-            while True:
-                self.queue_object.get(False)
-        except Empty:
-            pass
-        self.schedule_list = []
+        del self.ready_heap[:]
+        del self.schedule_list[:]
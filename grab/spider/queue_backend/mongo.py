@@ -1,26 +1,42 @@
+"""
+Spider task queue backend powered by MongoDB
+
+Tasks are not removed from the collection when they are taken from the
+queue. Instead, the task is given out on lease: its `schedule_time` is
+moved forward by `lease_timeout` seconds and the unique lease token is
+saved in the document. The document is removed when the spider reports
+that the task has been processed. If the spider has crashed then the task
+becomes visible again when the lease expires and other spider takes it.
+The spider extends leases of tasks which it holds.
+"""
 try:
     import Queue as queue
 except ImportError:
     import queue
-try:
-    import cPickle as pickle
-except ImportError:
-    import pickle
-from bson import Binary
+from bson import Binary, ObjectId
 import logging
 import pymongo
-from datetime import datetime
+from datetime import datetime, timedelta
 
 from grab.spider.queue_backend.base import QueueInterface
-from grab.spider.error import SpiderMisuseError
+from grab.spider.task_codec import encode_task, decode_task
 
 logger = logging.getLogger('grab.spider.queue_backend.mongo')
+DEFAULT_LEASE_TIMEOUT = 600
+# Acknowledged tasks are removed from the collection in batches
+ACK_BATCH_SIZE = 100
+# The approximate number of documents is used for big queues only
+EXACT_SIZE_LIMIT = 1000
 
 
 class QueueBackend(QueueInterface):
     def __init__(self, spider_name, database=None, queue_name=None,
-                 **kwargs):
+                 lease_timeout=DEFAULT_LEASE_TIMEOUT, **kwargs):
         """
+        :param lease_timeout: number of seconds the task taken from
+            the queue is invisible for other spiders, if the task has not
+            been processed in that time then it is given out again
+
         All "unexpected" kwargs goes to `pymongo.MongoClient()` method
         """
         if queue_name is None:
@@ -28,37 +44,132 @@ class QueueBackend(QueueInterface):
 
         self.database = database
         self.queue_name = queue_name
+        self.lease_timeout = lease_timeout
+        self.ack_buffer = []
+        # Lease tokens and expiration times of taken tasks which have not
+        # been acknowledged
+        self.leases = {}
         conn = pymongo.MongoClient(**kwargs)
         self.collection = conn[self.database][self.queue_name]
         logger.debug('Using collection: %s' % self.collection)
 
-        self.collection.ensure_index('priority')
+        # The query uses range condition on `schedule_time` and
+        # sorts by `priority`. Sort key goes first so the server reads
+        # documents in the order of index and does not sort them in memory.
+        self.collection.create_index([('priority', pymongo.ASCENDING),
+                                      ('schedule_time', pymongo.ASCENDING)])
 
         super(QueueInterface, self).__init__()
 
     def size(self):
-        return self.collection.count()
+        """
+        Return the number of tasks in the queue including tasks given out
+        on lease. The number is approximate if the queue is big.
+        """
 
-    def put(self, task, priority, schedule_time=None):
+        count = self.collection.estimated_document_count()
+        if count < EXACT_SIZE_LIMIT:
+            count = self.collection.count_documents({})
+        # Processed tasks which have not been removed yet
+        return max(0, count - len(self.ack_buffer))
+
+    def build_item(self, task, priority, schedule_time):
         if schedule_time is None:
             schedule_time = datetime.utcnow()
 
-        item = {
-            'task': Binary(pickle.dumps(task)),
+        return {
+            'task': Binary(encode_task(task)),
             'priority': priority,
             'schedule_time': schedule_time,
         }
-        self.collection.save(item)
+
+    def put(self, task, priority, schedule_time=None):
+        self.collection.insert_one(
+            self.build_item(task, priority, schedule_time))
+
+    def put_many(self, items):
+        if items:
+            self.collection.insert_many(
+                [self.build_item(*x) for x in items], ordered=False)
 
     def get(self):
-        item = self.collection.find_one_and_delete(
-            {'schedule_time': {'$lt': datetime.utcnow()}},
-            sort=[('priority', pymongo.ASCENDING)]
-        )
-        if item is None:
-            raise queue.Empty()
+        tasks = self.get_many(1)
+        if tasks:
+            return tasks[0]
         else:
-            return pickle.loads(item['task'])
+            raise queue.Empty()
+
+    def get_many(self, count):
+        self.flush_acks()
+        now = datetime.utcnow()
+        ids = [x['_id'] for x in self.collection.find(
+            {'schedule_time': {'$lte': now}},
+            projection=['_id'],
+            sort=[('priority', pymongo.ASCENDING)],
+            limit=count,
+        )]
+        if not ids:
+            return []
+        # Other spider could take some of found tasks at the same time.
+        # Condition on `schedule_time` lets only one spider to get
+        # the lease of the task.
+        token = ObjectId()
+        lease_time = now + timedelta(seconds=self.lease_timeout)
+        self.collection.update_many(
+            {'_id': {'$in': ids}, 'schedule_time': {'$lte': now}},
+            {'$set': {'lease': token, 'schedule_time': lease_time}})
+        tasks = []
+        for item in self.collection.find(
+                {'_id': {'$in': ids}, 'lease': token},
+                sort=[('priority', pymongo.ASCENDING)]):
+            task = decode_task(item['task'])
+            task.queue_lease = (item['_id'], token)
+            self.leases[item['_id']] = (token, lease_time)
+            tasks.append(task)
+        return tasks
+
+    def ack(self, task):
+        if task.queue_lease is not None:
+            self.leases.pop(task.queue_lease[0], None)
+            self.ack_buffer.append(task.queue_lease)
+            task.queue_lease = None
+            if len(self.ack_buffer) >= ACK_BATCH_SIZE:
+                self.flush_acks()
+
+    def flush_acks(self):
+        if self.ack_buffer:
+            # Document is not removed if the lease has expired and
+            # other spider has taken the task
+            self.collection.bulk_write(
+                [pymongo.DeleteOne({'_id': doc_id, 'lease': token})
+                 for doc_id, token in self.ack_buffer],
+                ordered=False)
+            self.ack_buffer = []
+
+    def renew_leases(self):
+        """
+        Extend leases which expire in less than a half of `lease_timeout`.
+        """
+
+        now = datetime.utcnow()
+        limit = now + timedelta(seconds=self.lease_timeout / 2.0)
+        lease_time = now + timedelta(seconds=self.lease_timeout)
+        ids_by_token = {}
+        for doc_id, (token, item_lease_time) in list(self.leases.items()):
+            if item_lease_time < limit:
+                ids_by_token.setdefault(token, []).append(doc_id)
+                self.leases[doc_id] = (token, lease_time)
+        # Document is not updated if the lease has expired and other
+        # spider has taken the task
+        for token, ids in ids_by_token.items():
+            self.collection.update_many(
+                {'_id': {'$in': ids}, 'lease': token},
+                {'$set': {'schedule_time': lease_time}})
 
     def clear(self):
-        self.collection.remove()
+        self.ack_buffer = []
+        self.leases = {}
+        self.collection.delete_many({})
+
+    def close(self):
+        self.flush_acks()
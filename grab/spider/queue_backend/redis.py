@@ -1,50 +1,240 @@
 """
 Spider task queue backend powered by redis
+
+Ready tasks are stored in sorted set which score is the priority of task.
+Delayed tasks are stored in another sorted set which score is the time
+when the task should be moved to the set of ready tasks. Tasks are moved
+and taken from the queue by the Lua script: it is atomic operation so
+many spiders could use the same queue.
+
+Taken task is given out on lease: it is put into the set of delayed tasks
+with the time when the lease expires. The spider removes the task from
+that set when the task has been processed. If the spider has crashed then
+the task is moved back to ready tasks like any other delayed task.
+The expiration time is the token of the lease: the task is not removed
+if it has been given out again. The spider extends leases of tasks which
+it holds, the backend keeps the current token of each lease.
 """
 from __future__ import absolute_import
-from qr import PriorityQueue
+from redis import StrictRedis
 try:
     import Queue as queue
 except ImportError:
     import queue
-import random
 import logging
+import random
+import struct
+import time
+from calendar import timegm
 
 from grab.spider.queue_backend.base import QueueInterface
-from grab.spider.error import SpiderMisuseError
+from grab.spider.task_codec import encode_task, decode_task
+
+# Each item starts with the prefix which makes the item unique
+# and sorts items with same priority in the order they have been added:
+# time in microseconds and random number
+ITEM_PREFIX = struct.Struct('>QI')
+# Max. number of delayed tasks which are moved to ready tasks at once
+MOVE_SCHEDULED_LIMIT = 1000
+DEFAULT_LEASE_TIMEOUT = 600
+# Acknowledged tasks are removed from the queue in batches
+ACK_BATCH_SIZE = 100
+# KEYS: ready tasks, delayed tasks
+# ARGV: pairs of acknowledged task and the time when its lease expires,
+# starting from ARGV[first]
+ACK_TASKS_LUA = '''
+for i = first, #ARGV, 2 do
+    local score = redis.call('ZSCORE', KEYS[2], ARGV[i])
+    if score and tonumber(score) == tonumber(ARGV[i + 1]) then
+        redis.call('ZREM', KEYS[2], ARGV[i])
+    end
+end
+'''
+ACK_TASKS_SCRIPT = 'local first = 1\n' + ACK_TASKS_LUA
+# KEYS: delayed tasks
+# ARGV: new time when the lease expires, pairs of task and the current
+# time when its lease expires
+# Returns tasks which lease has been extended
+RENEW_LEASES_SCRIPT = '''
+local renewed = {}
+for i = 2, #ARGV, 2 do
+    local score = redis.call('ZSCORE', KEYS[1], ARGV[i])
+    if score and tonumber(score) == tonumber(ARGV[i + 1]) then
+        redis.call('ZADD', KEYS[1], ARGV[1], ARGV[i])
+        renewed[#renewed + 1] = ARGV[i]
+    end
+end
+return renewed
+'''
+# Max. number of leases which are extended by one call of the script
+RENEW_BATCH_SIZE = 1000
+# KEYS: ready tasks, delayed tasks
+# ARGV: current time, number of tasks to take, max. number of delayed
+# tasks to move, time when the lease of taken tasks expires (0 if tasks
+# are not given on lease), acknowledged tasks (see ACK_TASKS_LUA)
+GET_TASKS_SCRIPT = 'local first = 5\n' + ACK_TASKS_LUA + '''
+local due = redis.call('ZRANGEBYSCORE', KEYS[2], '-inf', ARGV[1],
+                       'LIMIT', 0, ARGV[3])
+for i = 1, #due do
+    redis.call('ZADD', KEYS[1], 1, due[i])
+    redis.call('ZREM', KEYS[2], due[i])
+end
+local items = redis.call('ZRANGE', KEYS[1], 0, ARGV[2] - 1)
+if #items > 0 then
+    redis.call('ZREMRANGEBYRANK', KEYS[1], 0, #items - 1)
+    if tonumber(ARGV[4]) > 0 then
+        for i = 1, #items do
+            redis.call('ZADD', KEYS[2], ARGV[4], items[i])
+        end
+    end
+end
+return items
+'''
+
+
+def pack_task(task):
+    prefix = ITEM_PREFIX.pack(int(time.time() * 1000000),
+                              random.getrandbits(32))
+    return prefix + encode_task(task)
+
+
+def unpack_task(item):
+    return decode_task(item[ITEM_PREFIX.size:])
 
 
 class QueueBackend(QueueInterface):
-    def __init__(self, spider_name, queue_name=None, **kwargs):
+    def __init__(self, spider_name, queue_name=None,
+                 lease_timeout=DEFAULT_LEASE_TIMEOUT, **kwargs):
+        """
+        :param lease_timeout: number of seconds the task taken from
+            the queue is invisible for other spiders, if the task has not
+            been processed in that time then it is given out again.
+            If it is 0 then the task is removed from the queue
+            when it is taken.
+
+        All "unexpected" kwargs goes to `redis.StrictRedis()` constructor
+        """
+
         super(QueueBackend, self).__init__(spider_name, **kwargs)
         self.spider_name = spider_name
         if queue_name is None:
             queue_name = 'task_queue_%s' % spider_name
         self.queue_name = queue_name
-        self.queue_object = PriorityQueue(queue_name, **kwargs)
+        self.schedule_key = '%s:schedule' % queue_name
+        self.lease_timeout = lease_timeout
+        self.ack_buffer = []
+        # Current lease tokens of taken tasks which have not been
+        # acknowledged
+        self.leases = {}
+        self.redis = StrictRedis(**kwargs)
+        self.get_tasks_script = self.redis.register_script(GET_TASKS_SCRIPT)
+        self.ack_tasks_script = self.redis.register_script(ACK_TASKS_SCRIPT)
+        self.renew_leases_script = self.redis.register_script(
+            RENEW_LEASES_SCRIPT)
         logging.debug('Redis queue key: %s' % self.queue_name)
 
     def put(self, task, priority, schedule_time=None):
-        # Add attribute with random value
-        # This is required because qr library
-        # does not allow to store multiple values with same hash
-        # in the PriorityQueue
+        self.put_many([(task, priority, schedule_time)])
 
-        if schedule_time is not None:
-            raise SpiderMisuseError('Redis task queue does not support '
-                                    'delayed task')
-        task._rnd = random.random()
-        self.queue_object.push(task, priority)
+    def put_many(self, items):
+        # Arguments of ZADD commands: score, member, score, member...
+        ready_args = []
+        schedule_args = []
+        for task, priority, schedule_time in items:
+            if schedule_time is None:
+                ready_args.extend((priority, pack_task(task)))
+            else:
+                ts = (timegm(schedule_time.utctimetuple())
+                      + schedule_time.microsecond / 1000000.0)
+                schedule_args.extend((ts, pack_task(task)))
+        # Raw commands work with any version of redis client,
+        # signature of `zadd` method has been changed in redis 3.0
+        with self.redis.pipeline(transaction=False) as pipe:
+            if ready_args:
+                pipe.execute_command('ZADD', self.queue_name, *ready_args)
+            if schedule_args:
+                pipe.execute_command('ZADD', self.schedule_key,
+                                     *schedule_args)
+            pipe.execute()
 
     def get(self):
-        task = self.queue_object.pop()
-        if task is None:
-            raise queue.Empty()
+        tasks = self.get_many(1)
+        if tasks:
+            return tasks[0]
         else:
-            return task
+            raise queue.Empty()
+
+    def get_many(self, count):
+        now = time.time()
+        lease_time = now + self.lease_timeout if self.lease_timeout else 0
+        args = [now, count, MOVE_SCHEDULED_LIMIT, repr(lease_time)]
+        for item, item_lease_time in self.ack_buffer:
+            args.extend((item, item_lease_time))
+        self.ack_buffer = []
+        items = self.get_tasks_script(
+            keys=[self.queue_name, self.schedule_key], args=args)
+        tasks = []
+        for item in items:
+            task = unpack_task(item)
+            if lease_time:
+                task.queue_lease = (item, repr(lease_time))
+                self.leases[item] = repr(lease_time)
+            tasks.append(task)
+        return tasks
+
+    def ack(self, task):
+        if task.queue_lease is not None:
+            item, item_lease_time = task.queue_lease
+            # The lease could have been extended since the task was taken
+            self.ack_buffer.append(
+                (item, self.leases.pop(item, item_lease_time)))
+            task.queue_lease = None
+            if len(self.ack_buffer) >= ACK_BATCH_SIZE:
+                self.flush_acks()
+
+    def flush_acks(self):
+        if self.ack_buffer:
+            args = []
+            for item, item_lease_time in self.ack_buffer:
+                args.extend((item, item_lease_time))
+            self.ack_tasks_script(
+                keys=[self.queue_name, self.schedule_key], args=args)
+            self.ack_buffer = []
+
+    def renew_leases(self):
+        """
+        Extend leases which expire in less than a half of `lease_timeout`.
+        """
+
+        now = time.time()
+        items = [(item, item_lease_time) for item, item_lease_time
+                 in self.leases.items()
+                 if float(item_lease_time) - now < self.lease_timeout / 2.0]
+        if not items:
+            return
+        lease_time = repr(now + self.lease_timeout)
+        for pos in range(0, len(items), RENEW_BATCH_SIZE):
+            args = [lease_time]
+            for item, item_lease_time in items[pos:pos + RENEW_BATCH_SIZE]:
+                args.extend((item, item_lease_time))
+                # The lease has expired and the task could have been
+                # given out again, the token is dropped
+                del self.leases[item]
+            for item in self.renew_leases_script(keys=[self.schedule_key],
+                                                 args=args):
+                self.leases[item] = lease_time
 
     def size(self):
-        return len(self.queue_object)
+        with self.redis.pipeline(transaction=False) as pipe:
+            pipe.zcard(self.queue_name)
+            pipe.zcard(self.schedule_key)
+            # Processed tasks which have not been removed yet
+            return max(0, sum(pipe.execute()) - len(self.ack_buffer))
 
     def clear(self):
-        self.queue_object.clear()
+        self.ack_buffer = []
+        self.leases = {}
+        self.redis.delete(self.queue_name, self.schedule_key)
+
+    def close(self):
+        self.flush_acks()
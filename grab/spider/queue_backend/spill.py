@@ -0,0 +1,251 @@
+"""
+Spider task queue backend which keeps bounded number of tasks in memory
+and spills other tasks to local files.
+
+Ready tasks are stored in the in-memory heap ordered by priority like in
+the memory backend. When the heap grows over `max_size` tasks, the half of
+tasks with lowest priorities is sorted and written to the new file (run).
+Only the head record of each run is kept in memory. Tasks are returned in
+the order of priorities: the queue compares the top of the heap with heads
+of all runs and reads next record of the run which head has been taken.
+When number of runs grows over `max_runs` then all runs are merged into
+one run.
+
+Delayed tasks are spilled in the same way: the heap ordered by schedule
+time holds at most `max_size` tasks, the half of tasks with latest schedule
+time is written to the run of delayed tasks.
+
+Spilled tasks are stored in compact binary form (see `grab.spider.task_codec`),
+the directory with files is created when the first run is written and it is
+removed when the queue is cleared or closed. The queue does not survive the
+restart of the spider, use the sqlite backend for that.
+"""
+from calendar import timegm
+from heapq import heappush, heappop, merge
+from itertools import count
+import os
+import shutil
+import struct
+import tempfile
+from threading import Lock
+import time
+try:
+    from Queue import Empty
+except ImportError:
+    from queue import Empty
+
+from grab.spider.queue_backend.base import QueueInterface
+from grab.spider.task_codec import encode_task, decode_task
+
+DEFAULT_MAX_SIZE = 100000
+DEFAULT_MAX_RUNS = 16
+# Priority (schedule time for delayed tasks), sequence number and
+# length of encoded task
+RECORD_HEADER = struct.Struct('<dQI')
+
+
+def datetime_to_timestamp(date):
+    return timegm(date.utctimetuple()) + date.microsecond / 1000000.0
+
+
+class SpillRun(object):
+    """
+    File with records sorted by (priority, seq) or (schedule time, seq).
+    """
+
+    def __init__(self, path, records):
+        self.path = path
+        with open(path, 'wb') as out:
+            for priority, seq, data in records:
+                out.write(RECORD_HEADER.pack(priority, seq, len(data)))
+                out.write(data)
+        self.file = open(path, 'rb')
+
+    def read(self):
+        """
+        Return next (priority, seq, data) record or None if the run
+        has been read to the end.
+        """
+
+        header = self.file.read(RECORD_HEADER.size)
+        if not header:
+            return None
+        priority, seq, length = RECORD_HEADER.unpack(header)
+        return priority, seq, self.file.read(length)
+
+    def iter_records(self):
+        while True:
+            record = self.read()
+            if record is None:
+                break
+            yield record
+
+    def remove(self):
+        self.file.close()
+        os.remove(self.path)
+
+
+class QueueBackend(QueueInterface):
+    def __init__(self, spider_name, path=None, max_size=DEFAULT_MAX_SIZE,
+                 max_runs=DEFAULT_MAX_RUNS, **kwargs):
+        """
+        :param path: directory where the directory with runs is created,
+            by default it is system directory for temporary files
+        :param max_size: max. number of ready tasks kept in memory
+        :param max_runs: max. number of runs before they are merged
+        """
+
+        super(QueueBackend, self).__init__(spider_name, **kwargs)
+        self.path = path
+        self.run_dir = None
+        self.max_size = max_size
+        self.max_runs = max_runs
+        # Heap of (priority, seq, task)
+        self.ready_heap = []
+        # Heap of (schedule timestamp, seq, task)
+        self.schedule_list = []
+        # Heaps of (priority or schedule timestamp, seq, data, run):
+        # head records of runs of ready and delayed tasks
+        self.run_heap = []
+        self.schedule_run_heap = []
+        # Number of tasks in runs including head records
+        self.spilled_count = 0
+        self.seq_counter = count()
+        self.run_counter = count()
+        # Task generator thread puts tasks into the queue
+        # while the main thread reads it
+        self.lock = Lock()
+
+    def put(self, task, priority, schedule_time=None):
+        self.put_many([(task, priority, schedule_time)])
+
+    def put_many(self, items):
+        with self.lock:
+            for task, priority, schedule_time in items:
+                if schedule_time is None:
+                    heappush(self.ready_heap,
+                             (priority, next(self.seq_counter), task))
+                else:
+                    heappush(self.schedule_list,
+                             (datetime_to_timestamp(schedule_time),
+                              next(self.seq_counter), task))
+            self.check_size()
+
+    def check_size(self):
+        if len(self.ready_heap) > self.max_size:
+            self.spill(self.ready_heap, self.run_heap)
+        if len(self.schedule_list) > self.max_size:
+            self.spill(self.schedule_list, self.schedule_run_heap)
+
+    def spill(self, heap, run_heap):
+        """
+        Write the half of tasks with greatest keys (lowest priorities or
+        latest schedule time) from the heap to new run.
+        """
+
+        items = sorted(heap)
+        keep = self.max_size // 2
+        # Sorted list is a valid heap
+        heap[:] = items[:keep]
+        records = [(x[0], x[1], encode_task(x[2])) for x in items[keep:]]
+        self.add_run(run_heap, records)
+        self.spilled_count += len(records)
+        if len(run_heap) > self.max_runs:
+            self.merge_runs(run_heap)
+
+    def add_run(self, run_heap, records):
+        if self.run_dir is None:
+            if self.path is not None and not os.path.exists(self.path):
+                os.makedirs(self.path)
+            self.run_dir = tempfile.mkdtemp(prefix='grab-queue-',
+                                            dir=self.path)
+        path = os.path.join(self.run_dir,
+                            'run-%d.bin' % next(self.run_counter))
+        run = SpillRun(path, records)
+        self.push_run_head(run_heap, run)
+
+    def push_run_head(self, run_heap, run):
+        record = run.read()
+        if record is None:
+            run.remove()
+        else:
+            heappush(run_heap, record + (run,))
+
+    def merge_runs(self, run_heap):
+        def iter_run(head):
+            yield head[:3]
+            for record in head[3].iter_records():
+                yield record
+
+        heads = run_heap[:]
+        del run_heap[:]
+        self.add_run(run_heap, merge(*[iter_run(x) for x in heads]))
+        for head in heads:
+            head[3].remove()
+
+    def pop_spilled_task(self, run_heap):
+        head = heappop(run_heap)
+        self.spilled_count -= 1
+        self.push_run_head(run_heap, head[3])
+        return decode_task(head[2])
+
+    def move_scheduled_tasks(self):
+        """
+        Move tasks which schedule time has come to the ready heap.
+        """
+
+        schedule_list = self.schedule_list
+        schedule_run_heap = self.schedule_run_heap
+        now = time.time()
+        while True:
+            if (schedule_list and schedule_list[0][0] <= now
+                    and (not schedule_run_heap
+                         or schedule_list[0][:2] < schedule_run_heap[0][:2])):
+                task = heappop(schedule_list)[2]
+            elif schedule_run_heap and schedule_run_heap[0][0] <= now:
+                task = self.pop_spilled_task(schedule_run_heap)
+            else:
+                break
+            heappush(self.ready_heap, (1, next(self.seq_counter), task))
+
+    def get(self):
+        tasks = self.get_many(1)
+        if tasks:
+            return tasks[0]
+        else:
+            raise Empty
+
+    def get_many(self, count):
+        tasks = []
+        with self.lock:
+            self.move_scheduled_tasks()
+            self.check_size()
+            ready_heap = self.ready_heap
+            run_heap = self.run_heap
+            while len(tasks) < count and (ready_heap or run_heap):
+                if (ready_heap and (not run_heap
+                                    or ready_heap[0][:2] < run_heap[0][:2])):
+                    tasks.append(heappop(ready_heap)[2])
+                else:
+                    tasks.append(self.pop_spilled_task(run_heap))
+        return tasks
+
+    def size(self):
+        return (len(self.ready_heap) + len(self.schedule_list)
+                + self.spilled_count)
+
+    def clear(self):
+        with self.lock:
+            for head in self.run_heap + self.schedule_run_heap:
+                head[3].file.close()
+            self.run_heap = []
+            self.schedule_run_heap = []
+            self.spilled_count = 0
+            self.ready_heap = []
+            self.schedule_list = []
+            if self.run_dir is not None:
+                shutil.rmtree(self.run_dir, ignore_errors=True)
+                self.run_dir = None
+
+    def close(self):
+        self.clear()
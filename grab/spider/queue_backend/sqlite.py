@@ -0,0 +1,250 @@
+"""
+Spider task queue backend which stores tasks in local SQLite database.
+
+It does not require any database server and it could hold the queue which
+does not fit into memory. The database uses write-ahead log so the queue
+survives the crash of the spider process. Tasks which have been put into
+the queue are buffered in memory and written in one transaction when
+`batch_size` tasks are buffered, when `flush_interval` seconds have passed
+or when there are no ready tasks in the table. Only tasks added right
+before the crash could be lost.
+
+Taken task is not removed from the table: the row is marked as taken and
+it is deleted when the spider reports that the task has been processed.
+Tasks taken but not processed by the previous run of the spider (crashed
+or stopped) are given out again by the next run.
+
+Database file should not be used by multiple spiders at the same time.
+"""
+from calendar import timegm
+import os
+import sqlite3
+from threading import Lock
+import time
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+from grab.spider.queue_backend.base import QueueInterface
+from grab.spider.error import SpiderMisuseError
+from grab.spider.task_codec import encode_task, decode_task
+
+DEFAULT_BATCH_SIZE = 1000
+DEFAULT_FLUSH_INTERVAL = 1
+
+
+def datetime_to_timestamp(date):
+    return timegm(date.utctimetuple()) + date.microsecond / 1000000.0
+
+
+class QueueBackend(QueueInterface):
+    persistent = True
+
+    def __init__(self, spider_name, path=None, queue_name=None,
+                 batch_size=DEFAULT_BATCH_SIZE,
+                 flush_interval=DEFAULT_FLUSH_INTERVAL, **kwargs):
+        """
+        :param path: path to the database file
+        :param queue_name: name of the table, by default it is built
+            from the spider name
+        :param batch_size: max. number of tasks which are buffered in
+            memory before they are written to the database
+        :param flush_interval: max. number of seconds the task is
+            buffered in memory
+        """
+
+        super(QueueBackend, self).__init__(spider_name, **kwargs)
+        if path is None:
+            raise SpiderMisuseError('SQLite queue requires path option')
+        if queue_name is None:
+            queue_name = 'task_queue_%s' % spider_name
+        self.path = path
+        self.queue_name = queue_name
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.write_buffer = []
+        self.flush_time = time.time()
+        self.ack_buffer = []
+        # Task generator thread puts tasks into the queue
+        # while the main thread reads it
+        self.lock = Lock()
+        self.connect()
+
+    def connect(self):
+        path_dir = os.path.dirname(self.path)
+        if path_dir and not os.path.exists(path_dir):
+            os.makedirs(path_dir)
+        self.conn = sqlite3.connect(self.path, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode = WAL')
+        self.conn.execute('PRAGMA synchronous = NORMAL')
+        # Ready tasks have NULL `schedule_time`. The index is used
+        # both to find the ready task with the lowest priority and
+        # to find delayed tasks which time has come. Taken tasks
+        # have non-zero `taken` and they are skipped by both queries.
+        self.conn.execute(
+            'CREATE TABLE IF NOT EXISTS "%s" ('
+            'id INTEGER PRIMARY KEY AUTOINCREMENT, '
+            'taken INTEGER NOT NULL DEFAULT 0, '
+            'priority INTEGER NOT NULL, '
+            'schedule_time REAL, '
+            'task BLOB NOT NULL)' % self.queue_name)
+        self.conn.execute(
+            'CREATE INDEX IF NOT EXISTS "%s_schedule_priority" '
+            'ON "%s" (taken, schedule_time, priority, id)'
+            % (self.queue_name, self.queue_name))
+        self.count = 0
+        self.release_taken_tasks()
+
+    def release_taken_tasks(self):
+        # Tasks taken by previous run of the spider which have not been
+        # processed are given out again
+        self.conn.execute('UPDATE "%s" SET taken = 0 WHERE taken = 1'
+                          % self.queue_name)
+        self.conn.commit()
+        self.count = self.conn.execute(
+            'SELECT COUNT(*) FROM "%s"' % self.queue_name
+        ).fetchone()[0] + len(self.write_buffer)
+        self.load_next_schedule_time()
+
+    def load_next_schedule_time(self):
+        self.next_schedule_time = self.conn.execute(
+            'SELECT MIN(schedule_time) FROM "%s" WHERE taken = 0'
+            % self.queue_name
+        ).fetchone()[0]
+
+    def put(self, task, priority, schedule_time=None):
+        self.put_many([(task, priority, schedule_time)])
+
+    def put_many(self, items):
+        rows = []
+        min_schedule_time = None
+        for task, priority, schedule_time in items:
+            if schedule_time is not None:
+                schedule_time = datetime_to_timestamp(schedule_time)
+                if (min_schedule_time is None
+                        or schedule_time < min_schedule_time):
+                    min_schedule_time = schedule_time
+            rows.append((priority, schedule_time,
+                         sqlite3.Binary(encode_task(task))))
+        with self.lock:
+            self.write_buffer.extend(rows)
+            self.count += len(rows)
+            if (min_schedule_time is not None
+                    and (self.next_schedule_time is None
+                         or min_schedule_time < self.next_schedule_time)):
+                self.next_schedule_time = min_schedule_time
+            if (len(self.write_buffer) >= self.batch_size
+                    or time.time() - self.flush_time >= self.flush_interval):
+                self.flush_buffer()
+
+    def flush_buffer(self):
+        self.flush_time = time.time()
+        if self.write_buffer:
+            self.conn.executemany(
+                'INSERT INTO "%s" (priority, schedule_time, task) '
+                'VALUES (?, ?, ?)' % self.queue_name, self.write_buffer)
+            self.write_buffer = []
+        self.flush_acks()
+        self.conn.commit()
+
+    def flush_acks(self):
+        if self.ack_buffer:
+            self.conn.executemany('DELETE FROM "%s" WHERE id = ?'
+                                  % self.queue_name,
+                                  [(x,) for x in self.ack_buffer])
+            self.ack_buffer = []
+
+    def flush(self):
+        """
+        Write buffered tasks and acknowledgements to the database.
+        """
+
+        with self.lock:
+            self.flush_buffer()
+
+    def move_scheduled_tasks(self):
+        now = time.time()
+        if (self.next_schedule_time is not None
+                and self.next_schedule_time <= now):
+            self.conn.execute(
+                'UPDATE "%s" SET priority = 1, schedule_time = NULL '
+                'WHERE taken = 0 AND schedule_time <= ?'
+                % self.queue_name, (now,))
+            self.conn.commit()
+            self.load_next_schedule_time()
+
+    def take_ready_tasks(self, count):
+        rows = self.conn.execute(
+            'SELECT id, task FROM "%s" '
+            'WHERE taken = 0 AND schedule_time IS NULL '
+            'ORDER BY priority, id LIMIT ?' % self.queue_name, (count,)
+        ).fetchall()
+        if rows:
+            self.conn.executemany('UPDATE "%s" SET taken = 1 WHERE id = ?'
+                                  % self.queue_name,
+                                  [(x[0],) for x in rows])
+        return rows
+
+    def get(self):
+        tasks = self.get_many(1)
+        if tasks:
+            return tasks[0]
+        else:
+            raise queue.Empty()
+
+    def get_many(self, count):
+        with self.lock:
+            if time.time() - self.flush_time >= self.flush_interval:
+                self.flush_buffer()
+            self.move_scheduled_tasks()
+            rows = self.take_ready_tasks(count)
+            # Buffered tasks are written only when the table has
+            # not enough ready tasks
+            if len(rows) < count and self.write_buffer:
+                self.flush_buffer()
+                self.move_scheduled_tasks()
+                rows.extend(self.take_ready_tasks(count - len(rows)))
+            if rows:
+                self.conn.commit()
+                self.count -= len(rows)
+        tasks = []
+        for row_id, data in rows:
+            task = decode_task(bytes(data))
+            task.queue_lease = row_id
+            tasks.append(task)
+        return tasks
+
+    def ack(self, task):
+        if task.queue_lease is not None:
+            with self.lock:
+                self.ack_buffer.append(task.queue_lease)
+                if len(self.ack_buffer) >= self.batch_size:
+                    self.flush_buffer()
+            task.queue_lease = None
+
+    def size(self):
+        """
+        Return the number of tasks in the queue excluding taken tasks.
+        """
+
+        return self.count
+
+    def clear(self):
+        with self.lock:
+            self.write_buffer = []
+            self.ack_buffer = []
+            self.conn.execute('DELETE FROM "%s"' % self.queue_name)
+            self.conn.commit()
+            self.count = 0
+            self.next_schedule_time = None
+
+    def close(self):
+        """
+        Write buffered tasks to the database and release taken tasks
+        which have not been processed.
+        """
+
+        with self.lock:
+            self.flush_buffer()
+            self.release_taken_tasks()
@@ -0,0 +1,197 @@
+"""
+Write-behind buffer in front of the task queue backend.
+
+With remote backends (redis, mongo) each `put` is the network request made
+by the main loop thread. The buffer collects new tasks in memory and the
+background thread writes them to the backend with one `put_many` call
+every `flush_interval` seconds or when `batch_size` tasks have been
+collected.
+
+Tasks which priority is not greater than `local_priority` are not written
+to the backend at all: they are kept in the local heap (up to `local_size`
+tasks) and `get_many` returns them before tasks of the backend.
+Such tasks are not visible for other spiders which share the queue and
+they are not given out on lease, so they are lost if the spider crashes.
+"""
+from heapq import heappush, heappop
+from itertools import count
+import logging
+from threading import Event, Lock, Thread
+try:
+    from Queue import Empty
+except ImportError:
+    from queue import Empty
+
+from grab.spider.queue_backend.base import QueueInterface
+
+logger = logging.getLogger('grab.spider.queue_buffer')
+DEFAULT_BATCH_SIZE = 500
+DEFAULT_FLUSH_INTERVAL = 0.5
+DEFAULT_LOCAL_SIZE = 1000
+
+
+class QueueBuffer(QueueInterface):
+    def __init__(self, backend, batch_size=DEFAULT_BATCH_SIZE,
+                 flush_interval=DEFAULT_FLUSH_INTERVAL,
+                 local_priority=None, local_size=DEFAULT_LOCAL_SIZE):
+        """
+        :param backend: task queue backend
+        :param batch_size: number of buffered tasks which triggers
+            writing to the backend
+        :param flush_interval: max. number of seconds the task stays
+            in the buffer
+        :param local_priority: tasks with priority less than or equal
+            to that value are served from the local heap, if it is None
+            then all tasks are written to the backend
+        :param local_size: max. number of tasks in the local heap
+        """
+
+        super(QueueBuffer, self).__init__(spider_name=None)
+        self.backend = backend
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.local_priority = local_priority
+        self.local_size = local_size
+        # List of (task, priority, schedule_time) to write to the backend
+        self.write_buffer = []
+        # Number of tasks which are being written to the backend
+        self.flushing_count = 0
+        # Heap of (priority, seq, task)
+        self.local_heap = []
+        self.seq_counter = count()
+        # Task generator thread and the main thread put tasks
+        # while the flush thread takes them
+        self.lock = Lock()
+        # Only one thread writes to the backend at the same time
+        self.flush_lock = Lock()
+        self.flush_event = Event()
+        self.flush_thread = None
+        self.stop_flag = False
+
+    def __getattr__(self, key):
+        # Backend-specific attributes e.g. `lease_timeout`
+        if key == 'backend':
+            raise AttributeError(key)
+        return getattr(self.backend, key)
+
+    @property
+    def persistent(self):
+        return self.backend.persistent
+
+    def start_flush_thread(self):
+        self.stop_flag = False
+        self.flush_thread = Thread(target=self.flush_thread_worker)
+        self.flush_thread.daemon = True
+        self.flush_thread.start()
+
+    def flush_thread_worker(self):
+        while not self.stop_flag:
+            self.flush_event.wait(self.flush_interval)
+            self.flush_event.clear()
+            self.flush()
+
+    def is_local(self, priority, schedule_time):
+        return (self.local_priority is not None
+                and schedule_time is None
+                and priority is not None
+                and priority <= self.local_priority
+                and len(self.local_heap) < self.local_size)
+
+    def put(self, task, priority, schedule_time=None):
+        self.put_many([(task, priority, schedule_time)])
+
+    def put_many(self, items):
+        with self.lock:
+            for item in items:
+                task, priority, schedule_time = item
+                if self.is_local(priority, schedule_time):
+                    heappush(self.local_heap,
+                             (priority, next(self.seq_counter), task))
+                else:
+                    self.write_buffer.append(item)
+            if self.flush_thread is None:
+                self.start_flush_thread()
+            if len(self.write_buffer) >= self.batch_size:
+                self.flush_event.set()
+
+    def flush(self):
+        """
+        Write buffered tasks to the backend.
+
+        If the backend fails then tasks are returned into the buffer
+        and they are written with the next flush.
+        """
+
+        with self.flush_lock:
+            with self.lock:
+                items = self.write_buffer
+                self.write_buffer = []
+                self.flushing_count = len(items)
+            if items:
+                try:
+                    self.backend.put_many(items)
+                except Exception as ex:
+                    logger.error('Could not write %d tasks to the task '
+                                 'queue' % len(items), exc_info=ex)
+                    with self.lock:
+                        self.write_buffer[:0] = items
+                finally:
+                    self.flushing_count = 0
+
+    def get(self):
+        tasks = self.get_many(1)
+        if tasks:
+            return tasks[0]
+        else:
+            raise Empty
+
+    def get_many(self, count):
+        tasks = []
+        with self.lock:
+            local_heap = self.local_heap
+            while local_heap and len(tasks) < count:
+                tasks.append(heappop(local_heap)[2])
+        if len(tasks) < count:
+            tasks.extend(self.backend.get_many(count - len(tasks)))
+            if len(tasks) < count and self.write_buffer:
+                # Do not make the spider wait for the next flush
+                self.flush_event.set()
+        return tasks
+
+    def ack(self, task):
+        self.backend.ack(task)
+
+    def renew_leases(self):
+        self.backend.renew_leases()
+
+    def size(self):
+        # Buffers are checked before the backend: the task which is being
+        # written could be counted twice but it is never missed
+        buffered = (len(self.write_buffer) + self.flushing_count
+                    + len(self.local_heap))
+        return buffered + self.backend.size()
+
+    def clear(self):
+        with self.flush_lock:
+            with self.lock:
+                self.write_buffer = []
+                self.local_heap = []
+            self.backend.clear()
+
+    def close(self):
+        """
+        Stop the flush thread, write all buffered tasks including tasks
+        of the local heap to the backend and close the backend.
+        """
+
+        if self.flush_thread is not None:
+            self.stop_flag = True
+            self.flush_event.set()
+            self.flush_thread.join()
+            self.flush_thread = None
+        with self.lock:
+            while self.local_heap:
+                priority, seq, task = heappop(self.local_heap)
+                self.write_buffer.append((task, priority, None))
+        self.flush()
+        self.backend.close()
@@ -0,0 +1,182 @@
+"""
+This module contains token bucket rate limiter. It is used inside
+Grab::Spider to limit the rate of network requests globally, per host
+and per task name.
+
+The limiter never blocks. It answers the question how long the
+task has to wait before it could be sent to the network. The token of the
+delayed task is reserved at once in the bucket which delays the task:
+the bucket goes into debt, so each delayed task gets its own time slot.
+Other buckets are charged when the delayed task is about to be sent.
+Each bucket could reserve only limited number of tokens in advance.
+"""
+import time
+from six.moves.urllib.parse import urlsplit
+
+# When number of per-host buckets exceeds this limit then
+# buckets which are full (i.e. host is idle) are dropped
+HOST_BUCKET_CLEANUP_LIMIT = 10000
+DEFAULT_BACKLOG = 100
+
+
+class TokenBucket(object):
+    __slots__ = ('rate', 'capacity', 'tokens', 'timestamp')
+
+    def __init__(self, rate, capacity=1):
+        """
+        :param rate: number of tokens added to the bucket each second
+        :param capacity: max. number of tokens in the bucket i.e. the size
+            of burst. By default there is no burst: requests are spread
+            evenly over time.
+        """
+
+        self.rate = float(rate)
+        self.capacity = float(capacity)
+        self.tokens = self.capacity
+        self.timestamp = time.time()
+
+    def refill(self, now):
+        if now > self.timestamp:
+            self.tokens = min(self.capacity,
+                              self.tokens + (now - self.timestamp) * self.rate)
+        self.timestamp = now
+
+    def get_delay(self, now, tokens=1):
+        """
+        Return number of seconds to wait until the bucket has
+        `tokens` tokens. The number of tokens is negative if tokens
+        have been reserved in advance.
+        """
+
+        self.refill(now)
+        if self.tokens >= tokens:
+            return 0
+        else:
+            return (tokens - self.tokens) / self.rate
+
+    def consume(self):
+        self.tokens -= 1
+
+    def is_full(self, now):
+        self.refill(now)
+        return self.tokens >= self.capacity
+
+
+class RateLimiter(object):
+    def __init__(self, rps=None, host_rps=None, task_rps=None,
+                 hosts=None, tasks=None, burst=1, backlog=DEFAULT_BACKLOG):
+        """
+        :param rps: global limit of requests per second
+        :param host_rps: limit of requests per second for each host
+        :param task_rps: limit of requests per second for each task name
+        :param hosts: dict of limits for specific hosts, it overrides
+            `host_rps` value
+        :param tasks: dict of limits for specific task names, it overrides
+            `task_rps` value
+        :param burst: number of requests which could be sent at once
+            if the bucket was not used for some time
+        :param backlog: max. number of tokens which each bucket could
+            reserve for delayed requests
+        """
+
+        self.burst = burst
+        self.backlog = backlog
+        self.global_bucket = TokenBucket(rps, burst) if rps else None
+        self.host_rps = host_rps
+        self.task_rps = task_rps
+        self.host_limits = hosts or {}
+        self.task_limits = tasks or {}
+        self.host_buckets = {}
+        self.task_buckets = {}
+
+    def get_host_bucket(self, host, now):
+        try:
+            return self.host_buckets[host]
+        except KeyError:
+            rate = self.host_limits.get(host, self.host_rps)
+            if not rate:
+                return None
+            if len(self.host_buckets) > HOST_BUCKET_CLEANUP_LIMIT:
+                self.cleanup_host_buckets(now)
+            bucket = self.host_buckets[host] = TokenBucket(rate, self.burst)
+            return bucket
+
+    def cleanup_host_buckets(self, now):
+        for host, bucket in list(self.host_buckets.items()):
+            if bucket.is_full(now):
+                del self.host_buckets[host]
+
+    def get_task_bucket(self, name):
+        try:
+            return self.task_buckets[name]
+        except KeyError:
+            rate = self.task_limits.get(name, self.task_rps)
+            if not rate:
+                return None
+            bucket = self.task_buckets[name] = TokenBucket(rate, self.burst)
+            return bucket
+
+    def find_buckets(self, task, now):
+        buckets = []
+        if self.global_bucket is not None:
+            buckets.append(self.global_bucket)
+        if self.host_rps or self.host_limits:
+            host = urlsplit(task.url).hostname
+            bucket = self.get_host_bucket(host, now)
+            if bucket is not None:
+                buckets.append(bucket)
+        if self.task_rps or self.task_limits:
+            bucket = self.get_task_bucket(task.name)
+            if bucket is not None:
+                buckets.append(bucket)
+        return buckets
+
+    def get_backlog_delay(self, task, now=None):
+        """
+        Return number of seconds to wait until all buckets related to
+        the task could reserve one more token, 0 if they could do it now.
+        """
+
+        if now is None:
+            now = time.time()
+        delay = 0
+        for bucket in self.find_buckets(task, now):
+            delay = max(delay, bucket.get_delay(now, 1 - self.backlog))
+        return delay
+
+    def acquire(self, task, now=None, buckets=None):
+        """
+        Take tokens required to send network request for the task.
+
+        If some bucket has no free tokens then only the bucket which
+        delays the task most reserves the token in advance: the number of
+        tokens becomes negative. Other buckets are not charged until the
+        task is ready to be sent.
+
+        Returns tuple (delay, buckets). Delay is 0 if the request could be
+        sent now or number of seconds the task should be delayed for.
+        When the delay passes `acquire` must be called again with
+        returned buckets which have not been charged yet.
+
+        :param buckets: buckets returned by previous call, by default
+            all buckets related to the task are charged
+        """
+
+        if now is None:
+            now = time.time()
+        if buckets is None:
+            buckets = self.find_buckets(task, now)
+        delay = 0
+        slot_bucket = None
+        for bucket in buckets:
+            bucket_delay = bucket.get_delay(now)
+            if bucket_delay > delay:
+                delay = bucket_delay
+                slot_bucket = bucket
+        if slot_bucket is None:
+            for bucket in buckets:
+                bucket.consume()
+            return 0, []
+        else:
+            slot_bucket.consume()
+            return delay, [x for x in buckets if x is not slot_bucket]
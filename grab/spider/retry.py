@@ -0,0 +1,121 @@
+"""
+This module contains the policy which decides how long the spider waits
+before it repeats the network request which has failed.
+
+Delay grows exponentially with the number of network tries of the task.
+Each class of errors has its own curve. Random jitter is applied to delay
+to spread out retries of tasks which failed at the same time. If server
+responds with `Retry-After` header then the delay is not less than
+the value of the header.
+"""
+from email.utils import parsedate_tz, mktime_tz
+import random
+import time
+
+import pycurl
+
+# Error class -> (base delay, factor, max delay)
+DEFAULT_RETRY_CURVES = {
+    'timeout': (2, 2, 300),
+    'connect': (5, 3, 600),
+    'network': (1, 2, 120),
+    'http-429': (10, 2, 600),
+    'http-5xx': (5, 2, 600),
+    'http-error': (1, 2, 60),
+}
+DEFAULT_JITTER = 0.2
+DEFAULT_MAX_RETRY_AFTER = 3600
+CONNECT_ERROR_CODES = (pycurl.E_COULDNT_RESOLVE_HOST,
+                       pycurl.E_COULDNT_RESOLVE_PROXY,
+                       pycurl.E_COULDNT_CONNECT)
+
+
+def get_error_class(res):
+    """
+    Return the name of error class of failed network result.
+    """
+
+    if res.ok:
+        code = res.grab.response.code
+        if code == 429:
+            return 'http-429'
+        elif code >= 500:
+            return 'http-5xx'
+        else:
+            return 'http-error'
+    else:
+        if res.ecode == pycurl.E_OPERATION_TIMEOUTED:
+            return 'timeout'
+        elif res.ecode in CONNECT_ERROR_CODES:
+            return 'connect'
+        else:
+            return 'network'
+
+
+def parse_retry_after(value, now=None):
+    """
+    Convert value of `Retry-After` header to the number of seconds.
+
+    Returns None if value could not be parsed.
+    """
+
+    value = value.strip()
+    if value.isdigit():
+        return int(value)
+    date = parsedate_tz(value)
+    if date is None:
+        return None
+    if now is None:
+        now = time.time()
+    return max(0, mktime_tz(date) - now)
+
+
+class RetryPolicy(object):
+    def __init__(self, curves=None, jitter=DEFAULT_JITTER,
+                 retry_after=True, max_retry_after=DEFAULT_MAX_RETRY_AFTER):
+        """
+        :param curves: dict which maps error class to the tuple
+            (base delay, factor, max delay), it updates default curves.
+            Error classes are: timeout, connect, network, http-429,
+            http-5xx, http-error.
+        :param jitter: max. share of delay which is randomly added to
+            or subtracted from the delay
+        :param retry_after: if True then `Retry-After` header is respected
+        :param max_retry_after: max. delay which could be set by
+            `Retry-After` header
+        """
+
+        self.curves = dict(DEFAULT_RETRY_CURVES)
+        if curves:
+            self.curves.update(curves)
+        self.jitter = jitter
+        self.retry_after = retry_after
+        self.max_retry_after = max_retry_after
+
+    def get_retry_after(self, res):
+        if res.ok and res.grab.response.headers is not None:
+            value = res.grab.response.headers.get('Retry-After')
+            if value:
+                delay = parse_retry_after(value)
+                if delay is not None:
+                    return min(delay, self.max_retry_after)
+        return None
+
+    def get_delay(self, res, error_class=None):
+        """
+        Return number of seconds to wait before the task of failed
+        network result is sent to network again.
+        """
+
+        if error_class is None:
+            error_class = get_error_class(res)
+        base_delay, factor, max_delay = self.curves[error_class]
+        try_number = max(1, res.task.network_try_count)
+        delay = min(max_delay, base_delay * factor ** (try_number - 1))
+        if self.jitter:
+            delay *= 1 + random.uniform(-self.jitter, self.jitter)
+        if self.retry_after:
+            retry_after = self.get_retry_after(res)
+            if retry_after is not None:
+                delay = max(delay, retry_after)
+        return delay
@@ -0,0 +1,88 @@
+"""
+This module contains functions which transfer response bodies to parser
+processes through shared memory.
+
+In `mp_mode` network results are pickled and sent to parser processes
+through `multiprocessing.Queue`. Big response bodies are copied into
+shared memory segments and only names of segments travel through
+the queue. The parser process reads the body from the segment and
+destroys the segment.
+"""
+import copy
+import os
+
+try:
+    from multiprocessing import shared_memory, resource_tracker
+except ImportError:
+    # python < 3.8
+    shared_memory = None
+
+DEFAULT_SHARED_BODY_MIN_SIZE = 64 * 1024
+
+
+def is_shared_body_supported():
+    return shared_memory is not None
+
+
+def prepare_shared_body():
+    """
+    Start the resource tracker of shared memory segments.
+
+    Must be called before parser processes are forked. Otherwise
+    each process starts its own tracker and the tracker of the process
+    which has created the segment does not know that the segment has been
+    destroyed by the parser process.
+    """
+
+    if os.name == 'posix':
+        resource_tracker.ensure_running()
+
+
+def export_result_body(result, min_size):
+    """
+    Put response body of the network result into shared memory segment.
+
+    The original result is not modified because its Grab instance could
+    be used at the same time by the cache pipeline. Returns new result
+    which refers to the segment or the original result if the body
+    is too small or the segment could not be created.
+    """
+
+    grab = result.grab
+    doc = grab.doc
+    body = doc._bytes_body
+    if doc.body_path or body is None or len(body) < min_size:
+        return result
+    try:
+        shm = shared_memory.SharedMemory(create=True, size=len(body))
+    except OSError:
+        return result
+    try:
+        shm.buf[:len(body)] = body
+    finally:
+        shm.close()
+    # Shallow copies without body, the body is not pickled
+    new_doc = copy.copy(doc)
+    new_doc._bytes_body = None
+    new_grab = copy.copy(grab)
+    new_grab.doc = new_doc
+    new_result = result.copy()
+    new_result.grab = new_grab
+    new_result.shared_body = (shm.name, len(body))
+    return new_result
+
+
+def import_result_body(result):
+    """
+    Load response body of the network result from shared memory
+    segment and destroy the segment.
+    """
+
+    name, size = result.shared_body
+    result.shared_body = None
+    shm = shared_memory.SharedMemory(name=name)
+    try:
+        result.grab.doc.body = bytes(shm.buf[:size])
+    finally:
+        shm.close()
+        shm.unlink()
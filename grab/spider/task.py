@@ -6,14 +6,30 @@ from grab.base import copy_config
 
 
 class BaseTask(object):
-    pass
+    __slots__ = ()
 
 
 class Task(BaseTask):
     """
     Task for spider.
+
+    Standard attributes of the task are stored in slots. Custom attributes
+    are stored in the dict which is created only when the task gets first
+    custom attribute. URL-only tasks do not have Grab config at all,
+    the list of coroutines is created on first access.
     """
 
+    __slots__ = (
+        'name', 'url', '_grab_config',
+        'priority', 'priority_is_custom',
+        'network_try_count', 'task_try_count',
+        'disable_cache', 'refresh_cache',
+        'valid_status', 'use_proxylist', 'cache_timeout',
+        'schedule_time', 'original_delay',
+        'raw', 'callback', 'fallback_name', 'disable_url_filter',
+        'queue_lease', '_coroutines_stack', '_extra',
+    )
+
     def __init__(self, name=None, url=None, grab=None, grab_config=None,
                  priority=None, priority_is_custom=True,
                  network_try_count=0, task_try_count=1,
@@ -21,7 +37,7 @@ class Task(BaseTask):
                  valid_status=[], use_proxylist=True,
                  cache_timeout=None, delay=0,
                  raw=False, callback=None,
-                 fallback_name=None,
+                 fallback_name=None, disable_url_filter=False,
                  **kwargs):
         """
         Create `Task` object.
@@ -84,6 +100,9 @@ class Task(BaseTask):
                 raised if such 'task_*' handler does not exist.
             :param fallback_name: the name of method that is called when spider
                 gives up to do the task (due to multiple network errors)
+            :param disable_url_filter: if `True` then the task is not checked
+                with URL filter configured via `setup_url_filter` method of
+                spider
 
             Any non-standard named arguments passed to `Task` constructor will
             be saved as attributes of the object. You can get their values
@@ -98,6 +117,8 @@ class Task(BaseTask):
             # generates new tasks
             raise SpiderMisuseError('Task name could not be "generator"')
 
+        self._extra = None
+        self._coroutines_stack = None
         self.name = name
 
         if url is None and grab is None and grab_config is None:
@@ -117,7 +138,8 @@ class Task(BaseTask):
                 'Options grab and grab_config could not be used together')
 
         if grab:
-            self.setup_grab_config(grab.dump_config())
+            # `dump_config` already returns a private copy of config
+            self.setup_grab_config(grab.dump_config(), copy=False)
         elif grab_config:
             self.setup_grab_config(grab_config)
         else:
@@ -138,10 +160,62 @@ class Task(BaseTask):
         self.cache_timeout = cache_timeout
         self.raw = raw
         self.callback = callback
-        self.coroutines_stack = []
+        self.disable_url_filter = disable_url_filter
+        # Set by the queue backend which gives out tasks on lease
+        self.queue_lease = None
         for key, value in kwargs.items():
             setattr(self, key, value)
 
+    def __getattr__(self, key):
+        # Called only for attributes which are not found in slots
+        extra = object.__getattribute__(self, '_extra')
+        if extra is not None:
+            try:
+                return extra[key]
+            except KeyError:
+                pass
+        raise AttributeError(key)
+
+    def __setattr__(self, key, value):
+        try:
+            object.__setattr__(self, key, value)
+        except AttributeError:
+            if self._extra is None:
+                self._extra = {}
+            self._extra[key] = value
+
+    def __delattr__(self, key):
+        try:
+            object.__delattr__(self, key)
+        except AttributeError:
+            if self._extra is None or key not in self._extra:
+                raise
+            del self._extra[key]
+
+    def __getstate__(self):
+        return self.dump_attrs()
+
+    def __setstate__(self, state):
+        self.load_attrs(state)
+
+    def get_grab_config(self):
+        return self._grab_config
+
+    def set_grab_config(self, val):
+        self._grab_config = val
+
+    grab_config = property(get_grab_config, set_grab_config)
+
+    def get_coroutines_stack(self):
+        if self._coroutines_stack is None:
+            self._coroutines_stack = []
+        return self._coroutines_stack
+
+    def set_coroutines_stack(self, val):
+        self._coroutines_stack = val
+
+    coroutines_stack = property(get_coroutines_stack, set_coroutines_stack)
+
     def get(self, key, default=None):
         """
         Return value of attribute or None if such attribute
@@ -149,6 +223,41 @@ class Task(BaseTask):
         """
         return getattr(self, key, default)
 
+    def dump_attrs(self):
+        """
+        Return dict with all attributes of the task including custom ones.
+
+        The list of coroutines is included only if it has been created.
+        """
+
+        attrs = {}
+        for key in Task.__slots__:
+            if key[0] != '_':
+                attrs[key] = getattr(self, key)
+        attrs['grab_config'] = self._grab_config
+        if self._coroutines_stack is not None:
+            attrs['coroutines_stack'] = self._coroutines_stack
+        if self._extra:
+            attrs.update(self._extra)
+        # Attributes of subclasses which do not define `__slots__`
+        attrs.update(getattr(self, '__dict__', {}))
+        return attrs
+
+    def load_attrs(self, attrs):
+        """
+        Set attributes of the task from dict produced by `dump_attrs` method.
+
+        Constructor checks are not applied. It is used to restore the task
+        from pickled or encoded data.
+        """
+
+        self._extra = None
+        self._coroutines_stack = None
+        self._grab_config = None
+        self.queue_lease = None
+        for key, value in attrs.items():
+            setattr(self, key, value)
+
     def process_delay_option(self, delay):
         if delay:
             self.schedule_time = datetime.utcnow() + timedelta(seconds=delay)
@@ -157,8 +266,10 @@ class Task(BaseTask):
             self.schedule_time = None
             self.original_delay = None
 
-    def setup_grab_config(self, grab_config):
-        self.grab_config = copy_config(grab_config)
+    def setup_grab_config(self, grab_config, copy=True):
+        if copy:
+            grab_config = copy_config(grab_config)
+        self.grab_config = grab_config
         self.url = grab_config['url']
 
     def clone(self, **kwargs):
@@ -169,7 +280,7 @@ class Task(BaseTask):
         """
 
         # First, create exact copy of the current Task object
-        attr_copy = self.__dict__.copy()
+        attr_copy = self.dump_attrs()
         if attr_copy.get('grab_config') is not None:
             del attr_copy['url']
         task = Task(**attr_copy)
@@ -184,6 +295,7 @@ class Task(BaseTask):
             task.refresh_cache = False
         if 'disable_cache' not in kwargs:
             task.disable_cache = False
+        task.queue_lease = None
 
         if kwargs.get('url') is not None and kwargs.get('grab') is not None:
             raise SpiderMisuseError('Options url and grab could not be '
@@ -200,7 +312,7 @@ class Task(BaseTask):
                                     'be used together')
 
         if kwargs.get('grab'):
-            task.setup_grab_config(kwargs['grab'].dump_config())
+            task.setup_grab_config(kwargs['grab'].dump_config(), copy=False)
             del kwargs['grab']
         elif kwargs.get('grab_config'):
             task.setup_grab_config(kwargs['grab_config'])
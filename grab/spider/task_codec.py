@@ -0,0 +1,134 @@
+"""
+This module contains compact binary serialization of `Task` objects.
+It is used by persistent task queue backends.
+
+Pickled `Task` contains all its attributes and the full copy of Grab config
+including cookie objects, so it often takes few kilobytes. Encoded task
+contains only:
+
+* attributes which values differ from defaults of `Task` constructor
+* items of `grab_config` which values differ from the default Grab config,
+  the URL is not saved twice
+* cookies as tuples of their fields
+
+Data produced by `pickle.dumps(task)` is decoded too.
+"""
+from six.moves import http_cookiejar
+from six.moves import intern
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+from grab.base import default_config
+from grab.spider.task import Task
+
+CODEC_VERSION = 1
+# Arguments of `cookielib.Cookie` constructor and
+# names of attributes which store them
+COOKIE_FIELDS = (
+    ('version', 'version'),
+    ('name', 'name'),
+    ('value', 'value'),
+    ('port', 'port'),
+    ('port_specified', 'port_specified'),
+    ('domain', 'domain'),
+    ('domain_specified', 'domain_specified'),
+    ('domain_initial_dot', 'domain_initial_dot'),
+    ('path', 'path'),
+    ('path_specified', 'path_specified'),
+    ('secure', 'secure'),
+    ('expires', 'expires'),
+    ('discard', 'discard'),
+    ('comment', 'comment'),
+    ('comment_url', 'comment_url'),
+    ('rest', '_rest'),
+    ('rfc2109', 'rfc2109'),
+)
+# Attributes which are always dropped
+SKIP_ATTRS = ('grab_config', 'queue_lease')
+# Attributes with mutable default values
+MUTABLE_ATTRS = ('valid_status',)
+# Values of these attributes are repeated in many tasks
+INTERN_ATTRS = ('name', 'fallback_name')
+TASK_DEFAULTS = dict((key, val) for key, val
+                     in Task(url='').dump_attrs().items()
+                     if key not in SKIP_ATTRS)
+CONFIG_DEFAULTS = default_config()
+
+
+def encode_cookie(cookie):
+    return tuple(getattr(cookie, x[1]) for x in COOKIE_FIELDS)
+
+
+def decode_cookie(fields):
+    return http_cookiejar.Cookie(**dict(
+        (x[0], y) for x, y in zip(COOKIE_FIELDS, fields)))
+
+
+def encode_grab_config(config):
+    delta = {}
+    for key, val in config.items():
+        if key in ('url', 'state'):
+            continue
+        if key not in CONFIG_DEFAULTS or CONFIG_DEFAULTS[key] != val:
+            delta[key] = val
+    state = dict(config.get('state') or {})
+    cookies = state.pop('cookiejar_cookies', None)
+    if cookies is not None:
+        cookies = [encode_cookie(x) for x in cookies]
+    return delta, state, cookies
+
+
+def decode_grab_config(data, url):
+    delta, state, cookies = data
+    config = default_config()
+    config.update(delta)
+    config['url'] = url
+    if cookies is not None:
+        state['cookiejar_cookies'] = [decode_cookie(x) for x in cookies]
+    config['state'] = state
+    return config
+
+
+def encode_task(task):
+    """
+    Return bytes with compact representation of the task.
+    """
+
+    attrs = {}
+    for key, val in task.dump_attrs().items():
+        if key in SKIP_ATTRS:
+            continue
+        if key not in TASK_DEFAULTS or TASK_DEFAULTS[key] != val:
+            attrs[key] = val
+    if task.grab_config is None:
+        config = None
+    else:
+        config = encode_grab_config(task.grab_config)
+    return pickle.dumps((CODEC_VERSION, attrs, config),
+                        pickle.HIGHEST_PROTOCOL)
+
+
+def decode_task(data):
+    """
+    Build `Task` object from data produced by `encode_task` function
+    or by pickling of the task.
+    """
+
+    obj = pickle.loads(data)
+    if isinstance(obj, Task):
+        return obj
+    version, attrs, config = obj
+    state = TASK_DEFAULTS.copy()
+    for key in MUTABLE_ATTRS:
+        state[key] = list(TASK_DEFAULTS[key])
+    for key, val in attrs.items():
+        if key in INTERN_ATTRS and isinstance(val, str):
+            val = intern(val)
+        state[intern(key)] = val
+    task = Task.__new__(Task)
+    task.load_attrs(state)
+    if config is not None:
+        task.grab_config = decode_grab_config(config, task.url)
+    return task
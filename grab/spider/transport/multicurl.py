@@ -1,9 +1,18 @@
 import pycurl
 import select
+import socket
+import time
 import six
 from threading import Lock
+try:
+    import selectors
+except ImportError:
+    # Python 2.x does not have `selectors` module so the event loop mode
+    # is not available there
+    selectors = None
 
 from grab.error import GrabTooManyRedirectsError
+from grab.spider.network_result import NetworkResult
 
 ERROR_TOO_MANY_REFRESH_REDIRECTS = -2
 #ERROR_INTERNAL_GRAB_ERROR = -3
@@ -15,17 +24,63 @@ for key in dir(pycurl):
     if key.startswith('E_'):
         abbr = key[2:].lower().replace('_', '-')
         ERROR_ABBR[getattr(pycurl, key)] = abbr
+# Marks selector keys which belong to curl sockets
+CURL_SOCKET = 'curl-socket'
+
+
+def is_event_loop_supported():
+    return selectors is not None
+
+
+class Waker(object):
+    """
+    Self-pipe which allows other threads (and processes forked
+    from the main process) to interrupt waiting of the event loop.
+    """
+
+    def __init__(self):
+        self.reader, self.writer = socket.socketpair()
+        self.reader.setblocking(False)
+        self.writer.setblocking(False)
+
+    def fileno(self):
+        return self.reader.fileno()
+
+    def wake(self):
+        try:
+            self.writer.send(b'x')
+        except (socket.error, OSError):
+            # Socket buffer is full. It means that the event loop
+            # has not processed previous wake-ups yet. That is OK.
+            pass
+
+    def drain(self):
+        try:
+            while self.reader.recv(4096):
+                pass
+        except (socket.error, OSError):
+            pass
+
+    def close(self):
+        self.reader.close()
+        self.writer.close()
 
 
 class MulticurlTransport(object):
-    def __init__(self, socket_number):
+    def __init__(self, socket_number, event_loop=False):
         self.socket_number = socket_number
+        # Number of curl handles which are allowed to be used at once,
+        # it could be changed at run-time but not above `socket_number`
+        self.stream_limit = socket_number
         self.multi = pycurl.CurlMulti()
         self.multi.handles = []
         self.freelist = []
         self.registry = {}
         self.connection_count = {}
         self.network_op_lock = Lock()
+        self.event_loop = event_loop
+        if self.event_loop:
+            self.setup_event_loop()
 
         # Create curl instances
         for x in six.moves.range(self.socket_number):
@@ -34,11 +89,88 @@ class MulticurlTransport(object):
             self.freelist.append(curl)
             # self.multi.handles.append(curl)
 
+    def setup_event_loop(self):
+        """
+        Configure multicurl to report about its sockets and timeouts
+        via callbacks. The sockets are watched with the selector
+        (epoll/kqueue/etc, it depends on the OS).
+        """
+
+        self.selector = selectors.DefaultSelector()
+        self.waker = Waker()
+        self.selector.register(self.waker.reader, selectors.EVENT_READ)
+        self.curl_sockets = set()
+        self.timer_deadline = None
+        self.multi.setopt(pycurl.M_SOCKETFUNCTION, self.handle_socket_event)
+        self.multi.setopt(pycurl.M_TIMERFUNCTION, self.handle_timer_event)
+
+    def handle_socket_event(self, event, sock_fd, multi, data):
+        # Selector does not accept empty event mask: the socket which
+        # curl does not want to watch is removed from the selector and
+        # it is registered again with the next event
+        if event in (pycurl.POLL_NONE, pycurl.POLL_REMOVE):
+            if sock_fd in self.curl_sockets:
+                self.curl_sockets.discard(sock_fd)
+                try:
+                    self.selector.unregister(sock_fd)
+                except (KeyError, ValueError, OSError):
+                    pass
+        else:
+            mask = 0
+            if event in (pycurl.POLL_IN, pycurl.POLL_INOUT):
+                mask |= selectors.EVENT_READ
+            if event in (pycurl.POLL_OUT, pycurl.POLL_INOUT):
+                mask |= selectors.EVENT_WRITE
+            if sock_fd in self.curl_sockets:
+                try:
+                    self.selector.modify(sock_fd, mask, CURL_SOCKET)
+                    return
+                except (KeyError, ValueError, OSError):
+                    # The socket has been closed without POLL_REMOVE
+                    # notification and its descriptor has been reused
+                    self.curl_sockets.discard(sock_fd)
+            try:
+                self.selector.register(sock_fd, mask, CURL_SOCKET)
+            except KeyError:
+                self.selector.unregister(sock_fd)
+                self.selector.register(sock_fd, mask, CURL_SOCKET)
+            self.curl_sockets.add(sock_fd)
+
+    def handle_timer_event(self, timeout_ms):
+        if timeout_ms < 0:
+            self.timer_deadline = None
+        else:
+            self.timer_deadline = time.time() + timeout_ms / 1000.0
+
+    def register_wakeup_source(self, fileobj):
+        """
+        Register extra object (anything with `fileno` method) which
+        interrupts the waiting of event loop when it becomes readable.
+        """
+
+        self.selector.register(fileobj, selectors.EVENT_READ)
+
+    def wake(self):
+        if self.event_loop:
+            self.waker.wake()
+
+    def close(self):
+        if self.event_loop:
+            self.multi.setopt(pycurl.M_SOCKETFUNCTION, lambda *args: None)
+            self.multi.setopt(pycurl.M_TIMERFUNCTION, lambda *args: None)
+            self.selector.close()
+            self.waker.close()
+
+    def set_stream_limit(self, number):
+        self.stream_limit = max(1, min(number, self.socket_number))
+
     def ready_for_task(self):
-        return len(self.freelist)
+        return self.get_free_threads_number()
 
     def get_free_threads_number(self):
-        return len(self.freelist)
+        return max(0, min(len(self.freelist),
+                          self.stream_limit
+                          - self.get_active_threads_number()))
 
     def get_active_threads_number(self):
         return self.socket_number - len(self.freelist)
@@ -81,7 +213,52 @@ class MulticurlTransport(object):
         finally:
             self.network_op_lock.release()
 
-    def process_handlers(self):
+    def process_handlers(self, timeout=0):
+        """
+        Do network operations.
+
+        In event loop mode the method sleeps until some curl socket is ready,
+        the curl timer is expired, the loop is waked up or `timeout`
+        seconds passed. In polling mode the `timeout` argument is ignored.
+        """
+
+        if self.event_loop:
+            self.process_socket_events(timeout)
+        else:
+            self.process_fdset()
+
+    def socket_action(self, sock_fd, ev_bitmask):
+        while True:
+            status, active_objects = self.multi.socket_action(sock_fd,
+                                                              ev_bitmask)
+            if status != pycurl.E_CALL_MULTI_PERFORM:
+                break
+
+    def process_socket_events(self, timeout):
+        if self.timer_deadline is not None:
+            timeout = min(timeout, max(0, self.timer_deadline - time.time()))
+        events = self.selector.select(timeout)
+        self.network_op_lock.acquire()
+        try:
+            for key, mask in events:
+                if key.data is CURL_SOCKET:
+                    if key.fd in self.curl_sockets:
+                        ev_bitmask = 0
+                        if mask & selectors.EVENT_READ:
+                            ev_bitmask |= pycurl.CSELECT_IN
+                        if mask & selectors.EVENT_WRITE:
+                            ev_bitmask |= pycurl.CSELECT_OUT
+                        self.socket_action(key.fd, ev_bitmask)
+                elif key.fileobj is self.waker.reader:
+                    self.waker.drain()
+            if (self.timer_deadline is not None
+                    and self.timer_deadline <= time.time()):
+                self.timer_deadline = None
+                self.socket_action(pycurl.SOCKET_TIMEOUT, 0)
+        finally:
+            self.network_op_lock.release()
+
+    def process_fdset(self):
         # Ok, frankly I have really bad understanding of
         # how to deal with multicurl sockets ;-)
         # It is a sort of miracle that Grab actually works
@@ -136,7 +313,6 @@ class MulticurlTransport(object):
                     results.append((False, curl, ecode, emsg))
 
             for ok, curl, ecode, emsg in results:
-                # FORMAT: {ok, grab, grab_config_backup, task, emsg}
 
                 curl_id = id(curl)
                 task = self.registry[curl_id]['task']
@@ -167,13 +343,9 @@ class MulticurlTransport(object):
                     error_abbr = None
                 else:
                     error_abbr = ERROR_ABBR.get(ecode, 'unknown-%d' % ecode)
-                yield {'ok': ok,
-                       'ecode': ecode,
-                       'emsg': emsg,
-                       'error_abbr': error_abbr,
-                       'grab': grab,
-                       'grab_config_backup': grab_config_backup,
-                       'task': task}
+                yield NetworkResult(ok, task, grab, grab_config_backup,
+                                    ecode=ecode, emsg=emsg,
+                                    error_abbr=error_abbr)
 
                 self.multi.remove_handle(curl)
                 curl.reset()
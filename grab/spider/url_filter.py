@@ -0,0 +1,111 @@
+"""
+This module contains the filter of URLs which have been seen already.
+It is used by `Spider.add_task` to drop duplicate tasks.
+"""
+from fnmatch import fnmatch
+from hashlib import md5
+import struct
+
+from six.moves.urllib.parse import (urlsplit, urlunsplit, parse_qsl,
+                                    urlencode)
+from weblib.encoding import make_str
+
+DEFAULT_PORTS = {'http': 80, 'https': 443, 'ftp': 21}
+# Share of URLs which are also checked with exact set to count
+# false positives of the filter
+DEFAULT_FP_SAMPLE_RATE = 0.001
+
+
+def canonicalize_url(url, keep_fragment=False, sort_query=True,
+                     remove_params=None):
+    """
+    Convert URL to the form which is used to compare URLs.
+
+    * scheme and host are lower-cased
+    * default port is removed
+    * empty path is replaced with "/"
+    * query arguments are sorted
+    * fragment is removed
+
+    :param remove_params: list of names of query arguments which should
+        be removed, names could contain shell-style wildcards e.g. "utm_*"
+    """
+
+    parts = urlsplit(url)
+    scheme = parts.scheme.lower()
+    netloc = parts.netloc
+    if parts.hostname:
+        host = parts.hostname
+        if ':' in host:
+            # IPv6 address
+            host = '[%s]' % host
+        if parts.port and parts.port != DEFAULT_PORTS.get(scheme):
+            host = '%s:%d' % (host, parts.port)
+        userinfo = netloc.rpartition('@')[0]
+        netloc = '%s@%s' % (userinfo, host) if userinfo else host
+    path = parts.path or '/'
+    query = parts.query
+    if query and (sort_query or remove_params):
+        args = parse_qsl(query, keep_blank_values=True)
+        if remove_params:
+            args = [x for x in args
+                    if not any(fnmatch(x[0], y) for y in remove_params)]
+        if sort_query:
+            args.sort()
+        query = urlencode(args)
+    fragment = parts.fragment if keep_fragment else ''
+    return urlunsplit((scheme, netloc, path, query, fragment))
+
+
+class UrlFilter(object):
+    def __init__(self, backend, stat, canonicalizer=canonicalize_url,
+                 fp_sample_rate=DEFAULT_FP_SAMPLE_RATE):
+        """
+        :param backend: instance of URL filter backend
+        :param stat: `Stat` instance to count duplicates and
+            false positives
+        :param canonicalizer: function which converts URL to the
+            canonical form
+        :param fp_sample_rate: share of URLs which are also stored in the
+            exact set of hashes. When the filter tells that URL from the
+            sample has been seen before but the set does not contain it
+            then the false positive is counted. Use 0 to disable.
+            The check is not correct for filters which are shared with
+            other spiders or restored from previous run.
+        """
+
+        self.backend = backend
+        self.canonicalizer = canonicalizer
+        self.fp_sample_rate = fp_sample_rate
+        self.fp_sample_limit = int(fp_sample_rate * 2 ** 64)
+        self.fp_sample = set()
+        self.stat = stat
+
+    def is_seen(self, url):
+        """
+        Remember the URL and tell if it has been seen before.
+        """
+
+        key = make_str(self.canonicalizer(url))
+        seen = self.backend.add(key)
+        if self.fp_sample_limit:
+            key_hash = struct.unpack('<Q', md5(key).digest()[:8])[0]
+            if key_hash < self.fp_sample_limit:
+                if seen:
+                    if key_hash not in self.fp_sample:
+                        # The filter made a mistake
+                        self.stat.inc('spider:url-filter-false-positive')
+                        self.fp_sample.add(key_hash)
+                else:
+                    self.fp_sample.add(key_hash)
+                self.stat.inc('spider:url-filter-sample')
+        if seen:
+            self.stat.inc('spider:url-filter-duplicate')
+        return seen
+
+    def clear(self):
+        self.backend.clear()
+        self.fp_sample = set()
+
+    def close(self):
+        self.backend.close()
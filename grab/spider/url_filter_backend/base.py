@@ -0,0 +1,147 @@
+"""
+UrlFilterInterface defines interface of URL filter backend.
+
+This module also contains Bloom filter which is used by
+memory and disk backends.
+"""
+from hashlib import md5
+import math
+import struct
+
+import six
+
+
+class UrlFilterInterface(object):
+    def __init__(self, spider_name, **kwargs):
+        pass
+
+    def add(self, key):
+        """
+        Add the key (byte string) to the filter.
+
+        Returns True if the key has been added before. Filters based on
+        Bloom filter could also return True for the key which has not been
+        added (false positive).
+        """
+        raise NotImplementedError
+
+    def clear(self):
+        """Remove all keys from the filter."""
+        raise NotImplementedError
+
+    def close(self):
+        """Release resources used by the filter."""
+        pass
+
+
+def get_bloom_size(capacity, error_rate):
+    """
+    Return number of bits and number of hash functions of Bloom filter
+    which could hold `capacity` keys with given false positive rate.
+    """
+
+    bits_number = int(math.ceil(-capacity * math.log(error_rate)
+                                / (math.log(2) ** 2)))
+    hash_number = max(1, int(round(float(bits_number) / capacity
+                                   * math.log(2))))
+    return bits_number, hash_number
+
+
+def get_bit_positions(key, bits_number, hash_number):
+    # Enhanced double hashing, it does not produce short cycles
+    # of positions when step has common divisor with number of bits
+    h1, h2 = struct.unpack('<QQ', md5(key).digest())
+    pos = h1 % bits_number
+    step = h2 % bits_number
+    positions = []
+    for x in six.moves.range(hash_number):
+        positions.append(pos)
+        pos = (pos + step) % bits_number
+        step = (step + x) % bits_number
+    return positions
+
+
+class BloomFilter(object):
+    """
+    Bloom filter stored in the buffer which could be `bytearray`
+    or `mmap` object.
+    """
+
+    def __init__(self, bits_number, hash_number, buf=None, offset=0):
+        self.bits_number = bits_number
+        self.hash_number = hash_number
+        if buf is None:
+            buf = bytearray((bits_number + 7) // 8)
+        self.buf = buf
+        self.offset = offset
+        self.count = 0
+
+    def contains(self, key):
+        buf = self.buf
+        for pos in get_bit_positions(key, self.bits_number, self.hash_number):
+            idx = self.offset + (pos >> 3)
+            if not six.indexbytes(buf, idx) & (1 << (pos & 7)):
+                return False
+        return True
+
+    def add(self, key):
+        """
+        Add the key to the filter. Returns True if the key
+        is (probably) added before.
+        """
+
+        buf = self.buf
+        seen = True
+        for pos in get_bit_positions(key, self.bits_number, self.hash_number):
+            idx = self.offset + (pos >> 3)
+            byte = six.indexbytes(buf, idx)
+            mask = 1 << (pos & 7)
+            if not byte & mask:
+                seen = False
+                buf[idx:idx + 1] = six.int2byte(byte | mask)
+        if not seen:
+            self.count += 1
+        return seen
+
+
+class ScalableBloomFilter(object):
+    """
+    Sequence of Bloom filters. When the last filter is filled up to its
+    capacity then new filter with double capacity and two times lower
+    false positive rate is created. The total false positive rate
+    does not exceed `2 * error_rate`.
+    """
+
+    def __init__(self, capacity, error_rate, filter_factory):
+        """
+        :param filter_factory: function which accepts number of the filter,
+            number of bits and number of hash functions and returns
+            `BloomFilter` instance
+        """
+
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.filter_factory = filter_factory
+        self.filters = []
+        self.add_filter()
+
+    def get_filter_capacity(self, number):
+        return self.capacity * 2 ** number
+
+    def add_filter(self):
+        number = len(self.filters)
+        bits_number, hash_number = get_bloom_size(
+            self.get_filter_capacity(number),
+            self.error_rate / 2 ** (number + 1))
+        self.filters.append(self.filter_factory(number, bits_number,
+                                                hash_number))
+
+    def add(self, key):
+        for bloom in self.filters[:-1]:
+            if bloom.contains(key):
+                return True
+        seen = self.filters[-1].add(key)
+        if (self.filters[-1].count
+                >= self.get_filter_capacity(len(self.filters) - 1)):
+            self.add_filter()
+        return seen
@@ -0,0 +1,99 @@
+"""
+URL filter backend which stores Bloom filters in files. Files are
+mapped into memory and could be used again by next run of the spider.
+"""
+import mmap
+import os
+import struct
+
+from grab.spider.url_filter_backend.base import (UrlFilterInterface,
+                                                 BloomFilter,
+                                                 ScalableBloomFilter)
+from grab.spider.error import SpiderMisuseError
+
+DEFAULT_CAPACITY = 10000000
+DEFAULT_ERROR_RATE = 0.001
+# File header: number of bits, number of hash functions, number of keys
+HEADER = struct.Struct('<QQQ')
+COUNT_FIELD = struct.Struct('<Q')
+COUNT_OFFSET = 16
+
+
+class DiskBloomFilter(BloomFilter):
+    def __init__(self, path, bits_number, hash_number):
+        if os.path.exists(path):
+            self.file = open(path, 'r+b')
+            buf = mmap.mmap(self.file.fileno(), 0)
+            # Use parameters of existing file
+            bits_number, hash_number, count = HEADER.unpack(
+                buf[:HEADER.size])
+        else:
+            self.file = open(path, 'w+b')
+            self.file.truncate(HEADER.size + (bits_number + 7) // 8)
+            buf = mmap.mmap(self.file.fileno(), 0)
+            buf[:HEADER.size] = HEADER.pack(bits_number, hash_number, 0)
+            count = 0
+        super(DiskBloomFilter, self).__init__(bits_number, hash_number,
+                                              buf=buf, offset=HEADER.size)
+        self.count = count
+
+    def add(self, key):
+        seen = super(DiskBloomFilter, self).add(key)
+        if not seen:
+            self.buf[COUNT_OFFSET:COUNT_OFFSET + COUNT_FIELD.size] =\
+                COUNT_FIELD.pack(self.count)
+        return seen
+
+    def close(self):
+        self.buf.close()
+        self.file.close()
+
+
+class UrlFilterBackend(UrlFilterInterface):
+    def __init__(self, spider_name, path=None, capacity=DEFAULT_CAPACITY,
+                 error_rate=DEFAULT_ERROR_RATE, **kwargs):
+        """
+        :param path: path prefix of filter files, each filter file
+            gets numeric suffix
+        :param capacity: number of keys which could be stored in the first
+            filter file
+        :param error_rate: false positive rate
+        """
+
+        super(UrlFilterBackend, self).__init__(spider_name, **kwargs)
+        if path is None:
+            raise SpiderMisuseError('Disk URL filter requires path option')
+        self.path = path
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.open_filters()
+
+    def get_filter_path(self, number):
+        return '%s.%d' % (self.path, number)
+
+    def create_filter(self, number, bits_number, hash_number):
+        return DiskBloomFilter(self.get_filter_path(number),
+                               bits_number, hash_number)
+
+    def open_filters(self):
+        path_dir = os.path.dirname(self.path)
+        if path_dir and not os.path.exists(path_dir):
+            os.makedirs(path_dir)
+        self.bloom = ScalableBloomFilter(self.capacity, self.error_rate,
+                                         self.create_filter)
+        # Load filters created by previous runs
+        while os.path.exists(self.get_filter_path(len(self.bloom.filters))):
+            self.bloom.add_filter()
+
+    def add(self, key):
+        return self.bloom.add(key)
+
+    def close(self):
+        for bloom in self.bloom.filters:
+            bloom.close()
+
+    def clear(self):
+        self.close()
+        for number in range(len(self.bloom.filters)):
+            os.unlink(self.get_filter_path(number))
+        self.open_filters()
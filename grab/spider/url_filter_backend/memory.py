@@ -0,0 +1,31 @@
+from grab.spider.url_filter_backend.base import (UrlFilterInterface,
+                                                 BloomFilter,
+                                                 ScalableBloomFilter)
+
+DEFAULT_CAPACITY = 1000000
+DEFAULT_ERROR_RATE = 0.001
+
+
+class UrlFilterBackend(UrlFilterInterface):
+    def __init__(self, spider_name, capacity=DEFAULT_CAPACITY,
+                 error_rate=DEFAULT_ERROR_RATE, **kwargs):
+        """
+        :param capacity: number of keys which could be stored in the filter
+            before it grows
+        :param error_rate: false positive rate
+        """
+
+        super(UrlFilterBackend, self).__init__(spider_name, **kwargs)
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.clear()
+
+    def create_filter(self, number, bits_number, hash_number):
+        return BloomFilter(bits_number, hash_number)
+
+    def add(self, key):
+        return self.bloom.add(key)
+
+    def clear(self):
+        self.bloom = ScalableBloomFilter(self.capacity, self.error_rate,
+                                         self.create_filter)
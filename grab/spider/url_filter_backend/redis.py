@@ -0,0 +1,52 @@
+"""
+URL filter backend which stores Bloom filter in redis. Many spiders
+could share one filter. All of them must use same `capacity` and
+`error_rate` options.
+"""
+from __future__ import absolute_import
+from redis import StrictRedis
+
+from grab.spider.url_filter_backend.base import (UrlFilterInterface,
+                                                 get_bloom_size,
+                                                 get_bit_positions)
+from grab.spider.error import SpiderConfigurationError
+
+DEFAULT_CAPACITY = 100000000
+DEFAULT_ERROR_RATE = 0.001
+# Max. size of redis string is 512MB
+MAX_BITS_NUMBER = 2 ** 32
+
+
+class UrlFilterBackend(UrlFilterInterface):
+    def __init__(self, spider_name, key=None, capacity=DEFAULT_CAPACITY,
+                 error_rate=DEFAULT_ERROR_RATE, **kwargs):
+        """
+        All "unexpected" kwargs goes to `redis.StrictRedis()` constructor
+        """
+
+        super(UrlFilterBackend, self).__init__(spider_name)
+        if key is None:
+            key = 'url_filter_%s' % spider_name
+        self.key = key
+        self.bits_number, self.hash_number = get_bloom_size(capacity,
+                                                            error_rate)
+        if self.bits_number > MAX_BITS_NUMBER:
+            raise SpiderConfigurationError(
+                'Redis URL filter could not contain more than %d bits. '
+                'Decrease capacity or increase error_rate.'
+                % MAX_BITS_NUMBER)
+        self.redis = StrictRedis(**kwargs)
+
+    def add(self, key):
+        pipe = self.redis.pipeline(transaction=False)
+        for pos in get_bit_positions(key, self.bits_number,
+                                     self.hash_number):
+            pipe.setbit(self.key, pos, 1)
+        # SETBIT returns previous value of the bit
+        return all(pipe.execute())
+
+    def clear(self):
+        self.redis.delete(self.key)
+
+    def close(self):
+        self.redis.connection_pool.disconnect()
@@ -91,6 +91,9 @@ class Stat(object):
             self.print_progress_line()
             self.time = now
 
+    def set(self, key, val):
+        self.counters[key] = val
+
     def collect(self, key, val):
         self.collections[key].append(val)
 
@@ -81,6 +81,16 @@ SPIDER_TEST_LIST = (
     'test.spider_data',
     'test.spider_stat',
     'test.spider_multiprocess',
+    'test.spider_rate_limit',
+    'test.spider_frontier',
+    'test.spider_concurrency',
+    'test.spider_network_result',
+    'test.spider_retry',
+    'test.spider_url_filter',
+    'test.spider_distributed',
+    'test.spider_task_codec',
+    'test.spider_queue_buffer',
+    'test.spider_cache_memory',
 )
 
 
@@ -1,9 +1,13 @@
 import six
 from grab.spider import Spider, Task
 from grab.spider.error import SpiderError, FatalError
+from grab.spider.transport.multicurl import MulticurlTransport
 import os
+import time
 import signal
+import socket
 import mock
+import pycurl
 
 from test.util import BaseGrabTestCase, build_spider
 
@@ -250,3 +254,57 @@ class BasicSpiderTestCase(BaseGrabTestCase):
         self.assertEqual(5, bot.task_queue.size())
         bot.run()
         self.assertEqual(0, bot.task_queue.size())
+
+    def test_event_loop(self):
+        server = self.server
+
+        class TestSpider(Spider):
+            def task_generator(self):
+                for x in six.moves.range(50):
+                    yield Task('page', url=server.get_url())
+                yield Task('page', url=server.get_url(), delay=0.5)
+
+            def task_page(self, grab, task):
+                self.stat.inc('count')
+
+        bot = build_spider(TestSpider, event_loop=True)
+        bot.run()
+        self.assertEqual(bot.stat.counters['count'], 51)
+
+    def test_event_loop_socket_events(self):
+        transport = MulticurlTransport(1, event_loop=True)
+        sock = socket.socket()
+        try:
+            fd = sock.fileno()
+            transport.handle_socket_event(pycurl.POLL_IN, fd, None, None)
+            # Curl does not want to watch the socket for a while
+            transport.handle_socket_event(pycurl.POLL_NONE, fd, None, None)
+            self.assertFalse(fd in transport.curl_sockets)
+            transport.handle_socket_event(pycurl.POLL_OUT, fd, None, None)
+            self.assertTrue(fd in transport.curl_sockets)
+            transport.handle_socket_event(pycurl.POLL_REMOVE, fd, None, None)
+            self.assertFalse(fd in transport.curl_sockets)
+        finally:
+            sock.close()
+            transport.selector.close()
+            transport.waker.close()
+
+    def test_shutdown_after_all_results(self):
+        server = self.server
+
+        class TestSpider(Spider):
+            def task_generator(self):
+                for x in six.moves.range(5):
+                    yield Task('page', url=server.get_url())
+
+            def task_page(self, grab, task):
+                time.sleep(0.1)
+                if not task.get('last'):
+                    yield task.clone(last=True)
+                self.stat.inc('count')
+
+        bot = build_spider(TestSpider, thread_number=1)
+        bot.run()
+        self.assertEqual(bot.stat.counters['count'], 10)
+        self.assertEqual(0, bot.parser_pending_results)
+        self.assertFalse(bot.task_generator_enabled)
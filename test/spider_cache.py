@@ -1,5 +1,15 @@
 # coding: utf-8
+import os
+import shutil
+import tempfile
+from threading import Thread
+from unittest import TestCase
+
+from grab import Grab
 from grab.spider import Spider, Task
+from grab.spider.cache_backend.local import CacheBackend
+from grab.spider.cache_pipeline import build_revalidation_headers
+from grab.spider.network_result import NetworkResult
 import mock
 from copy import deepcopy
 
@@ -103,6 +113,56 @@ class SpiderCacheMixin(object):
         bot.run()
         self.assertEqual([1, 1, 1, 2], bot.stat.collections['resp_counters'])
 
+    def test_revalidation(self):
+        server = self.server
+
+        class TestSpider(Spider):
+            def task_generator(self):
+                yield Task('page', url=server.get_url(), cache_timeout=0)
+
+            def task_page(self, grab, task):
+                self.stat.collect('bodies', grab.doc.body)
+
+        server.response['get.data'] = b'foo'
+        server.response['headers'] = [('ETag', '"abc"')]
+        bot = build_spider(TestSpider)
+        self.setup_cache(bot)
+        bot.cache_pipeline.cache.clear()
+        bot.run()
+
+        server.response['code'] = 304
+        server.response['get.data'] = b''
+        bot = build_spider(TestSpider)
+        self.setup_cache(bot)
+        bot.run()
+        self.assertEqual('"abc"', server.request['headers']['If-None-Match'])
+        self.assertEqual([b'foo'], bot.stat.collections['bodies'])
+        self.assertEqual(1, bot.stat.counters['spider:cache-not-modified'])
+        self.assertTrue(bot.cache_pipeline.cache.has_item(server.get_url(),
+                                                          timeout=100))
+
+    def test_body_deduplication(self):
+        class TestSpider(Spider):
+            def task_page(self, grab, task):
+                pass
+
+        self.server.response['get.data'] = b'foo'
+        bot = build_spider(TestSpider)
+        self.setup_cache(bot)
+        cache = bot.cache_pipeline.cache
+        cache.clear()
+        bot.setup_queue()
+        bot.add_task(Task('page', url=self.server.get_url('/a')))
+        bot.add_task(Task('page', url=self.server.get_url('/b')))
+        bot.run()
+        self.assertEqual(2, cache.size())
+        self.assertEqual(1, self.count_bodies(cache))
+        cache.remove_cache_item(self.server.get_url('/a'))
+        self.assertEqual(1, self.count_bodies(cache))
+        self.assertTrue(cache.get_item(self.server.get_url('/b')) is not None)
+        cache.remove_cache_item(self.server.get_url('/b'))
+        self.assertEqual(0, self.count_bodies(cache))
+
     def test_only_cache_task(self):
         class TestSpider(Spider):
             def task_page(self, grab, task):
@@ -199,6 +259,22 @@ class SpiderCacheMixin(object):
         bot.cache_pipeline.cache.remove_cache_item(self.server.get_url())
         self.assertEqual(1, bot.cache_pipeline.cache.size())
 
+    def test_worker_number(self):
+        class TestSpider(Spider):
+            def task_page(self, grab, task):
+                self.stat.inc('page')
+
+        bot = build_spider(TestSpider)
+        self.setup_cache(bot, worker_number=3, write_batch_size=2)
+        bot.cache_pipeline.cache.clear()
+        self.assertEqual(3, len(bot.cache_pipeline.threads))
+        bot.setup_queue()
+        for x in range(5):
+            bot.add_task(Task('page', url=self.server.get_url('/%d' % x)))
+        bot.run()
+        self.assertEqual(5, bot.stat.counters['page'])
+        self.assertEqual(5, bot.cache_pipeline.cache.size())
+
     def test_has_item(self):
         class TestSpider(Spider):
             def task_page(self, grab, task):
@@ -226,6 +302,9 @@ class SpiderMongoCacheTestCase(SpiderCacheMixin, BaseGrabTestCase):
         config.update(kwargs)
         bot.setup_cache(backend='mongo', **config)
 
+    def count_bodies(self, cache):
+        return cache.db.cache_body.count()
+
     def test_too_large_document(self):
         class TestSpider(Spider):
             def task_page(self, grab, task):
@@ -264,6 +343,10 @@ class SpiderMysqlCacheTestCase(SpiderCacheMixin, BaseGrabTestCase):
         config.update(kwargs)
         bot.setup_cache(backend='mysql', **config)
 
+    def count_bodies(self, cache):
+        cache.execute('SELECT COUNT(*) FROM cache_body')
+        return cache.cursor.fetchone()[0]
+
     def test_create_table(self):
         class TestSpider(Spider):
             def task_page(self, grab, task):
@@ -287,6 +370,10 @@ class SpiderPostgresqlCacheTestCase(SpiderCacheMixin, BaseGrabTestCase):
         config.update(kwargs)
         bot.setup_cache(backend='postgresql', **config)
 
+    def count_bodies(self, cache):
+        cache.cursor.execute('SELECT COUNT(*) FROM cache_body')
+        return cache.cursor.fetchone()[0]
+
     def test_create_table(self):
         class TestSpider(Spider):
             def task_page(self, grab, task):
@@ -300,3 +387,205 @@ class SpiderPostgresqlCacheTestCase(SpiderCacheMixin, BaseGrabTestCase):
         self.setup_cache(bot)
         bot.cache_pipeline.cache.clear()
         self.assertEqual(0, bot.cache_pipeline.cache.size())
+
+
+class SpiderLocalCacheTestCase(SpiderCacheMixin, BaseGrabTestCase):
+    def setUp(self):
+        super(SpiderLocalCacheTestCase, self).setUp()
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def setup_cache(self, bot, **kwargs):
+        bot.setup_cache(backend='local', database=self.tmp_dir, **kwargs)
+
+    def count_bodies(self, cache):
+        return sum(len(x[2]) for x in os.walk(cache.body_dir))
+
+
+class LocalCacheBackendTestCase(TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        bot = Spider()
+        bot.setup_cache(backend='local', database=self.tmp_dir)
+        self.cache = bot.cache_pipeline.cache
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def save(self, url, body):
+        grab = Grab()
+        grab.setup_document(body)
+        grab.response.url = url
+        self.cache.save_response(url, grab)
+
+    def count_body_files(self):
+        return sum(len(x[2]) for x in os.walk(self.cache.body_dir))
+
+    def test_save_load(self):
+        self.save('http://a.com/', b'<b>foo</b>')
+        item = self.cache.get_item('http://a.com/')
+        self.assertEqual(b'<b>foo</b>', item['body'])
+        self.assertEqual(200, item['response_code'])
+        self.assertEqual('http://a.com/', item['response_url'])
+        grab = Grab()
+        self.cache.load_response(grab, item)
+        self.assertEqual(b'<b>foo</b>', grab.response.body)
+        self.assertTrue(grab.response.from_cache)
+        self.assertEqual(None, self.cache.get_item('http://b.com/'))
+        self.assertTrue(self.cache.has_item('http://a.com/', timeout=100))
+
+    def test_save_responses(self):
+        items = []
+        for url, body in (('http://a.com/', b'foo'), ('http://b.com/', b'bar'),
+                          ('http://a.com/', b'baz')):
+            grab = Grab()
+            grab.setup_document(body)
+            grab.response.url = url
+            items.append((url, grab))
+        self.cache.save_responses(items)
+        self.assertEqual(2, self.cache.size())
+        self.assertEqual(b'baz', self.cache.get_item('http://a.com/')['body'])
+        self.assertEqual(2, self.count_body_files())
+
+    def test_pipeline_save_batch(self):
+        pipeline = self.cache.spider.cache_pipeline
+        for x in range(5):
+            grab = Grab()
+            grab.setup_document(b'foo')
+            grab.request_method = 'GET'
+            task = Task('page', url='http://%d.com/' % (x % 3))
+            pipeline.input_queue.put(('save', (task, grab)))
+        pipeline.input_queue.join()
+        self.assertTrue(pipeline.is_idle())
+        self.assertEqual(3, self.cache.size())
+
+    def test_touch_item(self):
+        self.save('http://a.com/', b'foo')
+        self.cache.conn.execute('UPDATE cache SET timestamp = 0')
+        self.assertFalse(self.cache.has_item('http://a.com/', timeout=100))
+        self.cache.touch_item('http://a.com/')
+        self.assertTrue(self.cache.has_item('http://a.com/', timeout=100))
+
+    def test_pipeline_refresh(self):
+        pipeline = self.cache.spider.cache_pipeline
+        grab = Grab()
+        grab.setup_document(b'foo')
+        grab.response.head = (b'HTTP/1.1 200 OK\r\n'
+                              b'ETag: "abc"\r\n\r\n')
+        self.cache.save_response('http://a.com/', grab)
+        self.cache.conn.execute('UPDATE cache SET timestamp = 0')
+        self.cache.conn.commit()
+
+        task = Task('page', url='http://a.com/', cache_timeout=100)
+        grab = Grab(url='http://a.com/')
+        pipeline.input_queue.put(('load', (task, grab)))
+        action, result = pipeline.result_queue.get(timeout=5)
+        self.assertEqual('task', action)
+        self.assertEqual({'If-None-Match': '"abc"'},
+                         task.revalidation_headers)
+
+        pipeline.input_queue.put(('refresh', (task, grab)))
+        action, result = pipeline.result_queue.get(timeout=5)
+        self.assertEqual('network_result', action)
+        self.assertEqual(b'foo', result.grab.response.body)
+        self.assertTrue(self.cache.has_item('http://a.com/', timeout=100))
+
+    def test_not_modified_retry(self):
+        bot = self.cache.spider
+        headers = {'If-None-Match': '"abc"'}
+        task = Task('page', url='http://a.com/', revalidation_headers=headers)
+        grab = Grab(url='http://a.com/', headers=headers)
+        backup = grab.dump_config()
+        grab.setup_document(b'', code=503)
+        res = NetworkResult(True, task, grab, backup)
+        self.assertFalse(bot.process_not_modified(res))
+        # Repeated request is not conditional
+        self.assertFalse('If-None-Match' in res.grab.config['headers'])
+        self.assertFalse('If-None-Match' in res.grab_config_backup['headers'])
+
+        # Response to the repeated request is not expected to be 304
+        grab.setup_document(b'', code=304)
+        grab.request_method = 'GET'
+        self.assertFalse(bot.process_not_modified(res))
+        self.assertFalse(bot.is_valid_network_result(res))
+        self.assertFalse(bot.cache_pipeline.is_cache_saving_allowed(task,
+                                                                    grab))
+
+    def test_pipeline_backend_error(self):
+        pipeline = self.cache.spider.cache_pipeline
+        task = Task('page', url='http://a.com/')
+        grab = Grab(url='http://a.com/')
+        with mock.patch.object(self.cache, 'get_item',
+                               side_effect=IOError('Database is gone')):
+            pipeline.input_queue.put(('load', (task, grab)))
+            action, result = pipeline.result_queue.get(timeout=5)
+        # The task is sent to the network
+        self.assertEqual('task', action)
+        self.assertTrue(result is task)
+        pipeline.input_queue.join()
+        self.assertTrue(pipeline.is_idle())
+        # The worker is alive
+        pipeline.input_queue.put(('load', (task, grab)))
+        action, result = pipeline.result_queue.get(timeout=5)
+        self.assertEqual('task', action)
+
+    def test_concurrent_workers(self):
+        # Worker removes the last document which refers to the body while
+        # other worker is saving new document with the same body
+        other_cache = CacheBackend(database=self.tmp_dir,
+                                   spider=self.cache.spider)
+        self.save('http://a.com/', b'foo')
+        remove_thread = Thread(target=self.cache.remove_cache_item,
+                               args=['http://a.com/'])
+        write_body = other_cache.write_body
+
+        def patched_write_body(body):
+            body_hash = write_body(body)
+            remove_thread.start()
+            remove_thread.join(0.2)
+            return body_hash
+
+        other_cache.write_body = patched_write_body
+        grab = Grab()
+        grab.setup_document(b'foo')
+        other_cache.save_response('http://b.com/', grab)
+        remove_thread.join()
+        self.assertEqual(None, self.cache.get_item('http://a.com/'))
+        self.assertEqual(b'foo', self.cache.get_item('http://b.com/')['body'])
+
+    def test_empty_body(self):
+        self.cache.use_compression = False
+        self.save('http://a.com/', b'')
+        self.assertEqual(b'', self.cache.get_item('http://a.com/')['body'])
+
+    def test_same_body(self):
+        self.save('http://a.com/', b'foo')
+        self.save('http://b.com/', b'foo')
+        self.assertEqual(2, self.cache.size())
+        self.assertEqual(1, self.count_body_files())
+        self.cache.remove_cache_item('http://a.com/')
+        self.assertEqual(1, self.count_body_files())
+        self.save('http://b.com/', b'bar')
+        self.assertEqual(1, self.count_body_files())
+        self.assertEqual(b'bar', self.cache.get_item('http://b.com/')['body'])
+        self.cache.clear()
+        self.assertEqual(0, self.cache.size())
+        self.assertEqual(0, self.count_body_files())
+
+
+class RevalidationHeadersTestCase(TestCase):
+    def test_build_revalidation_headers(self):
+        head = (b'HTTP/1.1 301 Moved Permanently\r\n'
+                b'ETag: "old"\r\n\r\n'
+                b'HTTP/1.1 200 OK\r\n'
+                b'Content-Type: text/html\r\n'
+                b'etag: "abc"\r\n'
+                b'Last-Modified: Wed, 21 Oct 2015 07:28:00 GMT\r\n\r\n')
+        self.assertEqual({
+            'If-None-Match': '"abc"',
+            'If-Modified-Since': 'Wed, 21 Oct 2015 07:28:00 GMT',
+        }, build_revalidation_headers(head))
+        self.assertEqual({}, build_revalidation_headers(
+            b'HTTP/1.1 200 OK\r\nContent-Type: text/html\r\n\r\n'))
@@ -0,0 +1,143 @@
+import shutil
+import tempfile
+import time
+from unittest import TestCase
+
+from grab import Grab
+from grab.spider import Spider, Task
+from grab.spider.cache_memory import MemoryCache, ITEM_OVERHEAD
+
+
+def build_item(body):
+    return {'body': body, 'head': b''}
+
+
+class MemoryCacheTestCase(TestCase):
+    def test_lru(self):
+        cache = MemoryCache(max_size=(ITEM_OVERHEAD + 10) * 2)
+        cache.put('a', build_item(b'a' * 10), 0)
+        cache.put('b', build_item(b'b' * 10), 0)
+        self.assertEqual(b'a' * 10, cache.get('a')['body'])
+        cache.put('c', build_item(b'c' * 10), 0)
+        # "b" is the least recently used item
+        self.assertEqual(None, cache.get('b'))
+        self.assertNotEqual(None, cache.get('a'))
+        self.assertNotEqual(None, cache.get('c'))
+        self.assertEqual((ITEM_OVERHEAD + 10) * 2, cache.size)
+
+    def test_too_large_item(self):
+        cache = MemoryCache(max_size=ITEM_OVERHEAD + 10)
+        cache.put('a', build_item(b'a' * 100), 0)
+        self.assertEqual(None, cache.get('a'))
+        self.assertEqual(0, cache.size)
+
+    def test_timeout(self):
+        cache = MemoryCache()
+        cache.put('a', build_item(b'a'), time.time() - 10)
+        cache.put('b', build_item(b'b'), float('-inf'))
+        self.assertNotEqual(None, cache.get('a'))
+        self.assertNotEqual(None, cache.get('a', timeout=100))
+        self.assertEqual(None, cache.get('a', timeout=5))
+        self.assertNotEqual(None, cache.get('b'))
+        self.assertEqual(None, cache.get('b', timeout=100))
+
+    def test_remove_clear(self):
+        cache = MemoryCache()
+        cache.put('a', build_item(b'a'), 0)
+        cache.put('b', build_item(b'b'), 0)
+        cache.remove('a')
+        self.assertEqual(None, cache.get('a'))
+        cache.clear()
+        self.assertEqual(None, cache.get('b'))
+        self.assertEqual(0, cache.size)
+
+    def test_remove_during_load(self):
+        cache = MemoryCache()
+        cache.begin_load('a')
+        cache.remove('a')
+        cache.end_load('a', build_item(b'a'), 0)
+        self.assertEqual(None, cache.get('a'))
+        # Next load is not affected
+        cache.begin_load('a')
+        cache.end_load('a', build_item(b'a'), 0)
+        self.assertNotEqual(None, cache.get('a'))
+        self.assertEqual({}, cache.loading)
+
+
+class TwoTierCacheTestCase(TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.bot = Spider()
+        self.bot.setup_cache(backend='local', database=self.tmp_dir,
+                             memory_cache_size=1024 * 1024)
+        self.cache = self.bot.cache_pipeline.cache
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def save(self, url, body):
+        grab = Grab()
+        grab.setup_document(body)
+        self.cache.save_response(url, grab)
+
+    def test_tiers(self):
+        self.save('http://a.com/', b'foo')
+        counters = self.bot.stat.counters
+        self.assertEqual(b'foo', self.cache.get_item('http://a.com/')['body'])
+        self.assertEqual(b'foo', self.cache.get_item('http://a.com/')['body'])
+        self.assertEqual(None, self.cache.get_item('http://b.com/'))
+        # Counters are moved into the stat by the spider thread
+        self.assertEqual(0, counters['spider:cache-memory-hit'])
+        self.bot.cache_pipeline.flush_stat()
+        self.assertEqual(2, counters['spider:cache-memory-miss'])
+        self.assertEqual(1, counters['spider:cache-db-hit'])
+        self.assertEqual(1, counters['spider:cache-memory-hit'])
+        self.assertEqual(1, counters['spider:cache-db-miss'])
+
+    def test_save_invalidates_memory(self):
+        self.save('http://a.com/', b'foo')
+        self.cache.get_item('http://a.com/')
+        self.save('http://a.com/', b'bar')
+        self.assertEqual(b'bar', self.cache.get_item('http://a.com/')['body'])
+        self.cache.remove_cache_item('http://a.com/')
+        self.assertEqual(None, self.cache.get_item('http://a.com/'))
+
+    def test_backend_attributes(self):
+        self.assertEqual(self.tmp_dir, self.cache.path)
+
+    def test_cold_url_single_query(self):
+        pipeline = self.bot.cache_pipeline
+        task = Task('page', url='http://a.com/', cache_timeout=100)
+        pipeline.input_queue.put(('load', (task, Grab(url='http://a.com/'))))
+        self.assertEqual('task', pipeline.result_queue.get(timeout=5)[0])
+        pipeline.input_queue.join()
+        pipeline.flush_stat()
+        self.assertEqual(1, self.bot.stat.counters['spider:cache-db-miss'])
+
+    def test_touch_item(self):
+        self.save('http://a.com/', b'foo')
+        self.cache.backend.conn.execute('UPDATE cache SET timestamp = 0')
+        self.cache.backend.conn.commit()
+        self.assertEqual(0, self.cache.get_item('http://a.com/')['timestamp'])
+        self.cache.touch_item('http://a.com/')
+        item = self.cache.get_item('http://a.com/', timeout=100)
+        self.assertTrue(item['timestamp'] > time.time() - 100)
+        self.bot.cache_pipeline.flush_stat()
+        self.assertEqual(1, self.bot.stat.counters['spider:cache-memory-hit'])
+
+    def test_save_during_load(self):
+        self.save('http://a.com/', b'foo')
+        backend = self.cache.backend
+        get_item = backend.get_item
+
+        def patched_get_item(url, timeout=None):
+            # Other worker saves new document after the old one
+            # has been read from the database
+            item = get_item(url, timeout=timeout)
+            self.save('http://a.com/', b'bar')
+            return item
+
+        backend.get_item = patched_get_item
+        self.assertEqual(b'foo', self.cache.get_item('http://a.com/')['body'])
+        del backend.get_item
+        self.assertEqual(b'bar', self.cache.get_item('http://a.com/')['body'])
@@ -0,0 +1,109 @@
+from unittest import TestCase
+
+from grab.spider import Spider, Task
+from grab.spider.concurrency import ConcurrencyController
+from grab.spider.transport.multicurl import MulticurlTransport
+
+from test.util import BaseGrabTestCase, build_spider
+
+
+class ConcurrencyControllerTestCase(TestCase):
+    def test_additive_increase(self):
+        ctl = ConcurrencyController(max_streams=10, initial_streams=2,
+                                    window=5)
+        for x in range(4):
+            self.assertEqual((0, 0), ctl.register_result('a.com', False, 1))
+        self.assertEqual((1, 0), ctl.register_result('a.com', False, 1))
+        self.assertEqual(3, ctl.limit)
+
+    def test_max_streams(self):
+        ctl = ConcurrencyController(max_streams=3, window=1)
+        self.assertEqual((0, 0), ctl.register_result('a.com', False, 1))
+        self.assertEqual(3, ctl.limit)
+
+    def test_decrease_on_errors(self):
+        ctl = ConcurrencyController(max_streams=10, window=10,
+                                    error_threshold=0.1)
+        for x in range(8):
+            ctl.register_result('a.com', False, 1)
+        ctl.register_result('a.com', True, None)
+        self.assertEqual((-1, 0), ctl.register_result('a.com', True, None))
+        self.assertEqual(5, ctl.limit)
+
+    def test_decrease_on_latency(self):
+        ctl = ConcurrencyController(max_streams=10, window=1,
+                                    latency_factor=2)
+        ctl.register_result('a.com', False, 1)
+        self.assertEqual((0, 0), ctl.register_result('a.com', False, 1.5))
+        self.assertEqual((-1, 0), ctl.register_result('a.com', False, 3))
+        self.assertEqual(5, ctl.limit)
+
+    def test_min_streams(self):
+        ctl = ConcurrencyController(max_streams=10, min_streams=4, window=1)
+        for x in range(3):
+            ctl.register_result('a.com', True, None)
+        self.assertEqual(4, ctl.limit)
+
+    def test_per_host(self):
+        ctl = ConcurrencyController(max_streams=10, per_host=True,
+                                    host_max_streams=3, host_window=1)
+        self.assertEqual(1, ctl.register_result('a.com', False, 1,
+                                                host_limit=2)[1])
+        self.assertEqual(3, ctl.get_host_limit('a.com'))
+        self.assertEqual(-1, ctl.register_result('b.com', True, None,
+                                                 host_limit=2)[1])
+        self.assertEqual(1, ctl.get_host_limit('b.com'))
+        self.assertEqual(3, ctl.get_host_limit('a.com'))
+
+
+class TransportStreamLimitTestCase(TestCase):
+    def test_stream_limit(self):
+        transport = MulticurlTransport(5)
+        self.assertEqual(5, transport.get_free_threads_number())
+        transport.set_stream_limit(2)
+        self.assertEqual(2, transport.get_free_threads_number())
+        transport.set_stream_limit(100)
+        self.assertEqual(5, transport.stream_limit)
+
+
+class SpiderConcurrencyTestCase(BaseGrabTestCase):
+    def setUp(self):
+        self.server.reset()
+
+    def test_overload_decreases_limit(self):
+        server = self.server
+        server.response['code'] = 503
+
+        class TestSpider(Spider):
+            def task_generator(self):
+                for x in range(20):
+                    yield Task('page', url=server.get_url())
+
+            def task_page(self, grab, task):
+                pass
+
+        bot = build_spider(TestSpider, thread_number=8,
+                           network_try_limit=1)
+        bot.setup_concurrency_control(window=5)
+        bot.run()
+        self.assertEqual(1, bot.stat.counters['spider:concurrency-limit'])
+        self.assertEqual(3, bot.stat.counters['spider:concurrency-decrease'])
+
+    def test_per_host(self):
+        server = self.server
+
+        class TestSpider(Spider):
+            def task_generator(self):
+                for x in range(10):
+                    yield Task('page', url=server.get_url())
+
+            def task_page(self, grab, task):
+                self.stat.inc('count')
+
+        bot = build_spider(TestSpider, thread_number=5)
+        bot.setup_concurrency_control(per_host=True, host_window=2)
+        bot.run()
+        self.assertEqual(10, bot.stat.counters['count'])
+        self.assertTrue(bot.frontier is not None)
+        self.assertTrue(
+            bot.stat.counters['spider:host-concurrency-increase'] > 0)
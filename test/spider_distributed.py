@@ -0,0 +1,167 @@
+from multiprocessing import Process
+import time
+
+from grab.spider import Spider, Task
+from grab.spider.coordinator import Coordinator
+
+from test.util import BaseGrabTestCase, build_spider
+from test_settings import REDIS_CONNECTION
+
+PREFIX = 'test_spider_distributed'
+
+
+class TreeSpider(Spider):
+    """
+    Each page of first level produces ten pages of second level.
+    """
+
+    def task_generator(self):
+        for x in range(10):
+            yield Task('page', url='%s?page=%d' % (self.meta['url'], x),
+                       level=1)
+
+    def task_page(self, grab, task):
+        if task.level == 1:
+            for x in range(10):
+                yield Task('page', url='%s-%d' % (task.url, x), level=2)
+
+
+def run_worker(url, thread_number=2):
+    bot = build_spider(TreeSpider, meta={'url': url},
+                       thread_number=thread_number)
+    bot.setup_queue(backend='redis', queue_name=PREFIX, **REDIS_CONNECTION)
+    bot.setup_coordinator(prefix=PREFIX, check_interval=0.1,
+                          **REDIS_CONNECTION)
+    bot.run()
+
+
+class CoordinatorTestCase(BaseGrabTestCase):
+    _backend = 'redis'
+
+    def setUp(self):
+        super(CoordinatorTestCase, self).setUp()
+        self.coordinator = self.build_coordinator()
+        self.coordinator.clear()
+
+    def build_coordinator(self, **kwargs):
+        return Coordinator('test', prefix=PREFIX, check_interval=0,
+                           **dict(REDIS_CONNECTION, **kwargs))
+
+    def test_seed(self):
+        worker = self.build_coordinator()
+        self.assertTrue(self.coordinator.acquire_seed())
+        self.assertFalse(worker.acquire_seed())
+
+    def test_seed_release(self):
+        worker = self.build_coordinator()
+        self.coordinator.register()
+        worker.register()
+        self.assertTrue(self.coordinator.acquire_seed())
+        stat = build_spider(TreeSpider).stat
+        self.coordinator.close(stat)
+        self.assertFalse(worker.acquire_seed())
+        # The last worker has left the cluster
+        worker.close(stat)
+        self.assertTrue(worker.acquire_seed())
+
+    def test_seed_expires(self):
+        coordinator = self.build_coordinator(worker_timeout=0.5)
+        coordinator.register()
+        self.assertTrue(coordinator.acquire_seed())
+        time.sleep(0.6)
+        self.assertTrue(self.build_coordinator().acquire_seed())
+
+    def test_cluster_idle(self):
+        worker = self.build_coordinator()
+        self.coordinator.register()
+        worker.register()
+        self.assertFalse(self.coordinator.is_cluster_idle(None))
+        worker.heartbeat(None, busy=False)
+        self.assertTrue(self.coordinator.is_cluster_idle(None))
+        worker.heartbeat(None, busy=True)
+        self.assertFalse(self.coordinator.is_cluster_idle(None))
+        worker.close(build_spider(TreeSpider).stat)
+        self.assertTrue(self.coordinator.is_cluster_idle(None))
+
+    def test_dead_worker(self):
+        coordinator = self.build_coordinator(worker_timeout=0.5)
+        worker = self.build_coordinator()
+        worker.register()
+        self.assertFalse(coordinator.is_cluster_idle(None))
+        time.sleep(0.6)
+        self.assertTrue(coordinator.is_cluster_idle(None))
+        self.assertFalse(coordinator.redis.hexists(coordinator.workers_key,
+                                                   worker.worker_id))
+
+    def test_renew_leases(self):
+        bot = build_spider(TreeSpider)
+        bot.setup_queue(backend='redis', queue_name=PREFIX, lease_timeout=1,
+                        **REDIS_CONNECTION)
+        task_queue = bot.task_queue
+        task_queue.clear()
+        task_queue.put(Task('page', url='http://example.com/'), 1)
+        task = task_queue.get()
+        self.coordinator.register(task_queue)
+        time.sleep(0.6)
+        self.coordinator.heartbeat(None, busy=True, force=True)
+        time.sleep(0.6)
+        # The lease has been extended by the heartbeat
+        self.assertEqual([], task_queue.get_many(1))
+        task_queue.ack(task)
+        task_queue.flush_acks()
+        self.assertEqual(0, task_queue.size())
+
+    def test_counters(self):
+        stat = build_spider(TreeSpider).stat
+        worker = self.build_coordinator()
+        stat.inc('foo', 2)
+        self.coordinator.heartbeat(stat, busy=True, force=True)
+        stat.inc('foo')
+        stat.inc('bar', 0.5)
+        self.coordinator.close(stat)
+        stat2 = build_spider(TreeSpider).stat
+        stat2.inc('foo')
+        worker.close(stat2)
+        self.assertEqual({'foo': 4, 'bar': 0.5},
+                         self.coordinator.get_counters())
+
+
+class SpiderDistributedTestCase(BaseGrabTestCase):
+    _backend = 'redis'
+
+    def setUp(self):
+        super(SpiderDistributedTestCase, self).setUp()
+        self.coordinator = Coordinator('test', prefix=PREFIX,
+                                       **REDIS_CONNECTION)
+        self.coordinator.clear()
+        bot = build_spider(TreeSpider)
+        bot.setup_queue(backend='redis', queue_name=PREFIX,
+                        **REDIS_CONNECTION)
+        self.task_queue = bot.task_queue
+        self.task_queue.clear()
+
+    def test_workers(self):
+        workers = [Process(target=run_worker, args=[self.server.get_url()])
+                   for x in range(3)]
+        for proc in workers:
+            proc.start()
+        for proc in workers:
+            proc.join(30)
+            self.assertEqual(0, proc.exitcode)
+        counters = self.coordinator.get_counters()
+        self.assertEqual(110, counters['spider:task-page'])
+        self.assertEqual(110, counters['spider:request-processed'])
+        self.assertEqual(0, self.task_queue.size())
+        self.assertEqual(0, self.coordinator.redis.hlen(
+            self.coordinator.workers_key))
+
+    def test_dead_worker(self):
+        # Worker has taken tasks from the queue and has died
+        self.task_queue.put(
+            Task('page', url=self.server.get_url(), level=2), 1)
+        self.task_queue.lease_timeout = 1
+        self.assertEqual(1, len(self.task_queue.get_many(10)))
+        run_worker(self.server.get_url())
+        counters = self.coordinator.get_counters()
+        self.assertEqual(111, counters['spider:task-page'])
+        self.assertEqual(0, self.task_queue.size())
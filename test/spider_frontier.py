@@ -0,0 +1,105 @@
+from unittest import TestCase
+
+from grab.spider import Spider, Task
+from grab.spider.frontier import Frontier
+
+from test.util import BaseGrabTestCase, build_spider
+
+
+class FrontierTestCase(TestCase):
+    def test_round_robin(self):
+        frontier = Frontier(host_streams=10)
+        for x in range(3):
+            frontier.put(Task(url='http://a.com/%d' % x))
+        frontier.put(Task(url='http://b.com/'))
+        frontier.put(Task(url='http://c.com/'))
+        hosts = [frontier.get().url.split('/')[2] for x in range(5)]
+        self.assertEqual(['a.com', 'b.com', 'c.com', 'a.com', 'a.com'],
+                         hosts)
+        self.assertEqual(None, frontier.get())
+        self.assertEqual(0, frontier.size)
+
+    def test_host_streams(self):
+        frontier = Frontier(host_streams=2, hosts={'b.com': 1})
+        for x in range(3):
+            frontier.put(Task(url='http://a.com/%d' % x))
+            frontier.put(Task(url='http://b.com/%d' % x))
+        tasks = [frontier.get() for x in range(3)]
+        self.assertEqual(['http://a.com/0', 'http://b.com/0',
+                          'http://a.com/1'], [x.url for x in tasks])
+        self.assertEqual(None, frontier.get())
+        frontier.release(tasks[1])
+        self.assertEqual('http://b.com/1', frontier.get().url)
+        frontier.release(tasks[0])
+        self.assertEqual('http://a.com/2', frontier.get().url)
+        self.assertEqual(1, frontier.size)
+
+    def test_is_full(self):
+        frontier = Frontier(buffer_size=2)
+        frontier.put(Task(url='http://a.com/'))
+        self.assertFalse(frontier.is_full())
+        frontier.put(Task(url='http://a.com/'))
+        self.assertTrue(frontier.is_full())
+        frontier.clear()
+        self.assertFalse(frontier.is_full())
+
+    def test_clear_active_streams(self):
+        frontier = Frontier(host_streams=1)
+        frontier.put(Task(url='http://a.com/0'))
+        frontier.get()
+        # Network request has not been completed before the clear
+        frontier.clear()
+        frontier.put(Task(url='http://a.com/1'))
+        self.assertEqual('http://a.com/1', frontier.get().url)
+
+    def test_priority(self):
+        frontier = Frontier(host_streams=10)
+        for x, priority in enumerate((3, 1, 2, 1)):
+            frontier.put(Task(url='http://a.com/%d' % x, priority=priority))
+        self.assertEqual(['http://a.com/1', 'http://a.com/3',
+                          'http://a.com/2', 'http://a.com/0'],
+                         [frontier.get().url for x in range(4)])
+
+    def test_host_buffer_size(self):
+        frontier = Frontier(host_buffer_size=2)
+        self.assertTrue(frontier.put(Task(url='http://a.com/0')))
+        self.assertTrue(frontier.put(Task(url='http://a.com/1')))
+        self.assertFalse(frontier.put(Task(url='http://a.com/2')))
+        self.assertTrue(frontier.put(Task(url='http://b.com/0')))
+        self.assertEqual(3, frontier.size)
+
+
+class SpiderFrontierTestCase(BaseGrabTestCase):
+    def setUp(self):
+        self.server.reset()
+
+    def test_busy_host_tasks_returned(self):
+        bot = build_spider(Spider)
+        bot.setup_queue()
+        bot.setup_frontier(host_streams=1, buffer_size=10,
+                           host_buffer_size=2)
+        for x in range(12):
+            bot.add_task(Task('page', url='http://a.com/%d' % x, priority=1))
+        bot.add_task(Task('page', url='http://b.com/', priority=2))
+        self.assertEqual('http://a.com/0', bot.get_task_from_frontier().url)
+        # The task of other host is found behind tasks of the busy host
+        self.assertEqual('http://b.com/', bot.get_task_from_frontier().url)
+        self.assertEqual(2, bot.frontier.size)
+        self.assertEqual(9, bot.task_queue.size())
+
+    def test_host_streams(self):
+        server = self.server
+
+        class TestSpider(Spider):
+            def task_generator(self):
+                for x in range(10):
+                    yield Task('page', url=server.get_url())
+
+            def task_page(self, grab, task):
+                self.stat.inc('count')
+
+        bot = build_spider(TestSpider, thread_number=5)
+        bot.setup_frontier(host_streams=1)
+        bot.run()
+        self.assertEqual(10, bot.stat.counters['count'])
+        self.assertEqual(0, bot.frontier.size)
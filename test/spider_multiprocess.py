@@ -91,6 +91,44 @@ class BasicSpiderTestCase(BaseGrabTestCase):
         bot.run()
         self.assertEqual(1, len(set(bot.stat.collections['pid'])))
 
+    @multiprocess_mode(True)
+    def test_shared_body(self):
+        body = b'<html><body>%s</body></html>' % (b'x' * 100000)
+        self.server.response['get.data'] = body
+
+        class TestSpider(Spider):
+            def task_page(self, grab, task):
+                self.stat.collect('body', grab.doc.body)
+
+        for min_size in (1000, None):
+            bot = build_spider(TestSpider, mp_mode=True,
+                               shared_body_min_size=min_size)
+            bot.setup_queue()
+            bot.add_task(Task('page', url=self.server.get_url()))
+            bot.run()
+            self.assertEqual([body], bot.stat.collections['body'])
+
+    @multiprocess_mode(True)
+    def test_batched_parser_results(self):
+        url = self.server.get_url()
+
+        class TestSpider(Spider):
+            def task_generator(self):
+                yield Task('list', url=url)
+
+            def task_list(self, grab, task):
+                for x in range(10):
+                    yield Task('page', url=url)
+
+            def task_page(self, grab, task):
+                self.stat.inc('page')
+
+        bot = build_spider(TestSpider, mp_mode=True)
+        bot.run()
+        self.assertEqual(10, bot.stat.counters['page'])
+        # One message for each processed response
+        self.assertEqual(11, bot.stat.counters['spider:parser-result'])
+
     '''
     @multiprocess_mode(True)
     def test_task_callback(self):
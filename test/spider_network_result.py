@@ -0,0 +1,48 @@
+import pickle
+from unittest import TestCase
+
+from grab import Grab
+from grab.spider import Task
+from grab.spider.network_result import NetworkResult
+
+
+class NetworkResultTestCase(TestCase):
+    def test_dict_access(self):
+        task = Task('page', url='http://example.com/')
+        res = NetworkResult(False, task, None, ecode=28, emsg='timeout',
+                            error_abbr='operation-timeouted')
+        self.assertEqual(task, res['task'])
+        self.assertEqual('operation-timeouted', res['error_abbr'])
+        res['ok'] = True
+        self.assertTrue(res.ok)
+        self.assertRaises(KeyError, lambda: res['foo'])
+
+    def test_pickle(self):
+        grab = Grab(document_body=b'<h1>test</h1>')
+        res = NetworkResult(True, Task('page', url='http://example.com/'),
+                            grab, grab.dump_config())
+        res2 = pickle.loads(pickle.dumps(res))
+        self.assertTrue(res2.ok)
+        self.assertEqual('page', res2.task.name)
+        self.assertEqual(b'<h1>test</h1>', res2.grab.doc.body)
+        self.assertEqual(None, res2.grab_config_backup)
+        self.assertTrue(res.copy().grab_config_backup is not None)
+
+    def test_pickle_grab_state(self):
+        grab = Grab(document_body=b'<h1>test</h1>', user_agent='Foo')
+        grab.cookies.set('sid', '123', 'example.com')
+        grab.proxylist.load_list(['1.1.1.1:8080'])
+        res = NetworkResult(True, Task('page', url='http://example.com/'),
+                            grab)
+        res2 = pickle.loads(pickle.dumps(res))
+        # Grab instance is built on first access
+        self.assertEqual(None, res2._grab)
+        self.assertEqual('test', res2.grab.doc.select('//h1').text())
+        self.assertTrue(res2.grab.doc.grab is not None)
+        self.assertEqual('Foo', res2.grab.config['user_agent'])
+        self.assertEqual('123', res2.grab.cookies['sid'])
+        # Proxy list is not sent
+        self.assertEqual(0, res2.grab.proxylist.size())
+        # Result which has not been unpacked could be pickled again
+        res3 = pickle.loads(pickle.dumps(pickle.loads(pickle.dumps(res))))
+        self.assertEqual(b'<h1>test</h1>', res3.grab.doc.body)
@@ -1,6 +1,10 @@
+import os
+import shutil
+import tempfile
+import time
+from datetime import datetime, timedelta
 import six
 from grab.spider import Spider, Task
-from grab.spider.error import SpiderMisuseError
 from unittest import TestCase
 from grab.spider.queue_backend.base import QueueInterface
 
@@ -56,6 +60,24 @@ class SpiderQueueMixin(object):
         bot.task_queue.clear()
         self.assertEqual(0, bot.task_queue.size())
 
+    def test_put_many_get_many(self):
+        bot = build_spider(self.SimpleSpider)
+        self.setup_queue(bot)
+        bot.task_queue.clear()
+
+        bot.task_queue.put_many([(Task('page', url='http://%d.com/' % x),
+                                  x, None) for x in (3, 1, 2)])
+        self.assertEqual(3, bot.task_queue.size())
+        tasks = bot.task_queue.get_many(2)
+        self.assertEqual(['http://1.com/', 'http://2.com/'],
+                         [x.url for x in tasks])
+        tasks += bot.task_queue.get_many(5)
+        self.assertEqual(['http://3.com/'], [x.url for x in tasks[2:]])
+        self.assertEqual([], bot.task_queue.get_many(5))
+        for task in tasks:
+            bot.task_queue.ack(task)
+        self.assertEqual(0, bot.task_queue.size())
+
 
 class SpiderMemoryQueueTestCase(BaseGrabTestCase, SpiderQueueMixin):
     def setup_queue(self, bot):
@@ -95,6 +117,33 @@ class SpiderMemoryQueueTestCase(BaseGrabTestCase, SpiderQueueMixin):
         bot.task_queue.clear()
         self.assertEqual(0, len(bot.task_queue.schedule_list))
 
+    def test_same_priority_order(self):
+        bot = build_spider(self.SimpleSpider)
+        self.setup_queue(bot)
+        for x in six.moves.range(10):
+            bot.task_queue.put(Task('page', url='http://%d.com/' % x), 5)
+        bot.task_queue.put(Task('page', url='http://first.com/'), 1)
+        urls = [bot.task_queue.get().url for x in six.moves.range(11)]
+        self.assertEqual(['http://first.com/'] +
+                         ['http://%d.com/' % x for x in six.moves.range(10)],
+                         urls)
+        self.assertRaises(six.moves.queue.Empty, bot.task_queue.get)
+
+    def test_schedule_order(self):
+        bot = build_spider(self.SimpleSpider)
+        self.setup_queue(bot)
+        now = datetime.utcnow()
+        for x in (3, 1, 2):
+            bot.task_queue.put(Task('page', url='http://%d.com/' % x), 5,
+                               schedule_time=now - timedelta(seconds=x))
+        bot.task_queue.put(Task('page', url='http://future.com/'), 5,
+                           schedule_time=now + timedelta(seconds=60))
+        urls = [bot.task_queue.get().url for x in six.moves.range(3)]
+        self.assertEqual(['http://3.com/', 'http://2.com/', 'http://1.com/'],
+                         urls)
+        self.assertRaises(six.moves.queue.Empty, bot.task_queue.get)
+        self.assertEqual(1, bot.task_queue.size())
+
 
 class BasicSpiderTestCase(SpiderQueueMixin, BaseGrabTestCase):
     _backend = 'mongo'
@@ -130,6 +179,41 @@ class BasicSpiderTestCase(SpiderQueueMixin, BaseGrabTestCase):
         self.setup_queue(bot)
         bot.task_queue.clear()
 
+    def test_lease(self):
+        bot = build_spider(self.SimpleSpider)
+        bot.setup_queue(backend='mongo', lease_timeout=1,
+                        **MONGODB_CONNECTION)
+        bot.task_queue.clear()
+        bot.task_queue.put(Task('page', url='http://example.com/'), 1,
+                           schedule_time=datetime.utcnow())
+        task = bot.task_queue.get()
+        self.assertEqual([], bot.task_queue.get_many(1))
+        self.assertEqual(1, bot.task_queue.size())
+        # The lease has expired, the task is given out again
+        time.sleep(1.1)
+        task2 = bot.task_queue.get()
+        self.assertEqual('http://example.com/', task2.url)
+        # Stale lease does not remove the task
+        bot.task_queue.ack(task)
+        bot.task_queue.flush_acks()
+        self.assertEqual(1, bot.task_queue.size())
+        bot.task_queue.ack(task2)
+        self.assertEqual(0, bot.task_queue.size())
+        bot.task_queue.flush_acks()
+        self.assertEqual(0, bot.task_queue.collection.count_documents({}))
+
+    def test_renew_leases(self):
+        bot = build_spider(self.SimpleSpider)
+        bot.setup_queue(backend='mongo', lease_timeout=1,
+                        **MONGODB_CONNECTION)
+        bot.task_queue.clear()
+        bot.task_queue.put(Task('page', url='http://example.com/'), 1)
+        bot.task_queue.get()
+        time.sleep(0.6)
+        bot.task_queue.renew_leases()
+        time.sleep(0.6)
+        self.assertEqual([], bot.task_queue.get_many(1))
+
 
 class SpiderRedisQueueTestCase(SpiderQueueMixin, BaseGrabTestCase):
     _backend = 'redis'
@@ -137,13 +221,274 @@ class SpiderRedisQueueTestCase(SpiderQueueMixin, BaseGrabTestCase):
     def setup_queue(self, bot):
         bot.setup_queue(backend='redis', **REDIS_CONNECTION)
 
-    def test_delay_error(self):
+    def test_schedule(self):
+        server = self.server
+
+        class TestSpider(Spider):
+            def task_generator(self):
+                yield Task('page', url=server.get_url(), num=1)
+                yield Task('page', url=server.get_url(), delay=3, num=2)
+                yield Task('page', url=server.get_url(), delay=1.5, num=3)
+
+            def task_page(self, grab, task):
+                self.stat.collect('numbers', task.num)
+
+        bot = build_spider(TestSpider, thread_number=1)
+        self.setup_queue(bot)
+        bot.task_queue.clear()
+        bot.run()
+        self.assertEqual(bot.stat.collections['numbers'], [1, 3, 2])
+
+    def test_schedule_size(self):
+        bot = build_spider(self.SimpleSpider)
+        self.setup_queue(bot)
+        bot.task_queue.clear()
+        bot.add_task(Task('page', url=self.server.get_url(), delay=10))
+        self.assertEqual(1, bot.task_queue.size())
+        bot.task_queue.clear()
+        self.assertEqual(0, bot.task_queue.size())
+
+    def test_same_task(self):
+        bot = build_spider(self.SimpleSpider)
+        self.setup_queue(bot)
+        bot.task_queue.clear()
+        task = Task('page', url='http://example.com/')
+        bot.task_queue.put(task, 1)
+        bot.task_queue.put(task, 1)
+        self.assertEqual(2, bot.task_queue.size())
+
+    def test_shared_queue(self):
+        bot = build_spider(self.SimpleSpider)
+        self.setup_queue(bot)
+        bot.task_queue.clear()
+        bot2 = build_spider(self.SimpleSpider)
+        self.setup_queue(bot2)
+        now = datetime.utcnow()
+        for x in six.moves.range(10):
+            bot.task_queue.put(Task('page', url='http://%d.com/' % x), 5,
+                               schedule_time=now - timedelta(seconds=x))
+        tasks = bot.task_queue.get_many(6)
+        tasks2 = bot2.task_queue.get_many(6)
+        self.assertEqual(['http://%d.com/' % x for x in six.moves.range(10)],
+                         sorted(x.url for x in tasks + tasks2))
+        # Tasks given out on lease are in the queue until they are processed
+        self.assertEqual(10, bot.task_queue.size())
+        for task in tasks:
+            bot.task_queue.ack(task)
+        for task in tasks2:
+            bot2.task_queue.ack(task)
+        bot.task_queue.flush_acks()
+        bot2.task_queue.flush_acks()
+        self.assertEqual(0, bot.task_queue.size())
+
+    def test_lease(self):
+        bot = build_spider(self.SimpleSpider)
+        bot.setup_queue(backend='redis', lease_timeout=1, **REDIS_CONNECTION)
+        bot.task_queue.clear()
+        bot.task_queue.put(Task('page', url='http://example.com/'), 1)
+        task = bot.task_queue.get()
+        self.assertEqual([], bot.task_queue.get_many(1))
+        self.assertEqual(1, bot.task_queue.size())
+        # The lease has expired, the task is given out again
+        time.sleep(1.1)
+        task2 = bot.task_queue.get()
+        self.assertEqual('http://example.com/', task2.url)
+        # Stale lease does not remove the task
+        bot.task_queue.ack(task)
+        bot.task_queue.flush_acks()
+        self.assertEqual(1, bot.task_queue.size())
+        bot.task_queue.ack(task2)
+        self.assertEqual(0, bot.task_queue.size())
+        bot.task_queue.flush_acks()
+        self.assertEqual(0, bot.task_queue.redis.zcard(
+            bot.task_queue.schedule_key))
+
+    def test_no_lease(self):
+        bot = build_spider(self.SimpleSpider)
+        bot.setup_queue(backend='redis', lease_timeout=0, **REDIS_CONNECTION)
+        bot.task_queue.clear()
+        bot.task_queue.put(Task('page', url='http://example.com/'), 1)
+        task = bot.task_queue.get()
+        self.assertEqual(None, task.queue_lease)
+        self.assertEqual(0, bot.task_queue.size())
+
+
+class SpiderSqliteQueueTestCase(SpiderQueueMixin, BaseGrabTestCase):
+    def setUp(self):
+        super(SpiderSqliteQueueTestCase, self).setUp()
+        self.tmp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp_dir, 'queue.sqlite')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def setup_queue(self, bot, **kwargs):
+        bot.setup_queue(backend='sqlite', path=self.path, **kwargs)
+
+    def test_schedule(self):
+        server = self.server
+
+        class TestSpider(Spider):
+            def task_generator(self):
+                yield Task('page', url=server.get_url(), delay=1.5, num=3)
+                yield Task('page', url=server.get_url(), delay=3, num=4)
+                yield Task('page', url=server.get_url(), num=1)
+
+            def task_page(self, grab, task):
+                self.stat.collect('numbers', task.num)
+
+        bot = build_spider(TestSpider, thread_number=1)
+        self.setup_queue(bot)
+        bot.run()
+        self.assertEqual(bot.stat.collections['numbers'], [1, 3, 4])
+
+    def test_persistence(self):
+        bot = build_spider(self.SimpleSpider)
+        self.setup_queue(bot, batch_size=2)
+        for x in six.moves.range(5):
+            bot.add_task(Task('page', url='http://%d.com/' % x, priority=1))
+        bot.task_queue.close()
+
+        bot = build_spider(self.SimpleSpider)
+        self.setup_queue(bot)
+        self.assertEqual(5, bot.task_queue.size())
+        self.assertEqual('http://0.com/', bot.task_queue.get().url)
+        self.assertEqual(4, bot.task_queue.size())
+
+    def test_ack(self):
+        bot = build_spider(self.SimpleSpider)
+        self.setup_queue(bot)
+        for x in six.moves.range(3):
+            bot.add_task(Task('page', url='http://%d.com/' % x, priority=1))
+        task1, task2 = bot.task_queue.get_many(2)
+        self.assertEqual(1, bot.task_queue.size())
+        bot.task_queue.ack(task1)
+        bot.task_queue.close()
+
+        # Taken task which has not been processed is given out again
+        bot = build_spider(self.SimpleSpider)
+        self.setup_queue(bot)
+        self.assertEqual(2, bot.task_queue.size())
+        self.assertEqual(['http://1.com/', 'http://2.com/'],
+                         [x.url for x in bot.task_queue.get_many(10)])
+
+    def test_buffered_tasks_written_lazily(self):
         bot = build_spider(self.SimpleSpider)
+        self.setup_queue(bot, flush_interval=100)
+        bot.task_queue.put(Task('page', url='http://0.com/'), 1)
+        bot.task_queue.flush()
+        bot.task_queue.put(Task('page', url='http://1.com/'), 1)
+        self.assertEqual('http://0.com/', bot.task_queue.get().url)
+        self.assertEqual(1, len(bot.task_queue.write_buffer))
+        self.assertEqual('http://1.com/', bot.task_queue.get().url)
+        self.assertEqual([], bot.task_queue.write_buffer)
+
+    def test_spider_keeps_queue(self):
+        server = self.server
+
+        class TestSpider(Spider):
+            def task_page(self, grab, task):
+                self.stop()
+
+        bot = build_spider(TestSpider, thread_number=1)
         self.setup_queue(bot)
+        for x in six.moves.range(10):
+            bot.add_task(Task('page', url=server.get_url() + '?%d' % x))
+        bot.run()
+
+        bot = build_spider(TestSpider)
+        self.setup_queue(bot)
+        self.assertTrue(bot.task_queue.size() > 0)
+
+
+class SpiderSpillQueueTestCase(SpiderQueueMixin, BaseGrabTestCase):
+    def setUp(self):
+        super(SpiderSpillQueueTestCase, self).setUp()
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def setup_queue(self, bot, **kwargs):
+        bot.setup_queue(backend='spill', path=self.tmp_dir, **kwargs)
+
+    def test_spill_priority_order(self):
+        bot = build_spider(self.SimpleSpider)
+        self.setup_queue(bot, max_size=4, max_runs=2)
+        priorities = [7, 3, 9, 1, 5, 3, 8, 2, 6, 4, 1, 9, 5, 7]
+        for num, priority in enumerate(priorities):
+            bot.task_queue.put(Task('page', url='http://%d.com/' % num,
+                                    num=num), priority)
+        self.assertTrue(len(bot.task_queue.ready_heap) <= 4)
+        self.assertEqual(len(priorities), bot.task_queue.size())
+        nums = [x.num for x in bot.task_queue.get_many(100)]
+        expected = [x[1] for x in sorted((y, x) for x, y
+                                         in enumerate(priorities))]
+        self.assertEqual(expected, nums)
+        self.assertEqual(0, bot.task_queue.size())
+        self.assertEqual([], os.listdir(bot.task_queue.run_dir))
+
+    def test_clear_and_close(self):
+        bot = build_spider(self.SimpleSpider)
+        self.setup_queue(bot, max_size=2)
+        for x in six.moves.range(10):
+            bot.task_queue.put(Task('page', url='http://%d.com/' % x), x)
+        run_dir = bot.task_queue.run_dir
+        self.assertTrue(os.listdir(run_dir))
         bot.task_queue.clear()
-        self.assertRaises(SpiderMisuseError,
-                          bot.add_task,
-                          Task('page', url=self.server.get_url(), delay=1))
+        self.assertEqual(0, bot.task_queue.size())
+        self.assertFalse(os.path.exists(run_dir))
+        # The queue could be used after the clear
+        for x in six.moves.range(10):
+            bot.task_queue.put(Task('page', url='http://%d.com/' % x), x)
+        self.assertEqual(10, len(bot.task_queue.get_many(100)))
+        bot.task_queue.close()
+        self.assertEqual([], os.listdir(self.tmp_dir))
+
+    def test_spill_delayed_tasks(self):
+        bot = build_spider(self.SimpleSpider)
+        self.setup_queue(bot, max_size=4, max_runs=2)
+        now = datetime.utcnow()
+        delays = [7, 3, 9, 1, 5, 8, 2, 6, 4, 10]
+        for num, delay in enumerate(delays):
+            bot.task_queue.put(Task('page', url='http://%d.com/' % num,
+                                    num=num), 1,
+                               schedule_time=now - timedelta(seconds=delay))
+        bot.task_queue.put(Task('page', url='http://future.com/'), 1,
+                           schedule_time=now + timedelta(seconds=60))
+        self.assertTrue(len(bot.task_queue.schedule_list) <= 4)
+        self.assertTrue(bot.task_queue.schedule_run_heap)
+        self.assertEqual(len(delays) + 1, bot.task_queue.size())
+        nums = [x.num for x in bot.task_queue.get_many(100)]
+        expected = [x[1] for x in sorted(((y, x) for x, y
+                                          in enumerate(delays)),
+                                         reverse=True)]
+        self.assertEqual(expected, nums)
+        self.assertEqual(1, bot.task_queue.size())
+
+
+class AddTasksTestCase(TestCase):
+    def test_add_tasks(self):
+        bot = Spider()
+        bot.setup_queue()
+        self.assertEqual(2, bot.add_tasks([Task('page', url='http://a.com/'),
+                                           Task('page', url='http://b.com/')]))
+        self.assertEqual(2, bot.task_queue.size())
+
+    def test_overridden_add_task(self):
+        class TestSpider(Spider):
+            def add_task(self, task, raise_error=False):
+                if 'skip' in task.url:
+                    return False
+                task.url += '?from=hook'
+                return super(TestSpider, self).add_task(task, raise_error)
+
+        bot = TestSpider()
+        bot.setup_queue()
+        self.assertEqual(1, bot.add_tasks([Task('page', url='http://a.com/'),
+                                           Task('page', url='http://skip/')]))
+        self.assertEqual(['http://a.com/?from=hook'],
+                         [x.url for x in bot.task_queue.get_many(10)])
 
 
 class QueueInterfaceTestCase(TestCase):
@@ -157,3 +502,22 @@ class QueueInterfaceTestCase(TestCase):
         self.assertRaises(NotImplementedError, task_queue.get)
         self.assertRaises(NotImplementedError, task_queue.size)
         self.assertRaises(NotImplementedError, task_queue.clear)
+
+    def test_default_bulk_methods(self):
+        class ListQueue(QueueInterface):
+            def __init__(self, spider_name, **kwargs):
+                self.items = []
+
+            def put(self, task, priority, schedule_time=None):
+                self.items.append(task)
+
+            def get(self):
+                if not self.items:
+                    raise six.moves.queue.Empty()
+                return self.items.pop(0)
+
+        task_queue = ListQueue('spider_name')
+        task_queue.put_many([('a', 1, None), ('b', 1, None), ('c', 1, None)])
+        self.assertEqual(['a', 'b'], task_queue.get_many(2))
+        self.assertEqual(['c'], task_queue.get_many(2))
+        self.assertEqual([], task_queue.get_many(2))
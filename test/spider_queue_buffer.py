@@ -0,0 +1,130 @@
+import time
+from unittest import TestCase
+
+from grab.spider import Spider, Task
+from grab.spider.queue_backend.memory import QueueBackend
+from grab.spider.queue_buffer import QueueBuffer
+
+from test.util import BaseGrabTestCase, build_spider
+
+
+class FailingQueueBackend(QueueBackend):
+    fail = True
+
+    def put_many(self, items):
+        if self.fail:
+            raise IOError('Queue is not available')
+        super(FailingQueueBackend, self).put_many(items)
+
+
+class QueueBufferTestCase(TestCase):
+    def test_batch(self):
+        backend = QueueBackend('spider_name')
+        task_queue = QueueBuffer(backend, batch_size=3, flush_interval=60)
+        task_queue.put_many([(Task(url='http://%d.com/' % x), x, None)
+                             for x in range(2)])
+        self.assertEqual(0, backend.size())
+        self.assertEqual(2, task_queue.size())
+        task_queue.put(Task(url='http://2.com/'), 2)
+        for x in range(50):
+            if backend.size() == 3:
+                break
+            time.sleep(0.01)
+        self.assertEqual(3, backend.size())
+        self.assertEqual(3, task_queue.size())
+        self.assertEqual(['http://0.com/', 'http://1.com/'],
+                         [x.url for x in task_queue.get_many(2)])
+        task_queue.close()
+
+    def test_flush_interval(self):
+        backend = QueueBackend('spider_name')
+        task_queue = QueueBuffer(backend, flush_interval=0.05)
+        task_queue.put(Task(url='http://a.com/'), 1)
+        time.sleep(0.2)
+        self.assertEqual(1, backend.size())
+        task_queue.close()
+
+    def test_local_priority(self):
+        backend = QueueBackend('spider_name')
+        task_queue = QueueBuffer(backend, flush_interval=60,
+                                 local_priority=10, local_size=2)
+        for priority in (20, 5, 1, 3):
+            task_queue.put(Task(url='http://%d.com/' % priority), priority)
+        self.assertEqual(4, task_queue.size())
+        task_queue.flush()
+        self.assertEqual(2, backend.size())
+        self.assertEqual(['http://1.com/', 'http://5.com/', 'http://3.com/'],
+                         [x.url for x in task_queue.get_many(3)])
+        self.assertEqual(1, task_queue.size())
+        task_queue.close()
+
+    def test_close(self):
+        backend = QueueBackend('spider_name')
+        task_queue = QueueBuffer(backend, flush_interval=60,
+                                 local_priority=10)
+        task_queue.put(Task(url='http://a.com/'), 1)
+        task_queue.put(Task(url='http://b.com/'), 20)
+        task_queue.close()
+        self.assertEqual(2, backend.size())
+        self.assertEqual(0, len(task_queue.write_buffer))
+        self.assertEqual(0, len(task_queue.local_heap))
+
+    def test_clear(self):
+        backend = QueueBackend('spider_name')
+        task_queue = QueueBuffer(backend, flush_interval=60)
+        backend.put(Task(url='http://a.com/'), 1)
+        task_queue.put(Task(url='http://b.com/'), 1)
+        task_queue.clear()
+        self.assertEqual(0, task_queue.size())
+        task_queue.close()
+
+    def test_failed_flush(self):
+        backend = FailingQueueBackend('spider_name')
+        task_queue = QueueBuffer(backend, flush_interval=60)
+        task_queue.put(Task(url='http://a.com/'), 1)
+        task_queue.flush()
+        self.assertEqual(1, len(task_queue.write_buffer))
+        self.assertEqual(1, task_queue.size())
+        backend.fail = False
+        task_queue.flush()
+        self.assertEqual(1, backend.size())
+        task_queue.close()
+
+    def test_backend_attributes(self):
+        backend = QueueBackend('spider_name')
+        task_queue = QueueBuffer(backend)
+        self.assertTrue(task_queue.ready_heap is backend.ready_heap)
+
+    def test_backend_interface_attributes(self):
+        backend = QueueBackend('spider_name')
+        backend.persistent = True
+        backend.renew_leases = lambda: setattr(backend, 'renewed', True)
+        task_queue = QueueBuffer(backend)
+        self.assertTrue(task_queue.persistent)
+        task_queue.renew_leases()
+        self.assertTrue(backend.renewed)
+
+
+class SpiderQueueBufferTestCase(BaseGrabTestCase):
+    def setUp(self):
+        self.server.reset()
+
+    def test_spider(self):
+        server = self.server
+
+        class TestSpider(Spider):
+            def task_generator(self):
+                for x in range(5):
+                    yield Task('page', url=server.get_url(), num=x)
+
+            def task_page(self, grab, task):
+                self.stat.inc('page')
+                if task.num == 0:
+                    yield Task('page', url=server.get_url(), num=10)
+
+        bot = build_spider(TestSpider)
+        bot.setup_queue()
+        bot.setup_queue_buffer(flush_interval=0.05)
+        bot.run()
+        self.assertEqual(6, bot.stat.counters['page'])
+        self.assertEqual(0, bot.task_queue.size())
@@ -0,0 +1,136 @@
+import time
+from unittest import TestCase
+
+from grab.spider import Spider, Task
+from grab.spider.rate_limit import TokenBucket, RateLimiter
+
+from test.util import BaseGrabTestCase, build_spider
+
+
+class TokenBucketTestCase(TestCase):
+    def test_delay(self):
+        bucket = TokenBucket(2)
+        now = time.time()
+        self.assertEqual(0, bucket.get_delay(now))
+        bucket.consume()
+        self.assertAlmostEqual(0.5, bucket.get_delay(now))
+        self.assertEqual(0, bucket.get_delay(now + 0.5))
+
+    def test_burst(self):
+        bucket = TokenBucket(1, capacity=3)
+        now = time.time()
+        for x in range(3):
+            self.assertEqual(0, bucket.get_delay(now))
+            bucket.consume()
+        self.assertTrue(bucket.get_delay(now) > 0)
+
+
+class RateLimiterTestCase(TestCase):
+    def acquire(self, limiter, url, now, name='page'):
+        delay, buckets = limiter.acquire(Task(name, url=url), now)
+        return delay
+
+    def test_host_limits(self):
+        limiter = RateLimiter(host_rps=1, hosts={'b.com': 10})
+        now = time.time()
+        self.assertEqual(0, self.acquire(limiter, 'http://a.com/', now))
+        self.assertTrue(self.acquire(limiter, 'http://a.com/1', now) > 0)
+        self.assertEqual(0, self.acquire(limiter, 'http://c.com/', now))
+        self.assertEqual(0, self.acquire(limiter, 'http://b.com/', now))
+        self.assertAlmostEqual(
+            0.1, self.acquire(limiter, 'http://b.com/', now))
+
+    def test_task_limits(self):
+        limiter = RateLimiter(tasks={'foo': 1})
+        now = time.time()
+        self.assertEqual(0, self.acquire(limiter, 'http://a.com/', now,
+                                         name='foo'))
+        self.assertTrue(self.acquire(limiter, 'http://b.com/', now,
+                                     name='foo') > 0)
+        for x in range(5):
+            self.assertEqual(
+                0, self.acquire(limiter, 'http://a.com/', now, name='bar'))
+
+    def test_tokens_are_reserved(self):
+        limiter = RateLimiter(host_rps=2)
+        now = time.time()
+        self.assertEqual(0, self.acquire(limiter, 'http://a.com/', now))
+        # Each delayed task gets its own time slot
+        for x in range(1, 4):
+            self.assertAlmostEqual(
+                x * 0.5, self.acquire(limiter, 'http://a.com/', now))
+        self.assertEqual(0, self.acquire(limiter, 'http://b.com/', now))
+
+    def test_deferred_task_global_limit(self):
+        limiter = RateLimiter(rps=10, host_rps=1)
+        now = time.time()
+        deferred = []
+        for x in range(50):
+            task = Task(url='http://a.com/%d' % x)
+            delay, buckets = limiter.acquire(task, now)
+            deferred.append((now + delay, task, buckets))
+        # Tasks delayed by the host limit do not reserve global tokens
+        self.assertAlmostEqual(
+            0.1, self.acquire(limiter, 'http://b.com/', now))
+        # Global token is taken when the delayed task is ready
+        ready_time, task, buckets = deferred[1]
+        self.assertEqual([limiter.global_bucket], buckets)
+        self.assertEqual((0, []),
+                         limiter.acquire(task, ready_time, buckets=buckets))
+        self.assertAlmostEqual(
+            0.1, self.acquire(limiter, 'http://c.com/', ready_time))
+
+    def test_backlog(self):
+        limiter = RateLimiter(host_rps=1, backlog=2)
+        now = time.time()
+        task = Task(url='http://a.com/')
+        for x in range(3):
+            self.assertEqual(0, limiter.get_backlog_delay(task, now))
+            limiter.acquire(task, now)
+        # Two tokens have been reserved
+        self.assertAlmostEqual(1, limiter.get_backlog_delay(task, now))
+        self.assertEqual(0, limiter.get_backlog_delay(task, now + 1))
+        self.assertEqual(
+            0, limiter.get_backlog_delay(Task(url='http://b.com/'), now))
+
+
+class SpiderRateLimitTestCase(BaseGrabTestCase):
+    def setUp(self):
+        self.server.reset()
+
+    def test_host_rps(self):
+        server = self.server
+
+        class TestSpider(Spider):
+            def task_generator(self):
+                for x in range(5):
+                    yield Task('page', url=server.get_url())
+
+            def task_page(self, grab, task):
+                self.stat.collect('times', time.time())
+
+        bot = build_spider(TestSpider, thread_number=5)
+        bot.setup_rate_limit(host_rps=5)
+        bot.run()
+        times = sorted(bot.stat.collections['times'])
+        self.assertEqual(5, len(times))
+        self.assertTrue(times[-1] - times[0] > 0.7)
+        # Each task is delayed only once
+        self.assertEqual(4, bot.stat.counters['spider:rate-limit-delay'])
+
+    def test_backlog(self):
+        server = self.server
+
+        class TestSpider(Spider):
+            def task_generator(self):
+                for x in range(5):
+                    yield Task('page', url=server.get_url())
+
+            def task_page(self, grab, task):
+                self.stat.inc('count')
+
+        bot = build_spider(TestSpider, thread_number=5)
+        bot.setup_rate_limit(host_rps=10, backlog=1)
+        bot.run()
+        self.assertEqual(5, bot.stat.counters['count'])
+        self.assertTrue(bot.stat.counters['spider:rate-limit-backlog'] > 0)
@@ -0,0 +1,85 @@
+import time
+from unittest import TestCase
+
+from grab import Grab
+from grab.spider import Spider, Task
+from grab.spider.network_result import NetworkResult
+from grab.spider.retry import RetryPolicy, get_error_class, parse_retry_after
+
+from test.util import BaseGrabTestCase, build_spider
+
+
+def build_result(code=None, ecode=None, headers=None, try_count=1):
+    task = Task('page', url='http://example.com/')
+    task.network_try_count = try_count
+    grab = Grab()
+    if code is not None:
+        grab.doc.code = code
+        grab.doc.headers = headers or {}
+        return NetworkResult(True, task, grab)
+    else:
+        return NetworkResult(False, task, grab, ecode=ecode)
+
+
+class RetryPolicyTestCase(TestCase):
+    def test_error_class(self):
+        self.assertEqual('http-429', get_error_class(build_result(code=429)))
+        self.assertEqual('http-5xx', get_error_class(build_result(code=502)))
+        self.assertEqual('http-error',
+                         get_error_class(build_result(code=404)))
+        self.assertEqual('timeout', get_error_class(build_result(ecode=28)))
+        self.assertEqual('connect', get_error_class(build_result(ecode=7)))
+        self.assertEqual('network', get_error_class(build_result(ecode=56)))
+
+    def test_exponential_backoff(self):
+        policy = RetryPolicy(curves={'http-5xx': (1, 2, 5)}, jitter=0)
+        delays = [policy.get_delay(build_result(code=503, try_count=x))
+                  for x in range(1, 6)]
+        self.assertEqual([1, 2, 4, 5, 5], delays)
+
+    def test_jitter(self):
+        policy = RetryPolicy(curves={'timeout': (10, 2, 100)}, jitter=0.5)
+        for x in range(20):
+            delay = policy.get_delay(build_result(ecode=28))
+            self.assertTrue(5 <= delay <= 15)
+
+    def test_retry_after(self):
+        policy = RetryPolicy(curves={'http-429': (1, 2, 5)}, jitter=0,
+                             max_retry_after=100)
+        res = build_result(code=429, headers={'Retry-After': '30'})
+        self.assertEqual(30, policy.get_delay(res))
+        res = build_result(code=429, headers={'Retry-After': '3000'})
+        self.assertEqual(100, policy.get_delay(res))
+        policy = RetryPolicy(curves={'http-429': (1, 2, 5)}, jitter=0,
+                             retry_after=False)
+        self.assertEqual(1, policy.get_delay(res))
+
+    def test_parse_retry_after(self):
+        self.assertEqual(120, parse_retry_after(' 120 '))
+        self.assertEqual(
+            60, parse_retry_after('Wed, 21 Oct 2015 07:29:00 GMT',
+                                  now=1445412480))
+        self.assertEqual(None, parse_retry_after('foo'))
+
+
+class SpiderRetryTestCase(BaseGrabTestCase):
+    def setUp(self):
+        self.server.reset()
+
+    def test_retry_delay(self):
+        server = self.server
+        server.response_once['code'] = 503
+
+        class TestSpider(Spider):
+            def task_generator(self):
+                yield Task('page', url=server.get_url())
+
+            def task_page(self, grab, task):
+                self.stat.collect('time', time.time())
+
+        bot = build_spider(TestSpider)
+        bot.setup_retry_policy(curves={'http-5xx': (1, 2, 10)}, jitter=0)
+        start = time.time()
+        bot.run()
+        self.assertEqual(1, bot.stat.counters['spider:retry-delay-http-5xx'])
+        self.assertTrue(bot.stat.collections['time'][0] - start >= 1)
@@ -1,3 +1,6 @@
+import pickle
+from unittest import TestCase
+
 import six
 
 import grab.spider.base
@@ -333,3 +336,48 @@ class TestSpider(BaseGrabTestCase):
             bot.add_task(Task('page', url='http://ya.ru/'))
         bot.run()
         self.assertTrue(1 < bot.stat.counters['parser-pipeline-restore'])
+
+
+class TaskLayoutTestCase(TestCase):
+    def test_no_instance_dict(self):
+        task = Task('page', url='http://example.com/')
+        self.assertFalse(hasattr(task, '__dict__'))
+        self.assertEqual(None, task.grab_config)
+        self.assertEqual(None, task._extra)
+
+    def test_custom_attributes(self):
+        task = Task('page', url='http://example.com/', foo=1)
+        self.assertEqual(1, task.foo)
+        self.assertEqual(1, task.get('foo'))
+        self.assertEqual(None, task.get('bar'))
+        self.assertEqual(2, task.get('bar', 2))
+        self.assertRaises(AttributeError, lambda: task.bar)
+        task.bar = 3
+        self.assertEqual(3, task.bar)
+        del task.bar
+        self.assertEqual(None, task.get('bar'))
+
+    def test_clone_custom_attributes(self):
+        task = Task('page', url='http://example.com/', foo=1)
+        task.coroutines_stack.append('x')
+        task2 = task.clone(bar=2)
+        self.assertEqual(1, task2.foo)
+        self.assertEqual(2, task2.bar)
+        self.assertEqual(['x'], task2.coroutines_stack)
+        self.assertEqual(None, task2.grab_config)
+
+    def test_grab_config_is_private(self):
+        grab = Grab(url='http://example.com/')
+        task = Task('page', grab_config=grab.config)
+        task.grab_config['url'] = 'http://example.com/2'
+        self.assertEqual('http://example.com/', grab.config['url'])
+        task2 = task.clone()
+        task2.grab_config['timeout'] = 100
+        self.assertNotEqual(100, task.grab_config['timeout'])
+
+    def test_pickle(self):
+        task = Task('page', url='http://example.com/', priority=3, foo=1)
+        task2 = pickle.loads(pickle.dumps(task))
+        self.assertEqual(task.dump_attrs(), task2.dump_attrs())
+        self.assertEqual(1, task2.foo)
+        self.assertEqual(3, task2.priority)
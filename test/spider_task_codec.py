@@ -0,0 +1,62 @@
+from datetime import datetime
+import pickle
+from unittest import TestCase
+
+from grab import Grab
+from grab.spider import Task
+from grab.spider.task_codec import encode_task, decode_task
+
+
+class TaskCodecTestCase(TestCase):
+    def test_url_task(self):
+        task = Task('page', url='http://example.com/', priority=5,
+                    delay=10, level=2, tags=['a'])
+        data = encode_task(task)
+        self.assertTrue(len(data) < len(pickle.dumps(task)))
+        task2 = decode_task(data)
+        self.assertEqual(task.dump_attrs(), task2.dump_attrs())
+        self.assertTrue(isinstance(task2.schedule_time, datetime))
+        self.assertEqual(None, task2.grab_config)
+
+    def test_grab_task(self):
+        grab = Grab(url='http://example.com/', timeout=7,
+                    headers={'X-Foo': 'bar'})
+        grab.cookies.set('sid', '123', domain='example.com')
+        task = Task('page', grab=grab)
+        data = encode_task(task)
+        self.assertTrue(len(data) < len(pickle.dumps(task)) / 2)
+        task2 = decode_task(data)
+        self.assertEqual('http://example.com/', task2.url)
+        grab2 = Grab()
+        grab2.load_config(task2.grab_config)
+        self.assertEqual('http://example.com/', grab2.config['url'])
+        self.assertEqual(7, grab2.config['timeout'])
+        self.assertEqual({'X-Foo': 'bar'}, grab2.config['headers'])
+        self.assertEqual([('sid', '123', 'example.com')],
+                         [(x['name'], x['value'], x['domain'])
+                          for x in grab2.cookies.get_dict()])
+        self.assertEqual(set(task.grab_config), set(task2.grab_config))
+
+    def test_mutable_defaults(self):
+        task = decode_task(encode_task(Task('page', url='http://a.com/')))
+        task.valid_status.append(404)
+        task2 = decode_task(encode_task(Task('page', url='http://a.com/')))
+        self.assertEqual([], task2.valid_status)
+
+    def test_queue_lease(self):
+        task = Task('page', url='http://example.com/')
+        task.queue_lease = b'lease'
+        self.assertEqual(None, decode_task(encode_task(task)).queue_lease)
+
+    def test_clone(self):
+        task = decode_task(encode_task(Task('page', url='http://a.com/',
+                                            foo=1)))
+        task2 = task.clone(url='http://b.com/')
+        self.assertEqual('http://b.com/', task2.url)
+        self.assertEqual(1, task2.foo)
+        self.assertEqual(2, task2.task_try_count)
+
+    def test_pickled_task(self):
+        task = Task('page', url='http://example.com/', foo='bar')
+        task2 = decode_task(pickle.dumps(task))
+        self.assertEqual('bar', task2.foo)
@@ -0,0 +1,116 @@
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+from grab.spider import Spider, Task
+from grab.spider.url_filter import canonicalize_url
+from grab.spider.url_filter_backend.base import (BloomFilter,
+                                                 ScalableBloomFilter,
+                                                 get_bloom_size)
+from grab.spider.url_filter_backend import disk
+
+from test.util import BaseGrabTestCase, build_spider
+
+
+class CanonicalizeUrlTestCase(TestCase):
+    def test_canonicalize_url(self):
+        self.assertEqual('http://example.com/',
+                         canonicalize_url('HTTP://Example.COM:80'))
+        self.assertEqual('https://example.com:8443/a?a=1&b=2',
+                         canonicalize_url('https://example.com:8443/a'
+                                          '?b=2&a=1#top'))
+        self.assertEqual('http://example.com/?b=2',
+                         canonicalize_url('http://example.com/'
+                                          '?utm_source=x&b=2&utm_medium=y',
+                                          remove_params=['utm_*']))
+        self.assertEqual('http://example.com/?b=2&a=1#top',
+                         canonicalize_url('http://example.com/?b=2&a=1#top',
+                                          sort_query=False,
+                                          keep_fragment=True))
+
+
+class BloomFilterTestCase(TestCase):
+    def test_add(self):
+        bloom = BloomFilter(*get_bloom_size(1000, 0.001))
+        self.assertFalse(bloom.add(b'foo'))
+        self.assertTrue(bloom.add(b'foo'))
+        self.assertTrue(bloom.contains(b'foo'))
+        self.assertFalse(bloom.contains(b'bar'))
+        self.assertEqual(1, bloom.count)
+
+    def test_false_positive_rate(self):
+        bloom = BloomFilter(*get_bloom_size(10000, 0.01))
+        for x in range(10000):
+            bloom.add(('http://example.com/%d' % x).encode('ascii'))
+        fp_count = sum(1 for x in range(10000)
+                       if bloom.contains(('http://foo.com/%d' % x)
+                                         .encode('ascii')))
+        self.assertTrue(fp_count < 200)
+
+    def test_scalable(self):
+        bloom = ScalableBloomFilter(
+            10, 0.001, lambda n, bits, hashes: BloomFilter(bits, hashes))
+        for x in range(100):
+            self.assertFalse(bloom.add(('%d' % x).encode('ascii')))
+        for x in range(100):
+            self.assertTrue(bloom.add(('%d' % x).encode('ascii')))
+        self.assertEqual(4, len(bloom.filters))
+
+
+class DiskUrlFilterTestCase(TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp_dir, 'filter')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_persistence(self):
+        url_filter = disk.UrlFilterBackend('spider', path=self.path,
+                                           capacity=10)
+        for x in range(30):
+            self.assertFalse(url_filter.add(('%d' % x).encode('ascii')))
+        url_filter.close()
+
+        url_filter = disk.UrlFilterBackend('spider', path=self.path,
+                                           capacity=10)
+        self.assertEqual(3, len(url_filter.bloom.filters))
+        for x in range(30):
+            self.assertTrue(url_filter.add(('%d' % x).encode('ascii')))
+        url_filter.clear()
+        self.assertFalse(url_filter.add(b'1'))
+        url_filter.close()
+
+    def test_spider_closes_filter(self):
+        bot = Spider()
+        bot.setup_url_filter(backend='disk', path=self.path)
+        bot.run()
+        self.assertTrue(bot.url_filter.backend.bloom.filters[0].file.closed)
+
+
+class SpiderUrlFilterTestCase(BaseGrabTestCase):
+    def setUp(self):
+        self.server.reset()
+
+    def test_duplicates(self):
+        server = self.server
+
+        class TestSpider(Spider):
+            def task_generator(self):
+                for x in range(3):
+                    yield Task('page', url=server.get_url() + '?a=1&b=2')
+                    yield Task('page', url=server.get_url() + '?b=2&a=1')
+                yield Task('page', url=server.get_url() + '?a=1&b=2',
+                           disable_url_filter=True)
+
+            def task_page(self, grab, task):
+                self.stat.inc('page')
+
+        bot = build_spider(TestSpider)
+        bot.setup_url_filter(fp_sample_rate=1)
+        bot.run()
+        self.assertEqual(2, bot.stat.counters['page'])
+        self.assertEqual(5, bot.stat.counters['spider:url-filter-duplicate'])
+        self.assertEqual(0, bot.stat.counters[
+            'spider:url-filter-false-positive'])